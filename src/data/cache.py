@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module contains the content-addressed preprocessing cache
+######################################################################
+
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+MANIFEST_FILE = "manifest.json"
+
+
+def content_digest(data: bytes) -> str:
+    """Returns the SHA-256 hex digest of a raw file's bytes"""
+
+    return hashlib.sha256(data).hexdigest()
+
+
+def params_digest(params: Dict) -> str:
+    """Returns a short digest of the preprocessing parameters"""
+
+    encoded = json.dumps(params, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def _atomic_write(path: str, write) -> None:
+    """Writes through a temporary file so readers never see a partial entry"""
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+class PreprocessCache(object):
+    """Per-image store of preprocessed results
+
+    Entries live under <root>/<params digest>/<content digest>.npy, so changing any
+    preprocessing parameter starts a fresh namespace instead of serving stale results.
+    The object only holds two strings and is cheap to send to pool workers.
+    """
+
+    def __init__(self, root: str, params: Dict) -> None:
+        self.root = root
+        self.directory = os.path.join(root, params_digest(params))
+
+    def path(self, digest: str) -> str:
+        """Returns the location of the entry for a content digest"""
+
+        return os.path.join(self.directory, digest[:2], digest + ".npy")
+
+    def load(self, digest: str) -> Optional[np.ndarray]:
+        """Returns the cached result or None on a miss"""
+
+        path = self.path(digest)
+        if not os.path.isfile(path):
+            return None
+        try:
+            return np.load(path)
+        except (OSError, ValueError):
+            # truncated or foreign file, recompute and overwrite it
+            return None
+
+    def store(self, digest: str, image: np.ndarray) -> None:
+        """Stores a result for a content digest"""
+
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _atomic_write(path, lambda f: np.save(f, image))
+
+
+class FileManifest(object):
+    """Remembers the content digest of raw files by a cheap signature such as (size, mtime)
+
+    This lets a rerun skip re-reading and hashing files that were not touched since the
+    last run.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.path = os.path.join(root, MANIFEST_FILE)
+        self.entries: Dict[str, List] = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def lookup(self, key: str, signature: Tuple) -> Optional[str]:
+        """Returns the known digest if the signature is unchanged, otherwise None"""
+
+        entry = self.entries.get(key)
+        if entry is None or entry[:-1] != list(signature):
+            return None
+        return entry[-1]
+
+    def remember(self, key: str, signature: Tuple, digest: str) -> None:
+        """Records the digest of a file together with its current signature"""
+
+        self.entries[key] = list(signature) + [digest]
+
+    def save(self) -> None:
+        """Writes the manifest to disk"""
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = json.dumps(self.entries).encode()
+        _atomic_write(self.path, lambda f: f.write(data))
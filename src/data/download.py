@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module contains the resumable, checksum-verified downloader
+######################################################################
+
+import glob
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import requests
+from tqdm import tqdm
+
+from src.data.hashing import sha256sum
+
+# ranges smaller than this are not worth an extra connection
+MIN_RANGE_SIZE = 8 * 1024 * 1024
+
+
+def _probe(url: str, timeout: float) -> Tuple[Optional[int], bool]:
+    """Returns the content length (None if unknown) and whether byte ranges are served"""
+
+    r = requests.head(url, allow_redirects=True, timeout=timeout)
+    if r.ok and "content-length" in r.headers:
+        accepts_ranges = r.headers.get("accept-ranges", "").lower() == "bytes"
+        return int(r.headers["content-length"]), accepts_ranges
+
+    # some servers do not answer HEAD properly, ask for the first byte instead
+    r = requests.get(url, headers={"Range": "bytes=0-0"}, stream=True, timeout=timeout)
+    r.close()
+    if r.status_code == 206 and "/" in r.headers.get("content-range", ""):
+        total = r.headers["content-range"].rsplit("/", 1)[1]
+        return (int(total) if total.isdigit() else None), True
+    if "content-length" in r.headers and r.status_code == 200:
+        return int(r.headers["content-length"]), False
+    return None, False
+
+
+def _plan_ranges(
+    total_size: int, connections: int, min_range_size: int = MIN_RANGE_SIZE
+) -> List[Tuple[int, int]]:
+    """Splits [0, total_size) into at most `connections` contiguous inclusive ranges"""
+
+    count = max(1, min(connections, total_size // max(1, min_range_size)))
+    bounds = [total_size * i // count for i in range(count + 1)]
+    return [(bounds[i], bounds[i + 1] - 1) for i in range(count) if bounds[i + 1] > bounds[i]]
+
+
+def _part_path(dest: str, start: int, end: int) -> str:
+    """Returns the file a byte range is downloaded into"""
+
+    return f"{dest}.part-{start}-{end}"
+
+
+def _fetch_range(
+    url: str,
+    dest: str,
+    start: int,
+    end: int,
+    chunk_size: int,
+    timeout: float,
+    progress: tqdm,
+    lock: threading.Lock,
+) -> None:
+    """Downloads bytes [start, end] into their part file, resuming from what is there"""
+
+    part = _part_path(dest, start, end)
+    have = os.path.getsize(part) if os.path.isfile(part) else 0
+    length = end - start + 1
+    if have > length:
+        # longer than its range, e.g. written under another layout: it would corrupt dest
+        os.remove(part)
+        have = 0
+    with lock:
+        progress.update(have)
+    if have == length:
+        return
+
+    headers = {"Range": f"bytes={start + have}-{end}"}
+    with requests.get(url, headers=headers, stream=True, timeout=timeout) as r:
+        if r.status_code != 206:
+            raise IOError(f"Server ignored range request for {url} (HTTP {r.status_code})")
+        with open(part, "ab") as f:
+            for data in r.iter_content(chunk_size=chunk_size):
+                f.write(data)
+                with lock:
+                    progress.update(len(data))
+
+    if os.path.getsize(part) != length:
+        raise IOError(f"Range {start}-{end} of {url} ended early, rerun to resume")
+
+
+def _fetch_whole(url: str, dest: str, chunk_size: int, timeout: float, progress: tqdm) -> None:
+    """Downloads the file over a single request when ranges are not available"""
+
+    with requests.get(url, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        with open(_part_path(dest, 0, -1), "wb") as f:
+            for data in r.iter_content(chunk_size=chunk_size):
+                f.write(data)
+                progress.update(len(data))
+
+
+def _check_existing(
+    url: str, dest: str, sha256: Optional[str], chunk_size: int, timeout: float
+) -> Tuple[bool, Optional[Tuple[Optional[int], bool]]]:
+    """Returns whether an existing dest can be kept and the probe of url, if one was made
+
+    With sha256 the file is verified, without it at least a truncated file is caught by
+    comparing its size with the content length. A rejected dest is removed.
+    """
+
+    if not os.path.isfile(dest):
+        return False, None
+    probed = None
+    if sha256:
+        if sha256sum(dest, chunk_size) == sha256.lower():
+            return True, None
+        print(f"[INFO] {dest} does not match the expected checksum, downloading again...")
+    else:
+        try:
+            probed = _probe(url, timeout)
+        except requests.RequestException:
+            print(f"[INFO] Cannot reach {url}, using {dest} unverified")
+            return True, None
+        size = os.path.getsize(dest)
+        if probed[0] is None or size == probed[0]:
+            return True, probed
+        print(f"[INFO] {dest} has {size} bytes instead of {probed[0]}, downloading again...")
+    os.remove(dest)
+    return False, probed
+
+
+def _join_parts(dest: str, ranges: List[Tuple[int, int]], chunk_size: int) -> str:
+    """Concatenates the part files into dest.tmp and returns its SHA-256, in one pass"""
+
+    digest = hashlib.sha256()
+    with open(dest + ".tmp", "wb") as out:
+        for start, end in ranges:
+            with open(_part_path(dest, start, end), "rb") as part:
+                for block in iter(lambda: part.read(chunk_size), b""):
+                    digest.update(block)
+                    out.write(block)
+    for start, end in ranges:
+        os.remove(_part_path(dest, start, end))
+    return digest.hexdigest()
+
+
+def download_file(
+    url: str,
+    dest: str,
+    sha256: Optional[str] = None,
+    connections: int = 4,
+    chunk_size: int = 1024 * 1024,
+    timeout: float = 60.0,
+    min_range_size: int = MIN_RANGE_SIZE,
+) -> None:
+    """Downloads url to dest over parallel, resumable HTTP ranges
+
+    Every range is written to its own part file, so an interrupted download picks up where
+    each range stopped. dest only appears once the download is complete and, if sha256 is
+    given, verified; a mismatch removes the data and raises ValueError. Without sha256 an
+    existing dest is only reused if its size matches the content length of url.
+    """
+
+    reuse, probed = _check_existing(url, dest, sha256, chunk_size, timeout)
+    if reuse:
+        return
+
+    total_size, accepts_ranges = probed or _probe(url, timeout)
+    if total_size is not None and accepts_ranges:
+        ranges = _plan_ranges(total_size, connections, min_range_size)
+    else:
+        ranges = [(0, -1)]
+
+    # parts of an earlier run with a different range layout cannot be resumed
+    for stale in set(glob.glob(f"{glob.escape(dest)}.part-*")) - {
+        _part_path(dest, start, end) for start, end in ranges
+    }:
+        os.remove(stale)
+
+    lock = threading.Lock()
+    with tqdm(total=total_size, unit="B", unit_scale=True, unit_divisor=1024) as progress:
+        if ranges == [(0, -1)]:
+            _fetch_whole(url, dest, chunk_size, timeout, progress)
+        else:
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                futures = [
+                    executor.submit(
+                        _fetch_range, url, dest, start, end, chunk_size, timeout, progress, lock
+                    )
+                    for start, end in ranges
+                ]
+                for future in futures:
+                    future.result()
+
+    digest = _join_parts(dest, ranges, chunk_size)
+    tmp_dest = dest + ".tmp"
+    if sha256 and digest != sha256.lower():
+        os.remove(tmp_dest)
+        raise ValueError(f"Checksum mismatch for {url}: expected {sha256}, got {digest}")
+    if not sha256:
+        print(f"[INFO] No checksum configured, SHA-256 of {dest} is {digest}")
+    os.replace(tmp_dest, dest)
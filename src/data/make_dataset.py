@@ -1,16 +1,23 @@
 # -*- coding: utf-8 -*-
 import argparse
+import collections
+import io
+import itertools
 import logging
+import multiprocessing
+import multiprocessing.pool
 import os
-import sys
+import threading
+import time
+import tracemalloc
 import zipfile
 from distutils.command import config
 from pathlib import Path
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import kornia as K
 import matplotlib.pyplot as plt
 import numpy as np
-import requests
 import torch
 import torchvision
 from dotenv import find_dotenv, load_dotenv
@@ -20,9 +27,22 @@ from sklearn.model_selection import train_test_split
 from torchvision import transforms
 from tqdm import tqdm
 
+from src.data.cache import FileManifest, PreprocessCache, content_digest
+from src.data.download import download_file
+from src.data.profiling import Profiler
+from src.data.pyramid import BASE_RESOLUTION, downsample, resolution_path
+from src.data.shards import ShardedArray, ShardWriter
+
 config = OmegaConf.load("config/data.yaml")
 url = config.URL
 
+# bump whenever the per-image pipeline changes, it invalidates the preprocessing cache
+PIPELINE_VERSION = 2
+
+# separates archive path and member name in image references read from a zip
+ZIP_SEPARATOR = "::"
+_ZIP_HANDLES = threading.local()
+
 
 def download_extract(
     zip_file_url: str,
@@ -30,6 +50,10 @@ def download_extract(
     filename: str = config.FILENAME,
     foldername: str = config.FOLDERNAME,
     chunk_size: int = config.CHUNK_SIZE,
+    sha256: str = config.SHA256,
+    connections: int = config.CONNECTIONS,
+    extract: bool = config.EXTRACT,
+    profiler: Optional[Profiler] = None,
 ) -> None:
     """
     Script to download dataset zip into raw folder
@@ -37,36 +61,66 @@ def download_extract(
     PATH : path to download to
     filename : wanted filename for zip
     foldername : unzipped foldername
+    sha256 : expected SHA-256 of the zip, empty to skip verification
+    connections : number of parallel HTTP range requests
+    extract : unzip the archive, preprocess can also read the zip directly
+    profiler : collects the timings of the download and extract stages
     inspired by: https://gist.github.com/nikhilkumarsingh/d29c1fdec0f4e266e53137d96b52e289
     """
 
     if PATH[-1] != "/":
-        PATH.append("/")
+        PATH += "/"
 
-    download = True
-    extract = True
-    if os.path.isfile(PATH + filename):
-        download = False
     if os.path.isdir(PATH + foldername):
         extract = False
 
-    if download:
-        r = requests.get(zip_file_url, stream=True)
-        total_size = int(r.headers["content-length"])
-        with open(PATH + filename, "wb") as f:
-            for data in tqdm(
-                iterable=r.iter_content(chunk_size=chunk_size),
-                total=total_size / chunk_size,
-                unit="KB",
-            ):
-                f.write(data)
-        print("Download complete!")
-        del r
+    profiler = profiler or Profiler()
+
+    # resumes partial downloads and re-downloads a zip that fails verification
+    with profiler.stage("download") as stage:
+        download_file(
+            zip_file_url,
+            PATH + filename,
+            sha256=sha256 or None,
+            connections=connections,
+            chunk_size=chunk_size,
+        )
+        stage["bytes"] = os.path.getsize(PATH + filename)
 
     if extract:
-        z = zipfile.ZipFile(PATH + filename)
-        z.extractall(PATH)
-        del z
+        with profiler.stage("extract") as stage:
+            z = zipfile.ZipFile(PATH + filename)
+            z.extractall(PATH)
+            stage["bytes"] = sum(info.file_size for info in z.infolist())
+            del z
+
+
+# pixel value of full intensity for the integer PIL modes that are not 8 bit
+PIL_MODE_MAX = {"I;16": 65535, "I;16B": 65535, "I;16L": 65535, "I;16N": 65535, "I": 65535}
+
+
+def varying_channels(images: torch.Tensor) -> torch.Tensor:
+    """Returns a (..., C) mask of the channels that are not constant
+
+    A channel is constant if its maximum equals its minimum, so the mask for a single
+    image or a whole (N, C, H, W) batch comes from one reduction over the pixels.
+    """
+
+    flat = images.flatten(-2)
+    return flat.amax(-1) != flat.amin(-1)
+
+
+def select_channels(img: torch.Tensor, varying: torch.Tensor) -> torch.Tensor:
+    """Keeps the first three varying channels of a (C, H, W) image
+
+    Images with fewer than three varying channels are treated as gray and keep only the
+    first varying channel, or the first channel if the image is blank.
+    """
+
+    (index,) = torch.nonzero(varying, as_tuple=True)
+    if len(index) >= 3:
+        return img[index[:3]]
+    return img[index[:1]] if len(index) else img[:1]
 
 
 class check_size_and_gray(object):
@@ -75,38 +129,22 @@ class check_size_and_gray(object):
     def __init__(self, transform):
         self.transform = transform
 
-    def __call__(self, img):
+    def __call__(self, img, varying=None):
         shape = img.shape
         if shape[0] == 3:
             img = self.transform(img)
         elif shape[0] == 1:
             pass
         else:
-            nonezero_layers = [i for i in range(shape[0]) if not (img[i] == img[i][0, 0]).all()]
-            # assert len(nonezero_layers) ==3
-            img = self.transform(img[nonezero_layers, :, :][:3])
+            # drops constant layers such as an opaque alpha channel
+            if varying is None:
+                varying = varying_channels(img)
+            img = select_channels(img, varying)
+            if img.shape[0] == 3:
+                img = self.transform(img)
         return img
 
 
-def sizeof_fmt(num: float, suffix="B"):
-    """by Fred Cirera,  https://stackoverflow.com/a/1094933/1870254, modified"""
-
-    for unit in ["", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"]:
-        if abs(num) < 1024.0:
-            return "%3.1f %s%s" % (num, unit, suffix)
-        num /= 1024.0
-    return "%.1f %s%s" % (num, "Yi", suffix)
-
-
-def sizetorch(value):
-    """function to return size of objects"""
-
-    try:
-        return sys.getsizeof(value.storage())
-    except:
-        return sys.getsizeof(value)
-
-
 def kornia_preprocess(pil_image: Image.Image) -> Image.Image:
     """This module performs preprocessing using Kornia and pytorch"""
 
@@ -123,125 +161,596 @@ def kornia_preprocess(pil_image: Image.Image) -> Image.Image:
     return tensor_to_pil
 
 
-def preprocess(
-    path: str,
-    plotsample: bool = config.PLOT_SAMPLE,
-    output_filepath: str = config.OUTPUT_FILEPATH,
-    maxperclass: int = config.MAX_PER_CLASS,
-) -> None:
-    """Performs preprocessing operations and transformations on the data"""
+gray_check = check_size_and_gray(torchvision.transforms.Grayscale(num_output_channels=1))
+
+rgb_to_gray = torchvision.transforms.Compose(
+    [
+        torchvision.transforms.ToTensor(),
+        # K.augmentation.RandomHorizontalFlip(p=0.5),
+        # K.colour.rgb_to_grayscale
+        gray_check,
+        # ,torchvision.transforms.Normalize(0,1)
+    ]
+)
+
+data_aug = torchvision.transforms.Compose(
+    [
+        K.augmentation.RandomHorizontalFlip(p=0.5),
+        K.augmentation.RandomSharpness(p=0.5),
+        K.augmentation.RandomGaussianNoise(p=0.2),
+        K.augmentation.RandomThinPlateSpline(p=0.2),
+    ]
+)
+
+
+def _list_directory(path: str) -> Dict[str, List[str]]:
+    """Returns the sorted file paths of every class folder below path"""
+
+    files = {}
+    for class_name in os.listdir(path):
+        path_ = path + "/" + class_name
+        if os.path.isdir(path_):
+            files[class_name] = [
+                path_ + "/" + name
+                for name in sorted(os.listdir(path_))
+                if not os.path.isdir(os.path.join(path_, name))
+            ]
+    return files
+
+
+def _list_zip(archive: str, root: str = config.FOLDERNAME) -> Dict[str, List[str]]:
+    """Returns the sorted member references of every class folder in a zip archive
+
+    Class folders are looked up below `root` (the folder extractall would create), below
+    the only top-level folder if there is just one, and at the top level otherwise.
+    """
+
+    with zipfile.ZipFile(archive) as z:
+        names = z.namelist()
+    prefix = root.strip("/") + "/"
+    if not any(name.startswith(prefix) for name in names):
+        top_level = {name.split("/", 1)[0] for name in names}
+        single_folder = len(top_level) == 1 and all("/" in name for name in names)
+        prefix = top_level.pop() + "/" if single_folder else ""
+
+    files: Dict[str, List[str]] = {}
+    for name in sorted(names):
+        parts = name[len(prefix) :].split("/") if name.startswith(prefix) else []
+        if len(parts) == 2 and parts[0]:
+            # direct children of a class folder; parts[1] is empty for the folder itself
+            members = files.setdefault(parts[0], [])
+            if parts[1]:
+                members.append(archive + ZIP_SEPARATOR + name)
+    return files
+
+
+def list_images(path: str, maxperclass: int = config.MAX_PER_CLASS) -> Tuple[List[str], List[int]]:
+    """Lists image references and labels of a raw dataset folder or zip archive
+
+    Classes are numbered in sorted order and files are taken in sorted order, so the
+    listing is the same on every machine and for the folder and its zip archive.
+    """
+
+    if os.path.isfile(path) and zipfile.is_zipfile(path):
+        files = _list_zip(path)
+    else:
+        files = _list_directory(path)
 
-    classes = [name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))]
-    classes = np.sort(classes)
-    class_map = {name: c for c, name in enumerate(classes)}
     img_paths = []
     labels = []
-    for class_name in class_map:
-        path_ = path + "/" + class_name
-        files_names = [
-            name for name in os.listdir(path_) if not os.path.isdir(os.path.join(path_, name))
-        ]
-        for count, file_name in enumerate(files_names):
+    for c, class_name in enumerate(sorted(files)):
+        for count, img_path in enumerate(files[class_name]):
             if count <= maxperclass:
-                img_paths.append(path_ + "/" + file_name)
-                labels.append(class_map[class_name])
+                img_paths.append(img_path)
+                labels.append(c)
+    return img_paths, labels
 
-        #     if len(labels)==200:
-        #         break
-        # if len(labels)==200:
-        #     break
 
-    all_images_gray512 = torch.empty([len(img_paths), 1, 512, 512])
+def _zip_handle(archive: str) -> zipfile.ZipFile:
+    """Returns an archive handle owned by the calling process and thread
+
+    ZipFile objects share one file position, so concurrent readers must not share them;
+    handles inherited through fork are not reused either.
+    """
+
+    handles = _ZIP_HANDLES.__dict__.setdefault("handles", {})
+    key = (os.getpid(), archive)
+    if key not in handles:
+        handles[key] = zipfile.ZipFile(archive)
+    return handles[key]
+
+
+def _read_image_bytes(img_path: str) -> bytes:
+    """Reads the encoded bytes of a file path or an archive member reference"""
+
+    if ZIP_SEPARATOR in img_path:
+        archive, member = img_path.split(ZIP_SEPARATOR, 1)
+        return _zip_handle(archive).read(member)
+    with open(img_path, "rb") as f:
+        return f.read()
+
+
+def _signature(img_path: str) -> Tuple:
+    """Returns a cheap fingerprint that changes whenever the image content may have"""
+
+    if ZIP_SEPARATOR in img_path:
+        archive, member = img_path.split(ZIP_SEPARATOR, 1)
+        info = _zip_handle(archive).getinfo(member)
+        return info.file_size, info.CRC
+    stat = os.stat(img_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _init_worker(trace_memory: bool = False) -> None:
+    """Keeps every pool worker on a single intra-op thread to avoid oversubscription"""
+
+    torch.set_num_threads(1)
+    if trace_memory:
+        tracemalloc.start()
+
+
+def preprocessing_params() -> Dict:
+    """Returns every setting that influences the per-image result, used as cache key"""
+
+    return {
+        "version": PIPELINE_VERSION,
+        "size": 512,
+        "mean": config.MEAN,
+        "std": config.STD,
+        "seed": config.SEED,
+        "augmentation": repr(data_aug),
+    }
+
+
+def _decode(data: bytes) -> Tuple[torch.Tensor, bool]:
+    """Decodes an encoded image once into a (C, H, W) float tensor in [0, 1]
+
+    Returns the tensor and whether the source had a 16 bit depth. 16 bit images are
+    scaled by their full range instead of being truncated to 8 bit first.
+    """
+
+    with Image.open(io.BytesIO(data)) as pil_image:
+        mode = pil_image.mode
+        if mode.startswith("I;16"):
+            # torch has no uint16, widen to 32 bit before the conversion
+            pil_image = pil_image.convert("I")
+        image = transforms.functional.pil_to_tensor(pil_image)
+    if image.dtype == torch.uint8:
+        return image.float().div(255), False
+    if mode in PIL_MODE_MAX:
+        return image.float().div(PIL_MODE_MAX[mode]).clamp_(0.0, 1.0), True
+    return image.float(), False
+
+
+def _quantize(images: torch.Tensor) -> torch.Tensor:
+    """Rounds to 8 bit exactly like a ToPILImage -> ToTensor round trip, without PIL"""
+
+    return images.mul(255).byte().float().div(255)
 
-    rgb_to_gray = torchvision.transforms.Compose(
-        [
-            torchvision.transforms.ToTensor(),
-            # K.augmentation.RandomHorizontalFlip(p=0.5),
-            # K.colour.rgb_to_grayscale
-            check_size_and_gray(torchvision.transforms.Grayscale(num_output_channels=1))
-            # ,torchvision.transforms.Normalize(0,1)
-        ]
-    )
 
-    data_aug = torchvision.transforms.Compose(
-        [
-            K.augmentation.RandomHorizontalFlip(p=0.5),
-            K.augmentation.RandomSharpness(p=0.5),
-            K.augmentation.RandomGaussianNoise(p=0.2),
-            K.augmentation.RandomThinPlateSpline(p=0.2),
-        ]
+def _channel_path(channels: int) -> str:
+    """Names the channel handling an image with this many channels goes through"""
+
+    return {1: "gray", 3: "rgb"}.get(channels, "multi")
+
+
+def _to_gray(images: torch.Tensor) -> List[torch.Tensor]:
+    """Converts a (N, C, H, W) batch to a list of (1, H, W) gray images"""
+
+    if images.shape[1] in (1, 3):
+        return list(transforms.functional.rgb_to_grayscale(images))
+    varying = varying_channels(images)
+    return [gray_check(image, mask) for image, mask in zip(images, varying)]
+
+
+def _transform_batch(
+    datas: List[bytes],
+    digests: List[str],
+    counts: Optional[Dict[str, int]] = None,
+    profiler: Optional[Profiler] = None,
+) -> List[np.ndarray]:
+    """Runs the per-image pipeline on a list of encoded images using tensors only
+
+    Every image is decoded once. Images of the same shape are stacked, so resize,
+    normalize, 8 bit rounding and grayscale conversion run vectorized over the group.
+    The augmentation stays per image and is seeded with the image content, so the
+    result does not depend on batching, on which worker picks the image up, or on where
+    the file sits in the listing. The output equals the PIL based kornia_preprocess ->
+    rgb_to_gray chain. counts, if given, is updated with the number of images per path.
+    """
+
+    profiler = profiler or Profiler()
+
+    decoded = []
+    with profiler.stage("decode", sum(len(data) for data in datas)):
+        for data in datas:
+            image, deep = _decode(data)
+            decoded.append(image)
+            if counts is not None:
+                path = _channel_path(image.shape[0])
+                counts[path] = counts.get(path, 0) + 1
+                if deep:
+                    counts["16bit"] = counts.get("16bit", 0) + 1
+    groups: Dict[Tuple[int, ...], List[int]] = {}
+    for position, image in enumerate(decoded):
+        groups.setdefault(tuple(image.shape), []).append(position)
+
+    gray: List[torch.Tensor] = [None] * len(decoded)
+    with profiler.stage("resize", sum(image.numel() * 4 for image in decoded)):
+        for members in groups.values():
+            batch = torch.stack([decoded[position] for position in members])
+            batch = K.geometry.transform.resize(batch, (512, 512), antialias=False)
+            batch = K.enhance.normalize(
+                batch, torch.Tensor([config.MEAN]), torch.Tensor([config.STD])
+            )
+            for position, image in zip(members, _to_gray(_quantize(batch))):
+                gray[position] = image
+    del decoded
+
+    outputs = []
+    with profiler.stage("augment", sum(image.numel() * 4 for image in gray)):
+        for image, digest in zip(gray, digests):
+            # kornia draws from the global RNG; fork it so seeding per image does not reset
+            # the caller's RNG when the pipeline runs in-process (workers=1)
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(config.SEED + int(digest[:12], 16))
+                augmented = data_aug(K.color.grayscale_to_rgb(image))
+            outputs.append(_to_gray(_quantize(augmented))[0].numpy())
+    return outputs
+
+
+def _preprocess_chunk(
+    tasks: List[Tuple[int, str, Optional[str], Optional[PreprocessCache]]]
+) -> Tuple[List[Tuple[int, np.ndarray, str, bool]], Dict[str, int], Dict, int, float]:
+    """Processes a chunk of (index, path, known digest, cache) tasks
+
+    Cached images are served from the cache, the remaining ones go through
+    _transform_batch together. Also returns the per-path counts of the decoded images
+    and the stage statistics of the chunk.
+    """
+
+    start = time.perf_counter()
+    profiler = Profiler()
+    results = []
+    missing = []
+    counts: Dict[str, int] = {}
+    for index, img_path, digest, cache in tasks:
+        data = None
+        if digest is None:
+            with profiler.stage("read") as stage:
+                data = _read_image_bytes(img_path)
+                digest = content_digest(data)
+                stage["bytes"] = len(data)
+        with profiler.stage("cache"):
+            image = cache.load(digest) if cache is not None else None
+        if image is None:
+            if data is None:
+                with profiler.stage("read") as stage:
+                    data = _read_image_bytes(img_path)
+                    stage["bytes"] = len(data)
+            missing.append((len(results), data))
+        results.append([index, image, digest, image is not None])
+
+    if missing:
+        digests = [results[position][2] for position, _ in missing]
+        images = _transform_batch([data for _, data in missing], digests, counts, profiler)
+        for (position, _), image in zip(missing, images):
+            results[position][1] = image
+            cache = tasks[position][3]
+            if cache is not None:
+                with profiler.stage("cache", image.nbytes):
+                    cache.store(results[position][2], image)
+
+    results = [tuple(result) for result in results]
+    return results, counts, profiler.snapshot(), os.getpid(), time.perf_counter() - start
+
+
+def _report_throughput(throughput: Dict[int, List[float]], wall_time: float) -> None:
+    """Prints images/sec for every worker and for the whole run"""
+
+    total = 0
+    for pid, (count, busy) in sorted(throughput.items()):
+        total += count
+        print(f"worker {pid}: {int(count)} images, {count / max(busy, 1e-9):.2f} images/sec")
+    print(f"total: {total} images, {total / max(wall_time, 1e-9):.2f} images/sec")
+
+
+def _ordered_imap(
+    pool: multiprocessing.pool.Pool, func: Callable, tasks: Iterable, window: int
+) -> Iterator:
+    """Like pool.imap, but with at most `window` tasks submitted and not yet consumed
+
+    pool.imap consumes the task iterator eagerly and queues results without bound when
+    the consumer is slower than the workers; here a new task is only submitted once the
+    oldest result has been taken.
+    """
+
+    pending: Deque[multiprocessing.pool.AsyncResult] = collections.deque()
+    tasks = iter(tasks)
+    for task in itertools.islice(tasks, window):
+        pending.append(pool.apply_async(func, (task,)))
+    while pending:
+        result = pending.popleft().get()
+        for task in itertools.islice(tasks, 1):
+            pending.append(pool.apply_async(func, (task,)))
+        yield result
+
+
+def _iter_preprocessed(
+    img_paths: List[str],
+    workers: int = 1,
+    cache_dir: Optional[str] = None,
+    batch_size: int = config.DECODE_BATCH,
+    profiler: Optional[Profiler] = None,
+) -> Iterator[Tuple[int, torch.Tensor]]:
+    """Yields (index, image) for every path in the original index order
+
+    Images are processed in chunks of batch_size. With workers > 1 the chunks are
+    processed by a process pool with at most 2 * workers chunks in flight, so memory stays
+    flat even when the consumer is slower than the workers. Results are handed back in
+    submission order, so the consumer sees the same sequence as in the serial case. With a
+    cache_dir only new or changed images are decoded, the rest is read from cache. The stage
+    statistics of the workers are merged into profiler.
+    """
+
+    profiler = profiler or Profiler()
+
+    cache = manifest = None
+    if cache_dir:
+        cache = PreprocessCache(cache_dir, preprocessing_params())
+        manifest = FileManifest(cache_dir)
+        print(f"[INFO] Caching preprocessed images in {cache.directory}, about 1 MiB each")
+
+    def chunks() -> Iterator[List[Tuple[int, str, Optional[str], Optional[PreprocessCache]]]]:
+        """Groups the tasks into fixed-size chunks"""
+
+        for offset in range(0, len(img_paths), batch_size):
+            chunk = []
+            for index in range(offset, min(offset + batch_size, len(img_paths))):
+                img_path = img_paths[index]
+                digest = None
+                if manifest is not None:
+                    digest = manifest.lookup(os.path.abspath(img_path), _signature(img_path))
+                chunk.append((index, img_path, digest, cache))
+            yield chunk
+
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(
+            workers, initializer=_init_worker, initargs=(profiler.trace_memory,)
+        )
+        results = _ordered_imap(pool, _preprocess_chunk, chunks(), 2 * workers)
+    else:
+        results = map(_preprocess_chunk, chunks())
+
+    throughput: Dict[int, List[float]] = {}
+    counts: Dict[str, int] = {}
+    hits = 0
+    start = time.perf_counter()
+    try:
+        with tqdm(total=len(img_paths)) as progress:
+            for chunk_results, chunk_counts, chunk_stats, pid, elapsed in results:
+                profiler.merge(chunk_stats)
+                for path, count in chunk_counts.items():
+                    counts[path] = counts.get(path, 0) + count
+                stats = throughput.setdefault(pid, [0, 0.0])
+                stats[0] += len(chunk_results)
+                stats[1] += elapsed
+                progress.update(len(chunk_results))
+                for index, image, digest, hit in chunk_results:
+                    hits += hit
+                    if manifest is not None:
+                        img_path = img_paths[index]
+                        manifest.remember(os.path.abspath(img_path), _signature(img_path), digest)
+                    yield index, torch.from_numpy(image)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if manifest is not None:
+            manifest.save()
+
+    _report_throughput(throughput, time.perf_counter() - start)
+    if cache is not None:
+        print(f"cache: {hits} hits, {len(img_paths) - hits} images processed")
+    print(
+        "channel paths: "
+        + ", ".join(f"{path} {counts.get(path, 0)}" for path in ["rgb", "gray", "multi", "16bit"])
     )
 
-    for c, i in enumerate(tqdm(img_paths)):
-        tensor_to_pil = kornia_preprocess(i)
-        img_gray512 = rgb_to_gray(tensor_to_pil)
-        test1 = K.color.grayscale_to_rgb(img_gray512)
-        transf1 = data_aug(test1)
-        tensor_to_pil = transforms.ToPILImage()(transf1.squeeze_(0))
-        back1 = rgb_to_gray(tensor_to_pil)
-        all_images_gray512[c, :, :, :] = back1
 
-    if plotsample:
-        figpath = config.FIG_PATH
-        if not os.path.isdir(figpath):
-            os.makedirs(figpath)
-        for number in range(5):
-            samples = all_images_gray512[np.random.randint(0, len(all_images_gray512), 25), :, :]
-            grid_img = torchvision.utils.make_grid(samples, nrow=int(5))
-
-            plt.figure()
-            plt.imshow(grid_img.permute(1, 2, 0))
-            plt.savefig(figpath + "/" + "sample" + str(number) + ".png")
-            del samples
-
-    validation_split = config.VALIDATION_SPLIT
-    seed = config.SEED
+def plot_samples(images: Union[torch.Tensor, np.ndarray], figpath: str = config.FIG_PATH) -> None:
+    """Saves five grids of 25 randomly drawn images"""
+
+    if not os.path.isdir(figpath):
+        os.makedirs(figpath)
+    for number in range(5):
+        samples = torch.as_tensor(np.asarray(images[np.random.randint(0, len(images), 25)]))
+        grid_img = torchvision.utils.make_grid(samples, nrow=int(5))
+
+        plt.figure()
+        plt.imshow(grid_img.permute(1, 2, 0))
+        plt.savefig(figpath + "/" + "sample" + str(number) + ".png")
+        del samples
+
+
+def split_indices(labels: List[int]) -> Dict[str, List[int]]:
+    """Computes the stratified train/test/valid split from the labels alone"""
+
     train_indices, test_indices, _, _ = train_test_split(
-        range(len(all_images_gray512)),
+        range(len(labels)),
         labels,
         stratify=labels,
-        test_size=validation_split,
-        random_state=seed,
+        test_size=config.VALIDATION_SPLIT,
+        random_state=config.SEED,
     )
 
     len2test = int(len(test_indices) / 2)
-    valid_indices = test_indices[len2test:]
-    test_indices = test_indices[:len2test]
+    return {
+        "train": train_indices,
+        "test": test_indices[:len2test],
+        "valid": test_indices[len2test:],
+    }
+
+
+def preprocess_streaming(
+    img_paths: List[str],
+    labels: List[int],
+    output_filepath: str,
+    workers: int = 1,
+    plotsample: bool = False,
+    output_format: str = "pt",
+    shard_dtype: str = config.SHARD_DTYPE,
+    shard_size: int = config.SHARD_SIZE,
+    cache_dir: Optional[str] = config.CACHE_DIR,
+    batch_size: int = config.DECODE_BATCH,
+    resolutions: List[int] = config.RESOLUTIONS,
+    flush_every: int = 256,
+    profiler: Optional[Profiler] = None,
+) -> None:
+    """Writes every processed image directly into a preallocated memory-mapped file per split
+
+    The split is computed from the labels before any image is decoded, so only the image
+    currently being written is held in memory, no matter how large the dataset is.
+    With output_format "shards" every split becomes a folder of fixed-size shards (see
+    src/data/shards.py), otherwise a single float32 <split>_images.npy file.
+    Every extra resolution is downsampled from the same decoded image and written next to
+    it, see src/data/pyramid.py for the naming.
+    """
 
-    train_images = all_images_gray512[train_indices].float().clone()
-    test_images = all_images_gray512[test_indices].float().clone()
-    valid_images = all_images_gray512[valid_indices].float().clone()
+    profiler = profiler or Profiler()
+    if not os.path.isdir(output_filepath):
+        os.makedirs(output_filepath)
 
-    train_labels = np.array(labels)[train_indices]
-    test_labels = np.array(labels)[test_indices]
-    valid_labels = np.array(labels)[valid_indices]
+    sizes = [BASE_RESOLUTION] + [int(size) for size in resolutions if size != BASE_RESOLUTION]
+    with profiler.stage("split"):
+        splits = split_indices(labels)
+    writers = {}
+    position = {}
+    for split, indices in splits.items():
+        split_labels = np.array(labels, dtype=np.int64)[indices]
+        for size in sizes:
+            if output_format == "shards":
+                writers[split, size] = ShardWriter(
+                    resolution_path(output_filepath + split, size),
+                    split_labels,
+                    shape=(1, size, size),
+                    dtype=shard_dtype,
+                    shard_size=shard_size,
+                )
+            else:
+                writers[split, size] = np.lib.format.open_memmap(
+                    resolution_path(output_filepath + split + "_images.npy", size),
+                    mode="w+",
+                    dtype=np.float32,
+                    shape=(len(indices), 1, size, size),
+                )
+        if output_format != "shards":
+            torch.save(torch.from_numpy(split_labels), output_filepath + split + "_labels.pt")
+        position.update({index: (split, pos) for pos, index in enumerate(indices)})
+
+    for c, image in _iter_preprocessed(img_paths, workers, cache_dir, batch_size, profiler):
+        split, pos = position[c]
+        with profiler.stage("save") as stage:
+            for size in sizes:
+                resized = downsample(image, size).numpy()
+                writers[split, size][pos] = resized
+                stage["bytes"] += resized.nbytes
+                if (c + 1) % flush_every == 0:
+                    # written pages become clean and can be dropped by the kernel under pressure
+                    writers[split, size].flush()
+
+    with profiler.stage("save"):
+        for writer in writers.values():
+            writer.flush()
 
-    for name, size in sorted(
-        ((name, sizetorch(value)) for name, value in locals().items()), key=lambda x: -x[1]
-    )[:10]:
-        print("{:>30}: {:>8}".format(name, sizeof_fmt(size)))
+    if plotsample:
+        if output_format == "shards":
+            plot_samples(ShardedArray(output_filepath + "train"))
+        else:
+            plot_samples(writers["train", BASE_RESOLUTION])
 
-    if not os.path.isdir(output_filepath):
-        os.makedirs(output_filepath)
 
-    print("break before")
-    torch.save(train_images, output_filepath + "train_images.pt")
-    del train_images
-    print("break after train")
-    torch.save(torch.from_numpy(train_labels), output_filepath + "train_labels.pt")
-    del train_labels
+def preprocess(
+    path: str,
+    plotsample: bool = config.PLOT_SAMPLE,
+    output_filepath: str = config.OUTPUT_FILEPATH,
+    maxperclass: int = config.MAX_PER_CLASS,
+    workers: int = config.WORKERS,
+    stream: bool = config.STREAM,
+    output_format: str = config.OUTPUT_FORMAT,
+    cache_dir: Optional[str] = config.CACHE_DIR,
+    batch_size: int = config.DECODE_BATCH,
+    resolutions: List[int] = config.RESOLUTIONS,
+    profiler: Optional[Profiler] = None,
+) -> None:
+    """Performs preprocessing operations and transformations on the data
+
+    path : raw dataset folder with one subfolder per class, or the downloaded zip archive
+    workers : number of processes used for the per-image pipeline, 1 runs it in-process
+    stream : write every image straight into per-split memory-mapped .npy files
+    output_format : "pt" for monolithic float32 tensors, "shards" for compact sharded splits
+    cache_dir : folder of the per-image preprocessing cache, None or "" disables it
+    batch_size : number of images decoded and transformed together per worker task
+    resolutions : extra side lengths the splits are also written at, next to 512
+    profiler : collects per-stage timings and peak memory, see src/data/profiling.py
+    """
+
+    profiler = profiler or Profiler()
+    with profiler.stage("list"):
+        img_paths, labels = list_images(path, maxperclass)
+
+    if stream or output_format == "shards":
+        preprocess_streaming(
+            img_paths,
+            labels,
+            output_filepath,
+            workers,
+            plotsample,
+            output_format=output_format,
+            cache_dir=cache_dir,
+            batch_size=batch_size,
+            resolutions=resolutions,
+            profiler=profiler,
+        )
+        profiler.print_summary()
+        return
 
-    torch.save(test_images, output_filepath + "test_images.pt")
-    del test_images
-    torch.save(torch.from_numpy(test_labels), output_filepath + "test_labels.pt")
-    del test_labels
+    all_images_gray512 = torch.empty([len(img_paths), 1, 512, 512])
 
-    torch.save(valid_images, output_filepath + "valid_images.pt")
-    del valid_images
-    torch.save(torch.from_numpy(valid_labels), output_filepath + "valid_labels.pt")
-    del valid_labels
+    for c, image in _iter_preprocessed(img_paths, workers, cache_dir, batch_size, profiler):
+        all_images_gray512[c, :, :, :] = image
+
+    if plotsample:
+        plot_samples(all_images_gray512)
+
+    with profiler.stage("split"):
+        splits = split_indices(labels)
+
+    if not os.path.isdir(output_filepath):
+        os.makedirs(output_filepath)
+
+    with profiler.stage("save") as stage:
+        for split, indices in splits.items():
+            # one split at a time, so at most one split is copied next to the full tensor
+            images = all_images_gray512[indices].float().clone()
+            torch.save(images, output_filepath + split + "_images.pt")
+            torch.save(
+                torch.from_numpy(np.array(labels)[indices]), output_filepath + split + "_labels.pt"
+            )
+            stage["bytes"] += images.numel() * images.element_size()
+            del images
+
+            for size in resolutions:
+                if size == BASE_RESOLUTION:
+                    continue
+                images = downsample(all_images_gray512[indices], size)
+                torch.save(images, resolution_path(output_filepath + split + "_images.pt", size))
+                stage["bytes"] += images.numel() * images.element_size()
+                del images
 
     del all_images_gray512
+    profiler.print_summary()
 
 
 def main():
@@ -271,6 +780,44 @@ def main():
     )
     parser.add_argument("--maxperclass", type=int, default=200, help="maximum imgs per class")
     parser.add_argument("-plotsample", action="store_true")
+    parser.add_argument(
+        "--workers", type=int, default=config.WORKERS, help="number of preprocessing processes"
+    )
+    parser.add_argument(
+        "--batch", type=int, default=config.DECODE_BATCH, help="images transformed per task"
+    )
+    parser.add_argument(
+        "--resolutions",
+        type=int,
+        nargs="*",
+        default=list(config.RESOLUTIONS),
+        help="extra side lengths written next to the 512x512 splits",
+    )
+    parser.add_argument(
+        "--stream", action="store_true", help="write splits to memory-mapped .npy files"
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        default=config.OUTPUT_FORMAT,
+        choices=["pt", "shards"],
+        help="on-disk format of the preprocessed splits",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=config.CACHE_DIR or None,
+        help="per-image preprocessing cache, about 1 MiB per image",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="reprocess every image, bypassing the cache"
+    )
+    parser.add_argument(
+        "--trace-memory", action="store_true", help="track peak Python allocations per stage"
+    )
+    parser.add_argument(
+        "--from-zip", action="store_true", help="decode images from the zip instead of extracting"
+    )
     args = parser.parse_args()
     zip_file_url = args.url
     PATH = args.PATH
@@ -279,10 +826,27 @@ def main():
     maxperclass = args.maxperclass
     plotsample = config.PLOT_SAMPLE
 
-    download_extract(zip_file_url, PATH, filename, foldername)
-    path = config.RAW_DATA
+    profiler = Profiler(trace_memory=args.trace_memory or config.TRACE_MEMORY)
+    from_zip = args.from_zip or not config.EXTRACT
+    download_extract(
+        zip_file_url, PATH, filename, foldername, extract=not from_zip, profiler=profiler
+    )
+    path = os.path.join(PATH, filename) if from_zip else config.RAW_DATA
     print("plotsample:", plotsample)
-    preprocess(path, plotsample=plotsample, maxperclass=maxperclass)
+    preprocess(
+        path,
+        plotsample=plotsample,
+        maxperclass=maxperclass,
+        workers=args.workers,
+        stream=args.stream or config.STREAM,
+        output_format=args.format,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        batch_size=args.batch,
+        resolutions=args.resolutions,
+        profiler=profiler,
+    )
+    report = profiler.write_report(config.PROFILE_DIR, dict(vars(args), **preprocessing_params()))
+    print(f"[INFO] Profiling report written to {report}")
 
     logger = logging.getLogger(__name__)
 
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module contains the per-stage instrumentation of the data pipeline
+######################################################################
+
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_rss() -> int:
+    """Returns the peak resident set size of this process in bytes, 0 if unknown"""
+
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _high_water_mark() -> Optional[int]:
+    """Returns VmHWM of /proc/self/status in bytes, None where it does not exist"""
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss() -> bool:
+    """Resets VmHWM to the current RSS (Linux), returns False where that is not possible
+
+    ru_maxrss, and so peak_rss, is not affected and stays the peak of the whole process.
+    """
+
+    if _high_water_mark() is None:
+        return False
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def _empty_stage() -> Dict:
+    return {"calls": 0, "wall": 0.0, "cpu": 0.0, "bytes": 0, "peak_rss": 0, "peak_traced": 0}
+
+
+class Profiler(object):
+    """Accumulates wall time, CPU time, bytes and peak memory per named stage
+
+    The statistics are plain dicts, so workers can send theirs back to the parent, which
+    merges them. Tracing allocations with tracemalloc is opt-in because it slows Python
+    code down considerably; by default it is used only if tracing was already started.
+
+    "peak_rss" is the peak RSS while the stage ran where the high-water mark can be reset
+    (Linux, rss_scope "stage"). Elsewhere it is the process peak up to the end of the
+    stage (rss_scope "process"), which later stages inherit from earlier heavy ones.
+    """
+
+    def __init__(self, trace_memory: Optional[bool] = None) -> None:
+        if trace_memory is None:
+            trace_memory = tracemalloc.is_tracing()
+        elif trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.trace_memory = trace_memory
+        self.stages: Dict[str, Dict] = {}
+        self.workers: Dict[str, int] = {}
+        self.rss_scope = "stage" if reset_peak_rss() else "process"
+        # [traced peak, rss peak] of the open stages, innermost last
+        self._open: List[List[int]] = []
+
+    @contextmanager
+    def stage(self, name: str, nbytes: int = 0) -> Iterator[Dict]:
+        """Measures the enclosed block, the yielded dict's "bytes" can be raised inside it"""
+
+        stats = self.stages.setdefault(name, _empty_stage())
+        extra = {"bytes": nbytes}
+        frame = [0, 0]
+        # the peaks are reset per stage, enclosing stages get the inner peaks on exit
+        if self.trace_memory:
+            if self._open:
+                self._open[-1][0] = max(self._open[-1][0], tracemalloc.get_traced_memory()[1])
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            frame[0] = tracemalloc.get_traced_memory()[1]
+        if self.rss_scope == "stage":
+            if self._open:
+                self._open[-1][1] = max(self._open[-1][1], _high_water_mark() or 0)
+            reset_peak_rss()
+            frame[1] = _high_water_mark() or 0
+        self._open.append(frame)
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield extra
+        finally:
+            stats["calls"] += 1
+            stats["wall"] += time.perf_counter() - wall
+            stats["cpu"] += time.process_time() - cpu
+            stats["bytes"] += int(extra["bytes"])
+            self._open.pop()
+            if self.rss_scope == "stage":
+                rss = max(frame[1], _high_water_mark() or 0)
+                if self._open:
+                    self._open[-1][1] = max(self._open[-1][1], rss)
+            else:
+                rss = peak_rss()
+            stats["peak_rss"] = max(stats["peak_rss"], rss)
+            if self.trace_memory:
+                peak = max(frame[0], tracemalloc.get_traced_memory()[1])
+                stats["peak_traced"] = max(stats["peak_traced"], peak)
+                if self._open:
+                    self._open[-1][0] = max(self._open[-1][0], peak)
+
+    def snapshot(self) -> Dict:
+        """Returns the statistics of this process, ready to be sent to another process"""
+
+        self.workers[str(os.getpid())] = max(self.workers.get(str(os.getpid()), 0), peak_rss())
+        return {"stages": self.stages, "workers": self.workers}
+
+    def merge(self, snapshot: Dict) -> None:
+        """Adds the statistics of another process"""
+
+        for name, other in snapshot["stages"].items():
+            stats = self.stages.setdefault(name, _empty_stage())
+            for key in ["calls", "wall", "cpu", "bytes"]:
+                stats[key] += other[key]
+            for key in ["peak_rss", "peak_traced"]:
+                stats[key] = max(stats[key], other[key])
+        for pid, peak in snapshot["workers"].items():
+            self.workers[pid] = max(self.workers.get(pid, 0), peak)
+
+    def report(self, params: Optional[Dict] = None) -> Dict:
+        """Returns the run report with throughput per stage"""
+
+        stages = {}
+        for name, stats in self.stages.items():
+            stages[name] = dict(stats)
+            stages[name]["mb_per_sec"] = stats["bytes"] / 2**20 / max(stats["wall"], 1e-9)
+        self.snapshot()
+        return {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "trace_memory": self.trace_memory,
+            "rss_scope": self.rss_scope,
+            "params": params or {},
+            "stages": stages,
+            "peak_rss_per_process": self.workers,
+        }
+
+    def print_summary(self) -> None:
+        """Prints one line per stage"""
+
+        header = ["stage", "calls", "wall s", "cpu s", "MiB", "rss MiB", "traced MiB"]
+        print(" ".join(f"{column:>10}" for column in header))
+        for name, stats in self.stages.items():
+            print(
+                f"{name:>10} {stats['calls']:>10} {stats['wall']:>10.2f} {stats['cpu']:>10.2f}"
+                f" {stats['bytes'] / 2 ** 20:>10.1f} {stats['peak_rss'] / 2 ** 20:>10.1f}"
+                f" {stats['peak_traced'] / 2 ** 20:>10.1f}"
+            )
+
+    def write_report(self, directory: str, params: Optional[Dict] = None) -> str:
+        """Writes the run report as JSON into directory and returns its path"""
+
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, time.strftime("preprocess_%Y%m%dT%H%M%S.json"))
+        with open(path, "w") as f:
+            json.dump(self.report(params), f, indent=2, default=str)
+        return path
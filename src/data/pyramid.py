@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module contains the helpers for the multi-resolution outputs
+######################################################################
+
+import os
+from typing import Union
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# side length the preprocessing pipeline produces, the other resolutions are derived from it
+BASE_RESOLUTION = 512
+
+
+def resolution_path(path: str, resolution: int = BASE_RESOLUTION) -> str:
+    """Returns where the copy of a split at the given resolution is stored
+
+    The base resolution keeps the original name, other resolutions get a suffix, e.g.
+    train_images.pt -> train_images_256.pt and train/ -> train_256/.
+    """
+
+    if int(resolution) == BASE_RESOLUTION:
+        return path
+    root, ext = os.path.splitext(path.rstrip("/"))
+    return f"{root}_{int(resolution)}{ext}"
+
+
+def downsample(images: Union[torch.Tensor, np.ndarray], resolution: int) -> torch.Tensor:
+    """Area-downsamples (C, H, W) images or (N, C, H, W) batches to resolution x resolution"""
+
+    images = torch.as_tensor(images)
+    if images.shape[-1] == resolution and images.shape[-2] == resolution:
+        return images
+    batch = images if images.dim() == 4 else images.unsqueeze(0)
+    batch = F.interpolate(batch.float(), size=(resolution, resolution), mode="area")
+    return batch if images.dim() == 4 else batch.squeeze(0)
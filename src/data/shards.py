@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module contains the sharded on-disk dataset format
+######################################################################
+
+import argparse
+import hashlib
+import json
+import os
+from typing import Dict, List, Sequence, Union
+
+import numpy as np
+import torch
+
+from src.data.hashing import sha256sum
+
+INDEX_FILE = "index.json"
+FORMAT_VERSION = 1
+
+# value the stored samples are divided by to get back to [0, 1] floats
+SCALES = {"uint8": 255.0, "float16": 1.0}
+
+
+def is_sharded(path: str) -> bool:
+    """Returns True if path is a directory holding a sharded dataset"""
+
+    return os.path.isfile(os.path.join(path, INDEX_FILE))
+
+
+def file_digest(PATH_IMG: str) -> str:
+    """Returns the SHA-256 of an images file, or of the index and shards of a sharded split"""
+
+    if not is_sharded(PATH_IMG):
+        return sha256sum(PATH_IMG)
+    digest = hashlib.sha256()
+    for filename in sorted(os.listdir(PATH_IMG)):
+        if filename.endswith(".npy") or filename == INDEX_FILE:
+            digest.update(filename.encode())
+            digest.update(sha256sum(os.path.join(PATH_IMG, filename)).encode())
+    return digest.hexdigest()
+
+
+def file_signature(PATH_IMG: str) -> List:
+    """Returns (name, size, mtime) of an images file or of the files of a sharded split
+
+    Cheap to compute, it tells whether file_digest has to be recomputed.
+    """
+
+    if not is_sharded(PATH_IMG):
+        stat = os.stat(PATH_IMG)
+        return [[os.path.basename(PATH_IMG), stat.st_size, stat.st_mtime_ns]]
+    signature = []
+    for filename in sorted(os.listdir(PATH_IMG)):
+        if filename.endswith(".npy") or filename == INDEX_FILE:
+            stat = os.stat(os.path.join(PATH_IMG, filename))
+            signature.append([filename, stat.st_size, stat.st_mtime_ns])
+    return signature
+
+
+def encode_images(images: Union[torch.Tensor, np.ndarray], dtype: str) -> np.ndarray:
+    """Converts [0, 1] float images to the storage dtype"""
+
+    images = np.asarray(images, dtype=np.float32)
+    if dtype == "uint8":
+        # the pipeline output is 8 bit per channel, rounding costs at most half a grey level
+        return np.rint(np.clip(images, 0.0, 1.0) * 255.0).astype(np.uint8)
+    return images.astype(dtype)
+
+
+def decode_images(images: torch.Tensor, scale: float = 255.0) -> torch.Tensor:
+    """Converts a stored batch back to float32, meant to run once per batch"""
+
+    images = images.float()
+    if scale != 1.0:
+        images = images.div_(scale)
+    return images
+
+
+class ShardWriter(object):
+    """Preallocates fixed-size .npy shards for a split and fills them by position"""
+
+    def __init__(
+        self,
+        directory: str,
+        labels: Sequence[int],
+        shape: Sequence[int] = (1, 512, 512),
+        dtype: str = "uint8",
+        shard_size: int = 1024,
+    ) -> None:
+        if dtype not in SCALES:
+            raise ValueError(f"Unsupported shard dtype {dtype}, use one of {list(SCALES)}")
+
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.dtype = dtype
+        self.shard_size = shard_size
+        self.labels = [int(label) for label in labels]
+        self.shape = [int(dim) for dim in shape]
+        self.shards: List[Dict] = []
+        self._arrays = []
+
+        for number, offset in enumerate(range(0, len(self.labels), shard_size)):
+            count = min(shard_size, len(self.labels) - offset)
+            filename = f"shard_{number:05d}.npy"
+            self._arrays.append(
+                np.lib.format.open_memmap(
+                    os.path.join(directory, filename),
+                    mode="w+",
+                    dtype=dtype,
+                    shape=tuple([count] + self.shape),
+                )
+            )
+            self.shards.append({"file": filename, "offset": offset, "count": count})
+
+    def __setitem__(self, position: int, image: Union[torch.Tensor, np.ndarray]) -> None:
+        shard = self._arrays[position // self.shard_size]
+        shard[position % self.shard_size] = encode_images(image, self.dtype).reshape(self.shape)
+
+    def write_encoded(self, start: int, images: np.ndarray) -> None:
+        """Writes a block of samples that are already in the storage dtype from start on"""
+
+        for offset, image in enumerate(images):
+            position = start + offset
+            shard = self._arrays[position // self.shard_size]
+            shard[position % self.shard_size] = image.reshape(self.shape)
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def flush(self) -> None:
+        """Flushes the shards to disk and (re)writes the index"""
+
+        for array in self._arrays:
+            array.flush()
+
+        index = {
+            "version": FORMAT_VERSION,
+            "dtype": self.dtype,
+            "scale": SCALES[self.dtype],
+            "shape": self.shape,
+            "num_samples": len(self.labels),
+            "shard_size": self.shard_size,
+            "shards": self.shards,
+            "labels": self.labels,
+        }
+        with open(os.path.join(self.directory, INDEX_FILE), "w") as f:
+            json.dump(index, f)
+
+
+class ShardedArray(object):
+    """Read-only, array-like view of a sharded split
+
+    Shards are memory-mapped on first access, so opening is cheap and the object can be
+    handed to DataLoader workers; each worker maps the files itself.
+    """
+
+    def __init__(self, directory: str) -> None:
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            index = json.load(f)
+        if index["version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported shard format version {index['version']}")
+
+        self.directory = directory
+        self.dtype = index["dtype"]
+        self.scale = float(index["scale"])
+        self.shape = tuple(index["shape"])
+        self.shard_size = int(index["shard_size"])
+        self.shards = index["shards"]
+        self.labels = np.asarray(index["labels"], dtype=np.int64)
+        self._arrays: Dict[int, np.ndarray] = {}
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        state["_arrays"] = {}
+        return state
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def shard(self, number: int) -> np.ndarray:
+        """Returns the memory-mapped array of one shard"""
+
+        if number not in self._arrays:
+            path = os.path.join(self.directory, self.shards[number]["file"])
+            self._arrays[number] = np.load(path, mmap_mode="r")
+        return self._arrays[number]
+
+    def __getitem__(self, idx: Union[int, slice, Sequence[int], np.ndarray]) -> np.ndarray:
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            if not 0 <= idx < len(self):
+                raise IndexError(f"index {idx} is out of bounds for size {len(self)}")
+            return self.shard(idx // self.shard_size)[idx % self.shard_size]
+
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step == 1:
+                parts = []
+                while start < stop:
+                    number, offset = divmod(start, self.shard_size)
+                    count = min(stop - start, self.shards[number]["count"] - offset)
+                    parts.append(self.shard(number)[offset : offset + count])
+                    start += count
+                if parts:
+                    return np.concatenate(parts)
+            idx = np.arange(start, stop, step)
+
+        idx = np.asarray(idx)
+        if len(idx) == 0:
+            return np.empty((0,) + self.shape, dtype=self.dtype)
+        return np.stack([self[int(i)] for i in idx])
+
+    def decode(self, images: torch.Tensor) -> torch.Tensor:
+        """Converts a batch of stored samples to float32"""
+
+        return decode_images(images, self.scale)
+
+
+def convert_split(
+    images_path: str,
+    labels_path: str,
+    directory: str,
+    dtype: str = "uint8",
+    shard_size: int = 1024,
+) -> None:
+    """Converts a monolithic images/labels .pt pair into the sharded format"""
+
+    images = torch.load(images_path)
+    labels = torch.load(labels_path)
+    writer = ShardWriter(directory, labels.tolist(), images.shape[1:], dtype, shard_size)
+    for position in range(len(images)):
+        writer[position] = images[position]
+    writer.flush()
+
+
+def main() -> None:
+    """Converts the .pt splits of a preprocessed folder into sharded splits"""
+
+    parser = argparse.ArgumentParser(description="Convert preprocessed .pt splits to shards")
+    parser.add_argument("folder", type=str, help="folder holding <split>_images.pt files")
+    parser.add_argument("--dtype", type=str, default="uint8", choices=list(SCALES))
+    parser.add_argument("--shard-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    for split in ["train", "test", "valid"]:
+        images_path = os.path.join(args.folder, split + "_images.pt")
+        if not os.path.isfile(images_path):
+            continue
+        print(f"[INFO] Converting {images_path}...")
+        convert_split(
+            images_path,
+            os.path.join(args.folder, split + "_labels.pt"),
+            os.path.join(args.folder, split),
+            args.dtype,
+            args.shard_size,
+        )
+
+
+if __name__ == "__main__":
+
+    main()
@@ -1,11 +1,23 @@
 from google.cloud import storage
-import torch
-from torch import nn
 import omegaconf
 from omegaconf import OmegaConf
 import io
+import json
 import functions_framework
 import numpy as np
+from inference_backend import OnnxBackend, TorchBackend
+
+# only the torch backends need torch, the onnx backend runs on onnxruntime alone
+try:
+    import torch
+except ImportError:
+    torch = None
+
+
+def downloadFromGCP(config, MODEL_FILE):
+    client = storage.Client()
+    bucket = client.get_bucket(config.BUCKET_NAME)
+    return bucket.get_blob(MODEL_FILE).download_as_string()
 
 
 def loadCheckpointFromGCP(config):
@@ -19,21 +31,52 @@ def loadCheckpointFromGCP(config):
     return checkpoint
 
 
+def loadScriptedModelFromGCP(config):
+    """Returns the TorchScript artifact of src/models/export_model.py and its metadata"""
+
+    extra_files = {"metadata.json": ""}
+    model = torch.jit.load(
+        io.BytesIO(downloadFromGCP(config, config.BUCKET_SCRIPTED_MODEL)),
+        map_location="cpu",
+        _extra_files=extra_files,
+    )
+    # conv+relu fusion and weight prepacking for this machine, cannot be stored in the file
+    model = torch.jit.optimize_for_inference(model)
+    return model, json.loads(extra_files["metadata.json"])
+
+
+def load_backend(config):
+    """Returns the inference backend of the configured model
+
+    BUCKET_ONNX_MODEL (export_model.py --format onnx) runs on onnxruntime,
+    BUCKET_SCRIPTED_MODEL and BUCKET_BEST_MODEL on torch.
+    """
+
+    if config.get("BUCKET_ONNX_MODEL"):
+        return OnnxBackend(downloadFromGCP(config, config.BUCKET_ONNX_MODEL))
+    if config.BUCKET_SCRIPTED_MODEL:
+        # frozen, fused model that runs without the Python model code
+        return TorchBackend(*loadScriptedModelFromGCP(config))
+    return TorchBackend(get_model_from_checkpoint(config))
+
+
 def get_model_from_checkpoint(
     config: omegaconf.dictconfig.DictConfig, cloudModel: bool = True
-) -> nn.Module:
+) -> "torch.nn.Module":
     """Returns a loaded model from checkpoint"""
 
-    from model_architecture import XrayClassifier
+    from model_architecture import model_from_checkpoint
 
-    model = XrayClassifier()
     if cloudModel:
         print("[INFO] Load model from cloud...")
         checkpoint = loadCheckpointFromGCP(config)
     else:
         print("[INFO] Load model from disk...")
         checkpoint = torch.load(config.BEST_MODEL_PATH)
-    model.load_state_dict(checkpoint["model_state_dict"])
+    # rebuilt from the architecture spec stored in the checkpoint
+    model = model_from_checkpoint(checkpoint)
+    # inference only: batch norm statistics and no dropout
+    model.eval()
     return model
 
 
@@ -43,19 +86,29 @@ def predict_covid(request):
 
     request_json = request.get_json()  # json.loads(request)
     if request_json and "input_data" in request_json:
-        if "model-id" in request_json:
-            config.BUCKET_BEST_MODEL = request_json["model-id"]
+        # the most specific model given in the request wins
+        for key, field in [
+            ("model-id", "BUCKET_BEST_MODEL"),
+            ("scripted-model-id", "BUCKET_SCRIPTED_MODEL"),
+            ("onnx-model-id", "BUCKET_ONNX_MODEL"),
+        ]:
+            if key in request_json:
+                config.BUCKET_SCRIPTED_MODEL = ""
+                config.BUCKET_ONNX_MODEL = ""
+                config[field] = request_json[key]
 
-        data = torch.tensor(request_json["input_data"])
+        data = np.asarray(request_json["input_data"], dtype=np.float32)
 
-        if not data.shape[-2:] == torch.Size([512, 512]):
-            return "Wrong size of image, should be 512x512"
-        data = data.view(-1, 1, 512, 512)
+        backend = load_backend(config)
+        size, head = backend.metadata["input_size"], backend.metadata["head"]
 
-        model = get_model_from_checkpoint(config)
-        prediction = model(data).data
+        # pooled heads accept any image size, the flatten head only its training size
+        if head == "flatten" and not data.shape[-2:] == (size, size):
+            return f"Wrong size of image, should be {size}x{size}"
+        data = data.reshape(-1, 1, *data.shape[-2:])
+        prediction = backend(data)
         diagnosis = ["Covid", "Normal", "Pneumonia"]
 
-        return f"Diagnosis: {diagnosis[np.argmax(prediction.numpy())]}"
+        return f"Diagnosis: {diagnosis[np.argmax(prediction)]}"
     else:
         return "No input data received"
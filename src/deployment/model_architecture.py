@@ -9,57 +9,270 @@
 # Semester:    Spring 2022
 # Institution:  Technical University of Denmark (DTU)
 #
-# Module: This module contains the <PLACEHOLDER> model architecture
+# Module: This module contains the configurable XrayClassifier model architecture
+#         (src/deployment/model_architecture.py is an identical copy)
 ######################################################################
 
+import copy
+from typing import Dict, Optional
+
 import torch
+import torch.quantization as quantization
 from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
+# "flatten" feeds every activation to fc, the others pool each channel to one value first
+HEADS = ["flatten", "avg", "max", "avgmax"]
 
-class XrayClassifier(nn.Module):
-    """Model Architecture"""
+# one entry per conv block: output channels, stride, batch norm, 2x2 max pooling after it
+ARCHITECTURES = {
+    # the original network; bn2 exists in its checkpoints but was never applied
+    "xray": {
+        "widths": [12, 20, 32, 48],
+        "strides": [1, 1, 1, 1],
+        "batch_norm": [True, False, True, True],
+        "pools": [True, False, False, False],
+    },
+    # 16x fewer positions after the first block, for fast experiments at high resolution
+    "xray_fast": {
+        "widths": [12, 20, 32, 48],
+        "strides": [2, 1, 1, 1],
+        "batch_norm": [True, True, True, True],
+        "pools": [True, True, False, False],
+    },
+    # compact student for distillation, meant for the pooled heads and lower resolutions
+    "xray_student": {
+        "widths": [8, 12, 16, 24],
+        "strides": [1, 1, 1, 1],
+        "batch_norm": [True, True, True, True],
+        "pools": [True, True, False, False],
+    },
+}
 
-    def __init__(self, num_classes=3, dropout_probability=0.2):
-        super(XrayClassifier, self).__init__()
+DEFAULT_SPEC = {
+    "num_classes": 3,
+    "in_channels": 1,
+    "kernel_size": 3,
+    "dropout": 0.4,
+    "input_size": 512,
+    "head": "flatten",
+}
 
-        self.conv1 = nn.Conv2d(in_channels=1, out_channels=12, kernel_size=3, stride=1, padding=1)
-        self.bn1 = nn.BatchNorm2d(num_features=12)
-        self.relu1 = nn.ReLU()
-        self.pool = nn.MaxPool2d(kernel_size=2)
 
-        self.conv2 = nn.Conv2d(in_channels=12, out_channels=20, kernel_size=3, stride=1, padding=1)
-        self.bn2 = nn.BatchNorm2d(num_features=20)
-        self.relu2 = nn.ReLU()
+def architecture_spec(name: str = "xray", **overrides) -> Dict:
+    """Returns the full spec of a registered architecture with some fields overridden"""
+
+    if name not in ARCHITECTURES:
+        raise ValueError(f"Unknown architecture {name}, expected one of {list(ARCHITECTURES)}")
+    spec = dict(DEFAULT_SPEC, name=name, **copy.deepcopy(ARCHITECTURES[name]))
+    unknown = set(overrides) - set(spec)
+    if unknown:
+        raise ValueError(f"Unknown architecture fields {sorted(unknown)}")
+    spec.update({key: copy.deepcopy(value) for key, value in overrides.items()})
+    depth = len(spec["widths"])
+    if any(len(spec[key]) != depth for key in ["strides", "batch_norm", "pools"]):
+        raise ValueError("widths, strides, batch_norm and pools need one entry per block")
+    if spec["head"] not in HEADS:
+        raise ValueError(f"Unknown head {spec['head']}, expected one of {HEADS}")
+    return spec
+
 
-        self.conv3 = nn.Conv2d(in_channels=20, out_channels=32, kernel_size=3, stride=1, padding=1)
-        self.bn3 = nn.BatchNorm2d(num_features=32)
-        self.relu3 = nn.ReLU()
+def output_size(spec: Dict) -> int:
+    """Side length of the feature maps of the last block for spec["input_size"] images"""
 
-        self.conv4 = nn.Conv2d(in_channels=32, out_channels=48, kernel_size=3, stride=1, padding=1)
-        self.bn4 = nn.BatchNorm2d(num_features=48)
-        self.relu4 = nn.ReLU()
-        self.dropout = nn.Dropout(p=dropout_probability)
+    size = spec["input_size"]
+    padding = spec["kernel_size"] // 2
+    for stride, pool in zip(spec["strides"], spec["pools"]):
+        size = (size + 2 * padding - spec["kernel_size"]) // stride + 1
+        if pool:
+            size //= 2
+    return size
 
-        self.fc = nn.Linear(in_features=48 * 256 * 256, out_features=num_classes)
 
-    def forward(self, x):
+class XrayClassifier(nn.Module):
+    """Model Architecture
+
+    The layers are named conv1, bn1, relu1, ... per block as in the original network, so
+    its checkpoints load unchanged. The spec (see architecture_spec) is stored in
+    checkpoints, model_from_checkpoint rebuilds the model from it.
+    """
+
+    def __init__(
+        self,
+        num_classes: int = 3,
+        dropout_probability: float = 0.4,
+        input_size: int = 512,
+        head: str = "flatten",
+        spec: Optional[Dict] = None,
+    ) -> None:
+        super(XrayClassifier, self).__init__()
+
+        if spec is None:
+            spec = architecture_spec(
+                num_classes=num_classes,
+                dropout=dropout_probability,
+                input_size=input_size,
+                head=head,
+            )
+        self.spec = spec
+        # side length of the training images. Pooled heads accept any size, the flatten
+        # head only this one
+        self.input_size = spec["input_size"]
+        self.head = spec["head"]
+        self.depth = len(spec["widths"])
+
+        in_channels = spec["in_channels"]
+        for block, width in enumerate(spec["widths"], 1):
+            conv = nn.Conv2d(
+                in_channels=in_channels,
+                out_channels=width,
+                kernel_size=spec["kernel_size"],
+                stride=spec["strides"][block - 1],
+                padding=spec["kernel_size"] // 2,
+            )
+            setattr(self, f"conv{block}", conv)
+            setattr(self, f"bn{block}", nn.BatchNorm2d(num_features=width))
+            setattr(self, f"relu{block}", nn.ReLU())
+            in_channels = width
+        self.pool = nn.MaxPool2d(kernel_size=2)
+        self.dropout = nn.Dropout(p=spec["dropout"])
+
+        if self.head == "flatten":
+            in_features = in_channels * output_size(spec) ** 2
+        else:
+            self.avg_pool = nn.AdaptiveAvgPool2d(1)
+            self.max_pool = nn.AdaptiveMaxPool2d(1)
+            in_features = 2 * in_channels if self.head == "avgmax" else in_channels
+        self.fc = nn.Linear(in_features=in_features, out_features=spec["num_classes"])
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
         """Forward pass of the model"""
-        x = self.conv1(x)
-        x = self.bn1(x)
-        x = self.dropout(self.relu1(x))
-        x = self.pool(x)
-        x = self.conv2(x)
-        x = self.dropout(self.relu2(x))
-        x = self.conv3(x)
-        x = self.bn3(x)
-        x = self.dropout(self.relu3(x))
-        x = self.conv4(x)
-        x = self.bn4(x)
-        x = self.relu4(x)
-        x = x.view(x.shape[0], 48 * 256 * 256)
+        for block in range(1, self.depth + 1):
+            x = getattr(self, f"conv{block}")(x)
+            if self.spec["batch_norm"][block - 1]:
+                x = getattr(self, f"bn{block}")(x)
+            x = self.dropout(getattr(self, f"relu{block}")(x))
+            if self.spec["pools"][block - 1]:
+                x = self.pool(x)
+
+        if self.head == "avg":
+            x = self.avg_pool(x)
+        elif self.head == "max":
+            x = self.max_pool(x)
+        elif self.head == "avgmax":
+            x = torch.cat([self.avg_pool(x), self.max_pool(x)], dim=1)
+        x = torch.flatten(x, 1)
         x = self.fc(x)
 
         return x
 
 
+def fuse_model(model: XrayClassifier) -> XrayClassifier:
+    """Returns an inference copy with batch norm folded into the convolutions
+
+    The batch norm layers become identities, as does dropout, which does nothing in eval
+    mode anyway. The original model is left untouched.
+    """
+
+    fused = copy.deepcopy(model).eval()
+    for block in range(1, fused.depth + 1):
+        if fused.spec["batch_norm"][block - 1]:
+            conv = getattr(fused, f"conv{block}")
+            setattr(fused, f"conv{block}", fuse_conv_bn_eval(conv, getattr(fused, f"bn{block}")))
+            setattr(fused, f"bn{block}", nn.Identity())
+    fused.dropout = nn.Identity()
+    return fused
+
+
+def quantization_backend() -> str:
+    """Returns the int8 kernel library of this machine, fbgemm on x86 and qnnpack on ARM"""
+
+    engines = torch.backends.quantized.supported_engines
+    return "fbgemm" if "fbgemm" in engines else "qnnpack"
+
+
+class QuantizedXrayClassifier(nn.Module):
+    """Int8 inference form of an XrayClassifier
+
+    The conv blocks (batch norm folded, conv+relu fused) run in static int8 between a
+    QuantStub and a DeQuantStub, the head pools in float and fc is dynamically quantized.
+    Build it with prepare_quantization and convert_quantization.
+    """
+
+    def __init__(self, model: XrayClassifier) -> None:
+        super(QuantizedXrayClassifier, self).__init__()
+        self.spec = model.spec
+        self.input_size = model.input_size
+        self.head = model.head
+
+        fused = fuse_model(model)
+        layers = []
+        self.fuse_groups = []
+        for block in range(1, fused.depth + 1):
+            self.fuse_groups.append([str(len(layers)), str(len(layers) + 1)])
+            layers += [getattr(fused, f"conv{block}"), getattr(fused, f"relu{block}")]
+            if self.spec["pools"][block - 1]:
+                layers.append(nn.MaxPool2d(kernel_size=2))
+        self.features = nn.Sequential(*layers)
+        self.quant = quantization.QuantStub()
+        self.dequant = quantization.DeQuantStub()
+        self.avg_pool = nn.AdaptiveAvgPool2d(1)
+        self.max_pool = nn.AdaptiveMaxPool2d(1)
+        self.fc = fused.fc
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = self.dequant(self.features(self.quant(x)))
+        if self.head == "avg":
+            x = self.avg_pool(x)
+        elif self.head == "max":
+            x = self.max_pool(x)
+        elif self.head == "avgmax":
+            x = torch.cat([self.avg_pool(x), self.max_pool(x)], dim=1)
+        return self.fc(torch.flatten(x, 1))
+
+
+def prepare_quantization(model: XrayClassifier, backend: str) -> QuantizedXrayClassifier:
+    """Returns the model with observers on the conv stack, ready for calibration"""
+
+    torch.backends.quantized.engine = backend
+    quantized = QuantizedXrayClassifier(model).eval()
+    quantization.fuse_modules(quantized.features, quantized.fuse_groups, inplace=True)
+    quantized.qconfig = quantization.get_default_qconfig(backend)
+    # fc is quantized dynamically after the conversion
+    quantized.fc.qconfig = None
+    return quantization.prepare(quantized)
+
+
+def convert_quantization(prepared: QuantizedXrayClassifier) -> QuantizedXrayClassifier:
+    """Converts a calibrated model to static int8 convs and a dynamic int8 fc"""
+
+    quantized = quantization.convert(prepared.eval())
+    return quantization.quantize_dynamic(quantized, {nn.Linear}, dtype=torch.qint8)
+
+
+def checkpoint_spec(checkpoint: Dict) -> Dict:
+    """Returns the architecture spec of a checkpoint, also for checkpoints without one"""
+
+    if "architecture" in checkpoint:
+        return checkpoint["architecture"]
+    # older checkpoints are the original network with at most these two options
+    return architecture_spec(
+        input_size=checkpoint.get("input_size", 512), head=checkpoint.get("head", "flatten")
+    )
+
+
+def model_from_checkpoint(checkpoint: Dict) -> nn.Module:
+    """Rebuilds the model of a checkpoint and loads its weights"""
+
+    model = XrayClassifier(spec=checkpoint_spec(checkpoint))
+    if "quantization" in checkpoint:
+        # written by quantize_model.py; the int8 structure is built without calibration,
+        # the scales and zero points come with the state dict
+        model = convert_quantization(
+            prepare_quantization(model.eval(), checkpoint["quantization"]["backend"])
+        )
+    model.load_state_dict(checkpoint["model_state_dict"])
+    return model
+
+
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
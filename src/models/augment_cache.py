@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module materializes pre-augmented variants of the training set
+######################################################################
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+from typing import Tuple
+
+import numpy as np
+import torch
+from dataset_fetcher import AUGMENT_INDEX, Dataset_fetcher, batch_aug
+from omegaconf import OmegaConf
+from tqdm import tqdm
+
+from src.data.pyramid import BASE_RESOLUTION, resolution_path
+from src.data.shards import (
+    ShardWriter,
+    decode_images,
+    encode_images,
+    file_digest,
+    file_signature,
+)
+
+_DATASET = None
+
+
+def _init_worker(dataset: Dataset_fetcher, single_thread: bool = True) -> None:
+    """Gives every pool worker its own handle on the source images"""
+
+    global _DATASET
+    _DATASET = dataset
+    if single_thread:
+        # avoids oversubscription with several workers
+        torch.set_num_threads(1)
+
+
+def chunk_seed(seed: int, variant: int, chunk: int) -> int:
+    """Returns the RNG seed of one chunk of one variant"""
+
+    digest = hashlib.sha256(f"{seed}-{variant}-{chunk}".encode()).hexdigest()
+    return int(digest[:12], 16)
+
+
+def _augment_chunk(task: Tuple[int, int, int, int, int, str]) -> Tuple[int, int, np.ndarray]:
+    """Augments images [start, end) of the source for one variant"""
+
+    variant, chunk, start, end, seed, dtype = task
+    images = np.asarray(_DATASET.images[start:end])
+    images = decode_images(torch.as_tensor(np.array(images)), _DATASET.scale)
+    # seeded per chunk, so the output does not depend on the number of workers; the RNG is
+    # forked so the caller's one is left alone when this runs in-process (workers=1)
+    with torch.random.fork_rng(devices=[]), torch.no_grad():
+        torch.manual_seed(chunk_seed(seed, variant, chunk))
+        augmented = batch_aug(images)
+    return variant, start, encode_images(augmented, dtype)
+
+
+def build_augmented_cache(
+    PATH_IMG: str,
+    PATH_LAB: str,
+    directory: str,
+    variants: int = 8,
+    seed: int = 0,
+    workers: int = 1,
+    chunk_size: int = 64,
+    dtype: str = "uint8",
+    shard_size: int = 1024,
+    resolution: int = BASE_RESOLUTION,
+) -> None:
+    """Writes `variants` augmented copies of a split as sharded splits into directory
+
+    Every variant is a complete sharded split (see src/data/shards.py), so Dataset_fetcher
+    can read it with augmented_dir=directory and pick one variant per sample and epoch.
+    Chunks of chunk_size images are augmented with batch_aug, seeded from (seed, variant,
+    chunk), so rebuilding with the same arguments gives the same cache. uint8 storage
+    clips the augmented values to [0, 1], use float16 to keep them as they are.
+    """
+
+    dataset = Dataset_fetcher(PATH_IMG, PATH_LAB, transform=None, resolution=resolution)
+    shape = tuple(np.asarray(dataset.images[0]).shape)
+    names = [f"variant_{variant:03d}" for variant in range(variants)]
+    writers = [
+        ShardWriter(
+            os.path.join(directory, name), dataset.labels.tolist(), shape, dtype, shard_size
+        )
+        for name in names
+    ]
+
+    tasks = [
+        (variant, chunk, start, min(start + chunk_size, len(dataset)), seed, dtype)
+        for variant in range(variants)
+        for chunk, start in enumerate(range(0, len(dataset), chunk_size))
+    ]
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(dataset,))
+        results = pool.imap_unordered(_augment_chunk, tasks)
+    else:
+        _init_worker(dataset, single_thread=False)
+        results = map(_augment_chunk, tasks)
+
+    try:
+        for variant, start, images in tqdm(results, total=len(tasks)):
+            writers[variant].write_encoded(start, images)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    for writer in writers:
+        writer.flush()
+    with open(os.path.join(directory, AUGMENT_INDEX), "w") as f:
+        json.dump(
+            {
+                "variants": names,
+                "seed": seed,
+                "source": PATH_IMG,
+                # checked by Dataset_fetcher, a stale cache is never read
+                "resolution": resolution,
+                "source_digest": file_digest(resolution_path(PATH_IMG, resolution)),
+                "source_signature": file_signature(resolution_path(PATH_IMG, resolution)),
+            },
+            f,
+        )
+
+
+def main() -> None:
+    """Builds the pre-augmented cache of the training split configured in config.yaml"""
+
+    BASE_DIR = os.getcwd()
+    config = OmegaConf.load(BASE_DIR + "/config/config.yaml")
+
+    parser = argparse.ArgumentParser(description="Materialize augmented training variants")
+    parser.add_argument("--output", type=str, default=config.AUGMENTED_CACHE or None)
+    parser.add_argument("--variants", type=int, default=config.AUGMENT_VARIANTS)
+    parser.add_argument("--workers", type=int, default=config.N_WORKERS)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--dtype", type=str, default="uint8", choices=["uint8", "float16"])
+    args = parser.parse_args()
+    if not args.output:
+        parser.error("set AUGMENTED_CACHE in config/config.yaml or pass --output")
+
+    print(f"[INFO] Writing {args.variants} augmented variants to {args.output}...")
+    build_augmented_cache(
+        BASE_DIR + config.TRAIN_PATHS.images,
+        BASE_DIR + config.TRAIN_PATHS.labels,
+        BASE_DIR + args.output,
+        variants=args.variants,
+        seed=args.seed,
+        workers=args.workers,
+        dtype=args.dtype,
+        resolution=config.RESOLUTION,
+    )
+
+
+if __name__ == "__main__":
+
+    main()
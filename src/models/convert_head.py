@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module converts trained models to a global-pooling classifier head
+######################################################################
+
+import argparse
+import io
+import json
+import os
+import time
+from typing import Dict, Iterable
+
+import torch
+from dataset_fetcher import Dataset_fetcher
+from model_architecture import XrayClassifier, model_from_checkpoint
+from omegaconf import OmegaConf
+from torch import nn, optim
+from torch.utils.data import DataLoader
+
+
+def pooled_from_flatten(model: XrayClassifier, head: str = "avg") -> XrayClassifier:
+    """Returns a copy of a flatten-head model with a pooled head
+
+    The convolutions are copied. fc is initialized with the flatten weights summed over
+    the spatial positions of every channel, which gives exactly the old logits when each
+    channel is constant over the image and the channel mean is fed in. For "max" the same
+    weights are a starting point, for "avgmax" the max half starts at zero.
+    """
+
+    pooled = XrayClassifier(spec=dict(model.spec, head=head))
+    features = {k: v for k, v in model.state_dict().items() if not k.startswith("fc.")}
+    pooled.load_state_dict(features, strict=False)
+
+    channels = model.spec["widths"][-1]
+    summed = model.fc.weight.detach().view(model.fc.out_features, channels, -1).sum(-1)
+    with torch.no_grad():
+        pooled.fc.weight.zero_()
+        pooled.fc.weight[:, :channels] = summed
+        pooled.fc.bias.copy_(model.fc.bias)
+    return pooled
+
+
+def fine_tune_head(
+    model: XrayClassifier, loader: Iterable, epochs: int = 1, learning_rate: float = 1e-3
+) -> None:
+    """Trains fc only, with frozen convolutions and batch norm statistics"""
+
+    # eval mode keeps the batch norm statistics and disables dropout
+    model.eval()
+    for parameter in model.parameters():
+        parameter.requires_grad = False
+    for parameter in model.fc.parameters():
+        parameter.requires_grad = True
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(model.fc.parameters(), lr=learning_rate)
+    for epoch in range(epochs):
+        losses = []
+        for images, labels in loader:
+            optimizer.zero_grad(set_to_none=True)
+            loss = criterion(model(images), labels)
+            loss.backward()
+            optimizer.step()
+            losses.append(loss.item())
+        print(
+            f"[INFO] Fine-tuning epoch {epoch + 1}/{epochs}: loss={sum(losses) / len(losses):.3f}"
+        )
+    for parameter in model.parameters():
+        parameter.requires_grad = True
+
+
+def checkpoint_size(model: nn.Module) -> int:
+    """Returns the size of the serialized state dict in bytes"""
+
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+
+def evaluate(model: nn.Module, loader: Iterable) -> Dict:
+    """Returns accuracy, latency per image and size of a model on a split"""
+
+    model.eval()
+    correct = 0
+    total = 0
+    elapsed = 0.0
+    with torch.no_grad():
+        for images, labels in loader:
+            start = time.perf_counter()
+            output = model(images)
+            elapsed += time.perf_counter() - start
+            correct += (output.argmax(1) == labels).sum().item()
+            total += len(labels)
+    return {
+        "accuracy": 100 * correct / max(1, total),
+        "latency_ms": 1000 * elapsed / max(1, total),
+        "parameters": sum(p.numel() for p in model.parameters()),
+        "size_mb": checkpoint_size(model) / 2**20,
+    }
+
+
+def main() -> None:
+    """Converts the best checkpoint and compares both heads on the validation split"""
+
+    BASE_DIR = os.getcwd()
+    config = OmegaConf.load(BASE_DIR + "/config/config.yaml")
+
+    parser = argparse.ArgumentParser(description="Convert a model to a global-pooling head")
+    parser.add_argument("--checkpoint", type=str, default=config.BEST_MODEL_PATH)
+    parser.add_argument("--head", type=str, default="avg", choices=["avg", "max", "avgmax"])
+    parser.add_argument("--epochs", type=int, default=0, help="fine-tuning epochs of the head")
+    parser.add_argument("--learning-rate", type=float, default=1e-3)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    checkpoint = torch.load(args.checkpoint, map_location="cpu")
+    model = model_from_checkpoint(checkpoint)
+    if model.head != "flatten":
+        parser.error(f"{args.checkpoint} already has a {model.head} head")
+    pooled = pooled_from_flatten(model, args.head)
+
+    def loader(paths, shuffle):
+        dataset = Dataset_fetcher(
+            BASE_DIR + paths.images,
+            BASE_DIR + paths.labels,
+            transform=None,
+            resolution=model.input_size,
+            mmap=config.MMAP,
+        )
+        return DataLoader(
+            dataset,
+            shuffle=shuffle,
+            num_workers=config.N_WORKERS,
+            batch_size=config.BATCH_SIZE,
+            collate_fn=dataset.collate_fn,
+        )
+
+    if args.epochs:
+        fine_tune_head(pooled, loader(config.TRAIN_PATHS, True), args.epochs, args.learning_rate)
+
+    print("[INFO] Evaluating both heads on the validation split...")
+    validation = loader(config.VALID_PATHS, False)
+    report = {
+        "checkpoint": args.checkpoint,
+        "fine_tune_epochs": args.epochs,
+        "flatten": evaluate(model, validation),
+        args.head: evaluate(pooled, validation),
+    }
+    print(f"{'head':>10} {'accuracy %':>12} {'ms/image':>10} {'parameters':>12} {'MB':>8}")
+    for head in ["flatten", args.head]:
+        result = report[head]
+        print(
+            f"{head:>10} {result['accuracy']:>12.2f} {result['latency_ms']:>10.2f}"
+            f" {result['parameters']:>12} {result['size_mb']:>8.2f}"
+        )
+
+    output = args.output or os.path.splitext(args.checkpoint)[0] + f"_{args.head}.pth"
+    torch.save(
+        {
+            "epoch": checkpoint.get("epoch"),
+            "architecture": pooled.spec,
+            "model_state_dict": pooled.state_dict(),
+        },
+        output,
+    )
+    with open(os.path.splitext(output)[0] + "_report.json", "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"[INFO] Converted model saved to {output}")
+
+
+if __name__ == "__main__":
+
+    main()
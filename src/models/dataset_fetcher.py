@@ -12,16 +12,29 @@
 # Module: This module is responsible accessing our data
 ######################################################################
 
+import json
 import os
-from typing import Union
+from typing import Callable, Iterator, List, Optional, Tuple, Union
 
+import numpy as np
 import torch
 import torchvision.transforms as transforms
 from omegaconf import OmegaConf
-from torch.utils.data import DataLoader, Dataset
+from sampler import repeat_factors
+from torch import nn
+from torch.utils.data import DataLoader, Dataset, IterableDataset, get_worker_info
+from torch.utils.data.dataloader import default_collate
 
 import kornia as K
 import torchvision
+from src.data.pyramid import BASE_RESOLUTION, resolution_path
+from src.data.shards import (
+    ShardedArray,
+    decode_images,
+    file_digest,
+    file_signature,
+    is_sharded,
+)
 
 
 class korniaGray2RGB(object):
@@ -48,31 +61,389 @@ data_aug = torchvision.transforms.Compose(
     ]
 )
 
+# noise added to three channels independently and then averaged to gray is weaker than
+# noise added to the gray channel directly, by the norm of the grayscale weights
+GRAY_NOISE_SCALE = (0.299**2 + 0.587**2 + 0.114**2) ** 0.5
+
+# data_aug for whole [B, 1, H, W] batches: every op runs directly on the gray channel,
+# parameters are still drawn per sample
+batch_aug = nn.Sequential(
+    K.augmentation.RandomHorizontalFlip(p=0.2),
+    K.augmentation.RandomVerticalFlip(p=0.2),
+    K.augmentation.RandomSharpness(sharpness=0.5, p=0.2),
+    K.augmentation.RandomGaussianNoise(mean=0.0, std=0.01 * GRAY_NOISE_SCALE, p=0.1),
+    K.augmentation.RandomThinPlateSpline(scale=0.2, p=0.2),
+)
+
+
+def shared_epoch() -> torch.Tensor:
+    """Returns an epoch counter in shared memory
+
+    DataLoader workers see later updates of it, also persistent ones, which keep the
+    dataset copy they got in the first epoch.
+    """
+
+    return torch.zeros(1, dtype=torch.int64).share_memory_()
+
+
+# lists the variant folders of a cache written by augment_cache.py
+AUGMENT_INDEX = "augment.json"
+
+
+def memmap_file(PATH_IMG: str) -> str:
+    """Returns a .npy copy of a .pt images file that can be memory-mapped
+
+    The float32 copy is written next to the .pt file on first use, which doubles the disk
+    space of the split, and reused as long as it is newer than it. Delete it to reclaim
+    the space. make_dataset.py --stream writes .npy splits, which need no copy.
+    """
+
+    if PATH_IMG.endswith(".npy"):
+        return PATH_IMG
+    npy_path = os.path.splitext(PATH_IMG)[0] + ".npy"
+    # an equal mtime is stale too: the .pt may have been rewritten within the timestamp
+    # resolution of the file system
+    if not os.path.isfile(npy_path) or os.path.getmtime(npy_path) <= os.path.getmtime(PATH_IMG):
+        images = torch.load(PATH_IMG).numpy()
+        print(
+            f"[INFO] Writing a memory-mappable copy of {PATH_IMG} to {npy_path}"
+            f" ({images.nbytes / 2**20:.0f} MiB)..."
+        )
+        tmp_path = f"{npy_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, images)
+        os.replace(tmp_path, npy_path)
+    return npy_path
+
+
+def prepare_sample(
+    image: Union[torch.Tensor, np.ndarray], scale: float, transform: Optional[Callable]
+) -> torch.Tensor:
+    """Turns a stored image into a (C, H, W) tensor, applying the per-sample transform"""
+
+    if isinstance(image, np.ndarray):
+        # copies the sample out of the read-only mapping
+        image = torch.from_numpy(np.array(image))
+        if transform:
+            # per-sample augmentation needs floats, otherwise decoding waits for collate_fn
+            image = decode_images(image, scale)
+
+    if transform:
+        image = transform(image)
+
+    return image.view(-1, image.shape[-2], image.shape[-1])
+
+
+def collate_batch(
+    batch: list, scale: float, batch_transform: Optional[Callable]
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Collates a batch, converts compactly stored images to float32 and applies the batch
+    transform, all in one go per batch
+    """
+
+    images, labels = default_collate(batch)
+    if images.dtype != torch.float32:
+        images = decode_images(images, scale)
+    if batch_transform is not None:
+        with torch.no_grad():
+            images = batch_transform(images)
+    return images, labels
+
 
 # TODO: Write tests for this module
 class Dataset_fetcher(Dataset):
     def __init__(
         self,
         PATH_IMG: str,
-        PATH_LAB: str,
+        PATH_LAB: Union[str, None] = None,
         transform: Union[transforms.transforms.Compose, None] = data_aug,
+        resolution: int = BASE_RESOLUTION,
+        mmap: bool = False,
+        batch_transform: Optional[Callable[[torch.Tensor], torch.Tensor]] = None,
+        augmented_dir: Optional[str] = None,
+        seed: int = 0,
     ) -> None:
 
-        self.images = torch.load(PATH_IMG)
-        self.labels = torch.load(PATH_LAB).long()
+        # the downsampled copies written by make_dataset.py share the labels of the base split
+        PATH_IMG = resolution_path(PATH_IMG, resolution)
+
+        # scale the stored values are divided by, 1.0 means they are stored as floats
+        self.scale = 1.0
+        self.variants = None
+        self.seed = seed
+        self._epoch = shared_epoch()
+        self._variant_epoch = None
+        if augmented_dir:
+            # pre-augmented copies written by augment_cache.py, one sharded split per variant
+            with open(os.path.join(augmented_dir, AUGMENT_INDEX)) as f:
+                index = json.load(f)
+            if index.get("resolution") != resolution:
+                raise ValueError(
+                    f"{augmented_dir} holds {index.get('resolution')}px images, not {resolution}px,"
+                    " rebuild it with augment_cache.py"
+                )
+            # the digest is only recomputed when size or mtime of the source changed
+            unchanged = index.get("source_signature") == file_signature(PATH_IMG)
+            if not unchanged and index.get("source_digest") != file_digest(PATH_IMG):
+                raise ValueError(
+                    f"{augmented_dir} was not built from the current {PATH_IMG},"
+                    " rebuild it with augment_cache.py"
+                )
+            self.variants = [
+                ShardedArray(os.path.join(augmented_dir, name)) for name in index["variants"]
+            ]
+            self.images = self.variants[0]
+            self.scale = self.images.scale
+            self.labels = torch.from_numpy(self.images.labels)
+        elif is_sharded(PATH_IMG):
+            # written by make_dataset.py --format shards, labels live in the shard index
+            self.images = ShardedArray(PATH_IMG)
+            self.scale = self.images.scale
+            self.labels = torch.from_numpy(self.images.labels)
+        elif mmap or PATH_IMG.endswith(".npy"):
+            # every DataLoader worker maps the same read-only file, so the pages are shared
+            # through the page cache instead of being copied into each process
+            self.images_path = memmap_file(PATH_IMG)
+            self._length = len(np.load(self.images_path, mmap_mode="r"))
+            self._images = None
+            self.labels = torch.load(PATH_LAB).long()
+        else:
+            self.images = torch.load(PATH_IMG)
+            self.labels = torch.load(PATH_LAB).long()
         self.transform = transform
+        # applied to the whole float32 batch in collate_fn, e.g. batch_aug
+        self.batch_transform = batch_transform
+
+    @property
+    def epoch(self) -> int:
+        return int(self._epoch[0])
+
+    def set_epoch(self, epoch: int) -> None:
+        """Selects the epoch, which decides the pre-augmented variant of every sample"""
+
+        self._epoch[0] = epoch
+
+    @property
+    def variant_of(self) -> np.ndarray:
+        """The pre-augmented variant every sample is read from in the current epoch"""
+
+        # drawn per process from the shared epoch, so persistent workers follow set_epoch
+        if self._variant_epoch != self.epoch:
+            rng = np.random.default_rng([self.seed, self.epoch])
+            self._variant_of = rng.integers(len(self.variants), size=len(self.labels))
+            self._variant_epoch = self.epoch
+        return self._variant_of
+
+    @property
+    def images(self) -> Union[torch.Tensor, np.ndarray, ShardedArray]:
+        """The stored images, memory-mapped files are opened on first access per process"""
+
+        if self._images is None:
+            self._images = np.load(self.images_path, mmap_mode="r")
+        return self._images
+
+    @images.setter
+    def images(self, images: Union[torch.Tensor, ShardedArray]) -> None:
+        self._images = images
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        if isinstance(state["_images"], np.memmap):
+            # workers map the file themselves instead of receiving a pickled copy
+            state["_images"] = None
+        return state
 
     def __getitem__(self, idx: int) -> Union[torch.tensor, str]:
-        image = self.images[idx]
+        if self.variants is None:
+            image = self.images[idx]
+        else:
+            image = self.variants[self.variant_of[idx]][idx]
         label = self.labels[idx]
 
-        if self.transform:
-            image = self.transform(image)
+        return prepare_sample(image, self.scale, self.transform), label
+
+    def collate_fn(self, batch: list) -> Union[torch.tensor, str]:
+        """Collates a batch, see collate_batch"""
+
+        return collate_batch(batch, self.scale, self.batch_transform)
+
+    def __len__(self) -> int:
+        if self._images is None:
+            return self._length
+        return len(self._images)
+
+
+class Dataset_streamer(IterableDataset):
+    """Iterable counterpart of Dataset_fetcher for datasets larger than memory
+
+    The data is read block by block with large sequential reads: a block is a shard of a
+    sharded split, or block_size consecutive rows of a .npy/.pt file. Blocks are shuffled
+    per epoch and their sequence is cut into one equal part per distributed rank, padded
+    by wrapping around like DistributedSampler, so all ranks yield the same number of
+    samples. Within a rank the blocks are dealt round-robin to the DataLoader workers.
+    Every sample is read once per epoch, plus at most world_size - 1 padding samples. Samples pass
+    through a shuffle buffer of shuffle_buffer images, which bounds the memory use.
+    The order only depends on seed and epoch; call set_epoch before every epoch. The
+    epoch is kept in shared memory, so it also reaches persistent DataLoader workers.
+
+    With sampling set to "balanced" or "weighted" (see sampler.py), every sample enters
+    the shuffle buffer a random number of times whose expectation brings its class to
+    its share, so classes are balanced without a sampler and the expected epoch length
+    stays the same. The actual length then varies per rank, so use ClassBalancedSampler
+    with Dataset_fetcher for balanced distributed training.
+    """
+
+    def __init__(
+        self,
+        PATH_IMG: str,
+        PATH_LAB: Union[str, None] = None,
+        transform: Union[transforms.transforms.Compose, None] = data_aug,
+        resolution: int = BASE_RESOLUTION,
+        batch_transform: Optional[Callable[[torch.Tensor], torch.Tensor]] = None,
+        shuffle_buffer: int = 1024,
+        block_size: int = 256,
+        seed: int = 0,
+        rank: Optional[int] = None,
+        world_size: Optional[int] = None,
+        sampling: Optional[str] = None,
+        class_weights: Optional[List[float]] = None,
+    ) -> None:
+        super(Dataset_streamer, self).__init__()
+
+        PATH_IMG = resolution_path(PATH_IMG, resolution)
+        self.scale = 1.0
+        if is_sharded(PATH_IMG):
+            sharded = ShardedArray(PATH_IMG)
+            self.images_path = PATH_IMG
+            self.scale = sharded.scale
+            self.labels = torch.from_numpy(sharded.labels)
+            self.blocks = [
+                (shard["offset"], shard["offset"] + shard["count"]) for shard in sharded.shards
+            ]
+        else:
+            self.images_path = memmap_file(PATH_IMG)
+            self.labels = torch.load(PATH_LAB).long()
+            length = len(np.load(self.images_path, mmap_mode="r"))
+            self.blocks = [
+                (start, min(start + block_size, length)) for start in range(0, length, block_size)
+            ]
+
+        if rank is None or world_size is None:
+            distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+            rank = torch.distributed.get_rank() if distributed else 0
+            world_size = torch.distributed.get_world_size() if distributed else 1
 
-        return image.view(-1, 512, 512), label
+        self.transform = transform
+        self.batch_transform = batch_transform
+        self.shuffle_buffer = max(1, shuffle_buffer)
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self._epoch = shared_epoch()
+        self._images = None
+        # expected number of times a sample of each class is emitted per epoch
+        self.repeats = None
+        if sampling is not None:
+            self.repeats = repeat_factors(self.labels, sampling, class_weights)
+
+    @property
+    def epoch(self) -> int:
+        return int(self._epoch[0])
+
+    def set_epoch(self, epoch: int) -> None:
+        """Selects the block order and shuffle of an epoch"""
+
+        self._epoch[0] = epoch
+
+    @property
+    def images(self) -> Union[np.ndarray, ShardedArray]:
+        """The stored images, opened on first access per process"""
+
+        if self._images is None:
+            if is_sharded(self.images_path):
+                self._images = ShardedArray(self.images_path)
+            else:
+                self._images = np.load(self.images_path, mmap_mode="r")
+        return self._images
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    def _rank_blocks(self) -> List[Tuple[int, int]]:
+        """Returns the blocks of this rank in the order of the current epoch"""
+
+        order = np.random.default_rng([self.seed, self.epoch]).permutation(len(self.blocks))
+        blocks = [self.blocks[i] for i in order]
+        total = sum(end - start for start, end in blocks)
+        if total == 0:
+            return []
+        # every rank takes the same number of samples, as DistributedSampler does: the
+        # shuffled block sequence is cut into equal parts, wrapping around to its start
+        # for the last one, otherwise the ranks with more batches wait forever in DDP
+        per_rank = -(-total // self.world_size)
+        begin, stop = self.rank * per_rank, (self.rank + 1) * per_rank
+        pieces = []
+        offset = 0
+        while offset < stop:
+            for start, end in blocks:
+                low, high = max(begin - offset, 0), min(stop - offset, end - start)
+                if low < high:
+                    pieces.append((start + low, start + high))
+                offset += end - start
+                if offset >= stop:
+                    break
+        return pieces
 
     def __len__(self) -> int:
-        return len(self.images)
+        if self.repeats is None:
+            return sum(end - start for start, end in self._rank_blocks())
+        # expected length, the actual one varies around it
+        labels = self.labels.numpy()
+        expected = sum(self.repeats[labels[start:end]].sum() for start, end in self._rank_blocks())
+        return int(round(expected))
+
+    def __iter__(self) -> Iterator[Tuple[torch.Tensor, torch.Tensor]]:
+        worker = get_worker_info()
+        worker_id, num_workers = (worker.id, worker.num_workers) if worker else (0, 1)
+        blocks = self._rank_blocks()[worker_id::num_workers]
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank, worker_id])
+
+        buffer: List[Tuple[np.ndarray, torch.Tensor]] = []
+        for start, end in blocks:
+            # one sequential read per block, the buffer then holds plain in-memory copies
+            images = np.array(self.images[start:end])
+            labels = self.labels[start:end]
+            positions = np.arange(end - start)
+            if self.repeats is not None:
+                # floor(repeats) copies plus one more with the probability of the remainder
+                repeats = self.repeats[labels.numpy()]
+                counts = np.floor(repeats).astype(np.int64)
+                counts += rng.random(len(repeats)) < repeats - counts
+                positions = np.repeat(positions, counts)
+            # rows are copied out one at a time so buffered samples do not keep whole
+            # blocks alive; the repeats of a row, which are consecutive, share its copy
+            previous = None
+            for row in positions:
+                if row != previous:
+                    image, label, previous = images[row].copy(), labels[row], row
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append((image, label))
+                    continue
+                # emit a random buffered sample and put the new one in its place
+                position = rng.integers(len(buffer))
+                sample, buffer[position] = buffer[position], (image, label)
+                yield prepare_sample(sample[0], self.scale, self.transform), sample[1]
+
+        for position in rng.permutation(len(buffer)):
+            image, label = buffer[position]
+            yield prepare_sample(image, self.scale, self.transform), label
+
+    def collate_fn(self, batch: list) -> Union[torch.tensor, str]:
+        """Collates a batch, see collate_batch"""
+
+        return collate_batch(batch, self.scale, self.batch_transform)
 
 
 if __name__ == "__main__":
@@ -90,35 +461,3 @@ if __name__ == "__main__":
     dataset = Dataset_fetcher(TRAIN_PATHS["images"], TRAIN_PATHS["labels"])
     dataloader = DataLoader(dataset, shuffle=False, num_workers=4, batch_size=3)
     image, label = next(iter(dataloader))
-
-
-def mean_and_std() -> None:
-    """This function calculates the mean and standard deviation of the dataset"""
-
-    ##Code is redundant from the above class. Needs to be fixed
-    BASE_DIR = os.getcwd()
-    config = OmegaConf.load(BASE_DIR + "/config/config.yaml")
-    TRAIN_PATHS = {
-        "images": BASE_DIR + config.TRAIN_PATHS.images,
-        "labels": BASE_DIR + config.TRAIN_PATHS.labels,
-    }
-
-    dataset = Dataset_fetcher(TRAIN_PATHS["images"], TRAIN_PATHS["labels"])
-    dataloader = DataLoader(dataset, shuffle=False, num_workers=4, batch_size=3)
-    mean = 0.0
-    std = 0.0
-    nb_samples = 0.0
-
-    for images, _ in dataloader:
-        batch_samples = images.size(0)
-        data = images.view(batch_samples, images.size(1), -1)
-        mean += data.mean(2).sum(0)
-        std += data.std(2).sum(0)
-        nb_samples += batch_samples
-
-    mean /= nb_samples
-    std /= nb_samples
-    print(mean, std)
-
-
-mean_and_std()
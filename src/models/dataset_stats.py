@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module computes and caches the pixel statistics of a dataset
+######################################################################
+
+import argparse
+import json
+import os
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import torch
+from dataset_fetcher import Dataset_fetcher
+from omegaconf import OmegaConf
+from torch.utils.data import DataLoader, Dataset
+
+from src.data.shards import decode_images, file_digest, is_sharded
+
+STATS_VERSION = 1
+
+
+class RunningStats(object):
+    """Exact streaming mean, variance, range and histogram of pixel values
+
+    Every update computes the statistics of a whole batch at once and combines them with
+    the running ones using the parallel formula of Chan et al., which is also how partial
+    results of different workers are merged. Sums are kept in float64.
+    """
+
+    def __init__(self, bins: int = 256, value_range: Tuple[float, float] = (0.0, 1.0)) -> None:
+        self.bins = bins
+        self.value_range = (float(value_range[0]), float(value_range[1]))
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.histogram = np.zeros(bins, dtype=np.int64)
+
+    def update(self, values: torch.Tensor) -> None:
+        """Adds a batch of pixel values of any shape"""
+
+        values = values.detach().reshape(-1).double()
+        if len(values) == 0:
+            return
+        other = RunningStats(self.bins, self.value_range)
+        other.count = len(values)
+        other.mean = float(values.mean())
+        other.m2 = float(((values - other.mean) ** 2).sum())
+        other.min = float(values.min())
+        other.max = float(values.max())
+        # values outside the range are counted in the first or last bin
+        low, high = self.value_range
+        other.histogram = torch.histc(values.clamp(low, high), self.bins, low, high).long().numpy()
+        self.merge(other)
+
+    def merge(self, other: "RunningStats") -> None:
+        """Combines the statistics of another, disjoint part of the data into these"""
+
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.histogram = self.histogram + other.histogram
+
+    @property
+    def std(self) -> float:
+        """Standard deviation over all pixels of the dataset"""
+
+        return (self.m2 / self.count) ** 0.5 if self.count else 0.0
+
+    def to_dict(self) -> Dict:
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "std": self.std,
+            "m2": self.m2,
+            "min": self.min,
+            "max": self.max,
+            "bins": self.bins,
+            "value_range": list(self.value_range),
+            "histogram": self.histogram.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "RunningStats":
+        stats = cls(data["bins"], tuple(data["value_range"]))
+        stats.count = data["count"]
+        stats.mean = data["mean"]
+        stats.m2 = data["m2"]
+        stats.min = data["min"]
+        stats.max = data["max"]
+        stats.histogram = np.asarray(data["histogram"], dtype=np.int64)
+        return stats
+
+
+class _ChunkStats(Dataset):
+    """Turns contiguous chunks of a dataset into partial statistics, one chunk per item"""
+
+    def __init__(
+        self, dataset: Dataset_fetcher, chunk_size: int, bins: int, value_range: Tuple
+    ) -> None:
+        self.dataset = dataset
+        self.chunk_size = chunk_size
+        self.bins = bins
+        self.value_range = value_range
+
+    def __len__(self) -> int:
+        return (len(self.dataset) + self.chunk_size - 1) // self.chunk_size
+
+    def __getitem__(self, chunk: int) -> Dict:
+        start = chunk * self.chunk_size
+        images = self.dataset.images[start : start + self.chunk_size]
+        stats = RunningStats(self.bins, self.value_range)
+        stats.update(decode_images(torch.as_tensor(np.asarray(images)), self.dataset.scale))
+        return stats.to_dict()
+
+
+def stats_path(PATH_IMG: str) -> str:
+    """Returns where the statistics of an images file are cached"""
+
+    if is_sharded(PATH_IMG):
+        return os.path.join(PATH_IMG, "stats.json")
+    return os.path.splitext(PATH_IMG)[0] + "_stats.json"
+
+
+def compute_stats(
+    dataset: Dataset_fetcher,
+    num_workers: int = 0,
+    chunk_size: int = 64,
+    bins: int = 256,
+    value_range: Tuple[float, float] = (0.0, 1.0),
+) -> RunningStats:
+    """Computes the statistics of a dataset in a single pass
+
+    Chunks are reduced to partial statistics in the DataLoader workers, the main process
+    only merges them, so no image is ever held twice and the transfer between processes
+    is tiny.
+    """
+
+    loader = DataLoader(
+        _ChunkStats(dataset, chunk_size, bins, value_range),
+        batch_size=None,
+        num_workers=num_workers,
+    )
+    stats = RunningStats(bins, value_range)
+    for partial in loader:
+        stats.merge(RunningStats.from_dict(partial))
+    return stats
+
+
+def dataset_stats(
+    PATH_IMG: str,
+    PATH_LAB: Optional[str] = None,
+    num_workers: int = 0,
+    bins: int = 256,
+    value_range: Tuple[float, float] = (0.0, 1.0),
+    refresh: bool = False,
+) -> RunningStats:
+    """Returns the statistics of an images file, from the cache next to it if still valid
+
+    The cache entry is keyed by the SHA-256 of the data, so it is recomputed whenever the
+    file changes and never goes stale silently.
+    """
+
+    digest = file_digest(PATH_IMG)
+    key = {"version": STATS_VERSION, "sha256": digest, "bins": bins, "range": list(value_range)}
+    cache_file = stats_path(PATH_IMG)
+    if not refresh and os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached.get("key") == key:
+            return RunningStats.from_dict(cached["stats"])
+
+    dataset = Dataset_fetcher(PATH_IMG, PATH_LAB, transform=None)
+    stats = compute_stats(dataset, num_workers=num_workers, bins=bins, value_range=value_range)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({"key": key, "stats": stats.to_dict()}, f)
+    os.replace(tmp_file, cache_file)
+    return stats
+
+
+def main() -> None:
+    """Prints the statistics of the splits configured in config.yaml"""
+
+    parser = argparse.ArgumentParser(description="Compute pixel statistics of the dataset")
+    parser.add_argument("--splits", nargs="*", default=["TRAIN"], help="e.g. TRAIN TEST VALID")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--refresh", action="store_true", help="ignore cached statistics")
+    args = parser.parse_args()
+
+    BASE_DIR = os.getcwd()
+    config = OmegaConf.load(BASE_DIR + "/config/config.yaml")
+
+    for split in args.splits:
+        paths = config[split.upper() + "_PATHS"]
+        stats = dataset_stats(
+            BASE_DIR + paths.images,
+            BASE_DIR + paths.labels,
+            num_workers=args.workers,
+            refresh=args.refresh,
+        )
+        print(
+            f"[INFO] {split}: {stats.count} pixels, mean={stats.mean:.4f}, std={stats.std:.4f},"
+            f" min={stats.min:.4f}, max={stats.max:.4f}"
+        )
+
+
+if __name__ == "__main__":
+
+    main()
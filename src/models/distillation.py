@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module contains the knowledge distillation from a cached teacher
+######################################################################
+
+import argparse
+import os
+from typing import Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from dataset_fetcher import Dataset_fetcher
+from model_architecture import model_from_checkpoint
+from omegaconf import OmegaConf
+from torch.utils.data import DataLoader, Dataset
+
+from src.data.hashing import sha256sum
+from src.data.pyramid import resolution_path
+from src.data.shards import file_digest
+
+LOGITS_VERSION = 1
+
+
+def compute_teacher_logits(
+    teacher: torch.nn.Module, dataset: Dataset_fetcher, batch_size: int = 64, num_workers: int = 0
+) -> torch.Tensor:
+    """Returns the teacher's logits for every sample of dataset, in dataset order"""
+
+    loader = DataLoader(
+        dataset,
+        shuffle=False,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        collate_fn=dataset.collate_fn,
+    )
+    teacher.eval()
+    logits = []
+    with torch.no_grad():
+        for images, _ in loader:
+            logits.append(teacher(images))
+    return torch.cat(logits)
+
+
+def teacher_logits(
+    TEACHER: str,
+    PATH_IMG: str,
+    PATH_LAB: Optional[str],
+    cache_dir: str,
+    batch_size: int = 64,
+    num_workers: int = 0,
+) -> torch.Tensor:
+    """Returns the teacher's logits for a split, from the cache in cache_dir if still valid
+
+    The cache entry is keyed by the SHA-256 of the teacher checkpoint and of the images
+    the teacher reads (its own resolution), so a new teacher or new data never reuses
+    stale logits. The logits are computed once on the images without augmentation.
+    """
+
+    checkpoint = torch.load(TEACHER, map_location="cpu")
+    teacher = model_from_checkpoint(checkpoint)
+    dataset = Dataset_fetcher(PATH_IMG, PATH_LAB, transform=None, resolution=teacher.input_size)
+    key = {
+        "version": LOGITS_VERSION,
+        "teacher": sha256sum(TEACHER),
+        "images": file_digest(resolution_path(PATH_IMG, teacher.input_size)),
+    }
+    cache_file = os.path.join(cache_dir, f"{key['teacher'][:12]}_{key['images'][:12]}.pt")
+    if os.path.isfile(cache_file):
+        cached = torch.load(cache_file)
+        if cached.get("key") == key:
+            return cached["logits"]
+
+    print(f"[INFO] Computing teacher logits for {len(dataset)} images...")
+    logits = compute_teacher_logits(teacher, dataset, batch_size, num_workers)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    torch.save({"key": key, "logits": logits}, tmp_file)
+    os.replace(tmp_file, cache_file)
+    return logits
+
+
+class WithTeacherLogits(Dataset):
+    """Adds the cached teacher logits of every sample to a map-style dataset
+
+    Samples are (image, label, logits); set_epoch and collate_fn are passed through, so
+    the wrapper can replace the training set in train_model.py.
+    """
+
+    def __init__(self, dataset: Dataset_fetcher, logits: torch.Tensor) -> None:
+        if len(dataset) != len(logits):
+            raise ValueError(f"{len(logits)} teacher logits for {len(dataset)} samples")
+        self.dataset = dataset
+        self.logits = logits
+        self.labels = dataset.labels
+
+    def set_epoch(self, epoch: int) -> None:
+        self.dataset.set_epoch(epoch)
+
+    def __getitem__(self, idx: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        image, label = self.dataset[idx]
+        return image, label, self.logits[idx]
+
+    def collate_fn(self, batch: list) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Collates a batch with the wrapped dataset's collate_fn and stacks the logits"""
+
+        images, labels = self.dataset.collate_fn([(image, label) for image, label, _ in batch])
+        return images, labels, torch.stack([logits for _, _, logits in batch])
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+
+def distillation_loss(
+    student: torch.Tensor,
+    teacher: torch.Tensor,
+    labels: torch.Tensor,
+    temperature: float = 4.0,
+    alpha: float = 0.7,
+) -> torch.Tensor:
+    """Hinton et al.'s loss: alpha * T^2 * KL(teacher || student) at temperature T plus
+    (1 - alpha) * cross-entropy with the labels
+
+    The T^2 factor keeps the soft-target gradients on the scale of the hard ones.
+    """
+
+    soft = F.kl_div(
+        F.log_softmax(student / temperature, dim=1),
+        F.softmax(teacher.float() / temperature, dim=1),
+        reduction="batchmean",
+    )
+    hard = F.cross_entropy(student, labels)
+    return alpha * temperature**2 * soft + (1 - alpha) * hard
+
+
+def main() -> None:
+    """Precomputes the teacher logits of the training split configured in config.yaml"""
+
+    BASE_DIR = os.getcwd()
+    config = OmegaConf.load(BASE_DIR + "/config/config.yaml")
+
+    parser = argparse.ArgumentParser(description="Cache the teacher logits for distillation")
+    parser.add_argument("--teacher", type=str, default=config.TEACHER_CHECKPOINT or None)
+    parser.add_argument("--workers", type=int, default=config.N_WORKERS)
+    args = parser.parse_args()
+    if not args.teacher:
+        parser.error("set TEACHER_CHECKPOINT in config/config.yaml or pass --teacher")
+
+    logits = teacher_logits(
+        args.teacher,
+        BASE_DIR + config.TRAIN_PATHS.images,
+        BASE_DIR + config.TRAIN_PATHS.labels,
+        BASE_DIR + "/" + config.TEACHER_LOGITS_DIR,
+        num_workers=args.workers,
+    )
+    print(f"[INFO] Teacher logits ready: {tuple(logits.shape)}")
+
+
+if __name__ == "__main__":
+
+    main()
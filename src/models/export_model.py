@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module exports trained models as frozen TorchScript inference artifacts
+######################################################################
+
+import argparse
+import inspect
+import io
+import json
+import os
+import time
+from typing import IO, Dict, Iterable, Tuple, Union
+
+import numpy as np
+import torch
+from dataset_fetcher import Dataset_fetcher
+from inference_backend import ONNX_METADATA_KEY, OnnxBackend, TorchBackend
+from model_architecture import XrayClassifier, fuse_model, model_from_checkpoint
+from omegaconf import OmegaConf
+from torch import nn
+from torch.utils.data import DataLoader
+
+METADATA_FILE = "metadata.json"
+CLASSES = ["covid", "normal", "pneumonia"]
+
+
+class ChannelsLast(nn.Module):
+    """Runs a model on channels_last inputs, whatever the layout of the caller's tensor"""
+
+    def __init__(self, model: nn.Module) -> None:
+        super(ChannelsLast, self).__init__()
+        self.model = model
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.model(x.contiguous(memory_format=torch.channels_last))
+
+
+def script_model(model: XrayClassifier) -> torch.jit.ScriptModule:
+    """Fuses, traces and freezes a model for inference in channels_last layout
+
+    The forward pass has no data dependent control flow, so tracing captures it fully.
+    Freezing inlines the weights as constants.
+    """
+
+    fused = ChannelsLast(fuse_model(model).to(memory_format=torch.channels_last)).eval()
+    example = torch.rand(1, model.spec["in_channels"], model.input_size, model.input_size)
+    with torch.no_grad():
+        return torch.jit.freeze(torch.jit.trace(fused, example))
+
+
+def model_metadata(model: XrayClassifier, **metadata) -> Dict:
+    """Returns what a server needs to know about an exported model"""
+
+    return dict(
+        architecture=model.spec,
+        input_size=model.input_size,
+        head=model.head,
+        classes=CLASSES[: model.spec["num_classes"]],
+        torch_version=torch.__version__,
+        exported=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        **metadata,
+    )
+
+
+def export_model(model: XrayClassifier, path: Union[str, IO[bytes]], **metadata) -> Dict:
+    """Writes the TorchScript artifact of a model and returns its metadata
+
+    The metadata (architecture spec, input size, classes, versions and any keyword
+    arguments) is stored inside the file, so no Python model code is needed to serve it.
+    """
+
+    metadata = model_metadata(model, memory_format="channels_last", **metadata)
+    scripted = script_model(model)
+    torch.jit.save(scripted, path, _extra_files={METADATA_FILE: json.dumps(metadata)})
+    return metadata
+
+
+def load_scripted(
+    path: Union[str, IO[bytes]], optimize: bool = True
+) -> Tuple[torch.jit.ScriptModule, Dict]:
+    """Loads a TorchScript artifact and its metadata
+
+    optimize_for_inference fuses conv+relu and prepacks the weights for the kernels of
+    the machine it runs on. Its result cannot be saved, so it is applied on loading.
+    """
+
+    extra_files = {METADATA_FILE: ""}
+    model = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+    if optimize:
+        model = torch.jit.optimize_for_inference(model)
+    return model, json.loads(extra_files[METADATA_FILE])
+
+
+def export_onnx(
+    model: XrayClassifier, path: Union[str, IO[bytes]], opset: int = 13, **metadata
+) -> Dict:
+    """Writes the ONNX export of a model and returns its metadata
+
+    The batch dimension is dynamic, and so are height and width for the pooled heads.
+    The metadata is stored in the model's metadata_props, OnnxBackend reads it back.
+    """
+
+    import onnx
+
+    metadata = model_metadata(model, opset=opset, **metadata)
+    fused = fuse_model(model)
+    example = torch.rand(1, model.spec["in_channels"], model.input_size, model.input_size)
+    dynamic = {0: "batch"} if model.head == "flatten" else {0: "batch", 2: "height", 3: "width"}
+    options = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # newer torch defaults to the dynamo exporter, keep the TorchScript based one
+        options["dynamo"] = False
+    buffer = io.BytesIO()
+    with torch.no_grad():
+        torch.onnx.export(
+            fused,
+            example,
+            buffer,
+            input_names=["images"],
+            output_names=["logits"],
+            dynamic_axes={"images": dynamic, "logits": {0: "batch"}},
+            opset_version=opset,
+            do_constant_folding=True,
+            **options,
+        )
+    exported = onnx.load_from_string(buffer.getvalue())
+    entry = exported.metadata_props.add()
+    entry.key = ONNX_METADATA_KEY
+    entry.value = json.dumps(metadata)
+    onnx.checker.check_model(exported)
+    onnx.save(exported, path)
+    return metadata
+
+
+def compare_backends(reference: nn.Module, backends: Dict, loader: Iterable) -> Dict:
+    """Returns accuracy, latency per image and the largest logit difference to reference"""
+
+    results = {
+        name: {"correct": 0, "total": 0, "seconds": 0.0, "max_abs_diff": 0.0} for name in backends
+    }
+    reference.eval()
+    for images, labels in loader:
+        with torch.no_grad():
+            expected = reference(images).numpy()
+        images = images.numpy()
+        for name, backend in backends.items():
+            start = time.perf_counter()
+            logits = backend(images)
+            result = results[name]
+            result["seconds"] += time.perf_counter() - start
+            result["correct"] += int((logits.argmax(1) == labels.numpy()).sum())
+            result["total"] += len(labels)
+            diff = float(np.abs(logits - expected).max())
+            result["max_abs_diff"] = max(result["max_abs_diff"], diff)
+    return {
+        name: {
+            "accuracy": 100 * result["correct"] / max(1, result["total"]),
+            "latency_ms": 1000 * result["seconds"] / max(1, result["total"]),
+            "max_abs_diff": result["max_abs_diff"],
+        }
+        for name, result in results.items()
+    }
+
+
+def main() -> None:
+    """Exports the best checkpoint next to it as <name>_scripted.pt or <name>.onnx"""
+
+    BASE_DIR = os.getcwd()
+    config = OmegaConf.load(BASE_DIR + "/config/config.yaml")
+
+    parser = argparse.ArgumentParser(description="Export a checkpoint for inference")
+    parser.add_argument("--checkpoint", type=str, default=config.BEST_MODEL_PATH)
+    parser.add_argument(
+        "--format", type=str, default="torchscript", choices=["torchscript", "onnx"]
+    )
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--compare", action="store_true", help="compare on the validation split")
+    args = parser.parse_args()
+
+    model = model_from_checkpoint(torch.load(args.checkpoint, map_location="cpu")).eval()
+    stem = os.path.splitext(args.checkpoint)[0]
+    if args.format == "onnx":
+        output = args.output or stem + ".onnx"
+        export_onnx(model, output, checkpoint=args.checkpoint)
+        backend = OnnxBackend(output)
+    else:
+        output = args.output or stem + "_scripted.pt"
+        export_model(model, output, checkpoint=args.checkpoint)
+        backend = TorchBackend(*load_scripted(output))
+
+    x = torch.rand(1, model.spec["in_channels"], model.input_size, model.input_size)
+    with torch.no_grad():
+        error = np.abs(backend(x.numpy()) - model(x).numpy()).max()
+    print(f"[INFO] {args.format} model saved to {output} (max deviation {error:.2e})")
+
+    if args.compare:
+        dataset = Dataset_fetcher(
+            BASE_DIR + config.VALID_PATHS.images,
+            BASE_DIR + config.VALID_PATHS.labels,
+            transform=None,
+            resolution=model.input_size,
+            mmap=config.MMAP,
+        )
+        loader = DataLoader(
+            dataset, batch_size=config.BATCH_SIZE, collate_fn=dataset.collate_fn, shuffle=False
+        )
+        backends = {"torch": TorchBackend(model), args.format: backend}
+        report = compare_backends(model, backends, loader)
+        print(f"{'backend':>12} {'accuracy %':>12} {'ms/image':>10} {'max abs diff':>14}")
+        for name, result in report.items():
+            print(
+                f"{name:>12} {result['accuracy']:>12.2f} {result['latency_ms']:>10.2f}"
+                f" {result['max_abs_diff']:>14.2e}"
+            )
+        with open(os.path.splitext(output)[0] + "_report.json", "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+
+    main()
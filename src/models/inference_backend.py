@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module contains the interchangeable inference backends
+#         (src/deployment/inference_backend.py is an identical copy)
+######################################################################
+
+import json
+from typing import Dict, Optional, Union
+
+import numpy as np
+
+# key of the model metadata (spec, input size, head, classes) in ONNX exports
+ONNX_METADATA_KEY = "xray_metadata"
+BACKENDS = ["torch", "onnx"]
+
+
+class TorchBackend(object):
+    """Runs an eager, TorchScript or int8 PyTorch model"""
+
+    name = "torch"
+
+    def __init__(self, model, metadata: Optional[Dict] = None) -> None:
+        self.model = model.eval()
+        if metadata is None:
+            metadata = {"architecture": model.spec, "input_size": model.input_size}
+            metadata["head"] = model.head
+        self.metadata = metadata
+
+    def __call__(self, images: np.ndarray) -> np.ndarray:
+        """Returns the logits of a float32 batch of shape (N, 1, H, W)"""
+
+        import torch
+
+        with torch.no_grad():
+            return self.model(torch.as_tensor(images, dtype=torch.float32)).numpy()
+
+
+class OnnxBackend(object):
+    """Runs an ONNX export on onnxruntime's CPU execution provider, torch is not needed"""
+
+    name = "onnx"
+
+    def __init__(self, model: Union[str, bytes], threads: int = 0) -> None:
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            model, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.metadata = json.loads(metadata[ONNX_METADATA_KEY])
+
+    def __call__(self, images: np.ndarray) -> np.ndarray:
+        """Returns the logits of a float32 batch of shape (N, 1, H, W)"""
+
+        images = np.ascontiguousarray(images, dtype=np.float32)
+        return self.session.run(None, {self.input_name: images})[0]
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module benchmarks and tunes the DataLoader settings per machine
+######################################################################
+
+import argparse
+import itertools
+import json
+import os
+import socket
+import time
+from typing import Dict, List, Optional
+
+import omegaconf
+import torch
+from dataset_fetcher import Dataset_fetcher, batch_aug
+from omegaconf import OmegaConf
+from torch.utils.data import DataLoader, Subset
+
+# applied automatically from the machine override. BATCH_SIZE changes the optimization, so
+# the sweep only suggests it
+TUNED_KEYS = ["N_WORKERS", "PREFETCH_FACTOR", "PERSISTENT_WORKERS", "TORCH_THREADS"]
+
+
+def machine_config_path(config_dir: str = "config") -> str:
+    """Returns the file holding the tuned DataLoader settings of this machine"""
+
+    return os.path.join(config_dir, f"dataloader_{socket.gethostname()}.yaml")
+
+
+def load_machine_config(
+    config: omegaconf.dictconfig.DictConfig, config_dir: str = "config"
+) -> omegaconf.dictconfig.DictConfig:
+    """Overrides the DataLoader settings of config with the tuned ones of this machine
+
+    Only TUNED_KEYS are taken from the override, anything else in it is ignored.
+    """
+
+    path = machine_config_path(config_dir)
+    if not os.path.isfile(path):
+        return config
+    tuned = OmegaConf.load(path)
+    overrides = {key: tuned[key] for key in TUNED_KEYS if key in tuned}
+    ignored = sorted(set(tuned) - set(TUNED_KEYS))
+    if ignored:
+        print(f"[INFO] Ignoring {ignored} in {path}, only {TUNED_KEYS} are tuned per machine")
+    for key, value in overrides.items():
+        print(f"[INFO] {key}: {config.get(key)} -> {value} (tuned in {path})")
+    return OmegaConf.merge(config, OmegaConf.create(overrides))
+
+
+def loader_kwargs(
+    num_workers: int, prefetch_factor: int = 2, persistent_workers: bool = False
+) -> Dict:
+    """Returns the DataLoader arguments, the worker options only apply with workers"""
+
+    if num_workers == 0:
+        return {"num_workers": 0}
+    return {
+        "num_workers": num_workers,
+        "prefetch_factor": prefetch_factor,
+        "persistent_workers": persistent_workers,
+    }
+
+
+def _tree_rss(process) -> int:
+    """RSS of a process and its DataLoader workers; shared pages are counted per process"""
+
+    total = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            total += child.memory_info().rss
+        except Exception:
+            # the worker exited in the meantime
+            pass
+    return total
+
+
+def benchmark(
+    dataset: Dataset_fetcher,
+    num_workers: int,
+    batch_size: int,
+    prefetch_factor: int = 2,
+    persistent_workers: bool = False,
+    torch_threads: int = 0,
+    epochs: int = 2,
+) -> Dict:
+    """Iterates `epochs` times over dataset and returns samples/sec and the peak RSS
+
+    Several epochs are timed so that worker start-up and persistent_workers are part of
+    the measurement.
+    """
+
+    import psutil
+
+    default_threads = torch.get_num_threads()
+    if torch_threads:
+        torch.set_num_threads(torch_threads)
+    process = psutil.Process()
+    loader = DataLoader(
+        dataset,
+        shuffle=True,
+        batch_size=batch_size,
+        collate_fn=dataset.collate_fn,
+        **loader_kwargs(num_workers, prefetch_factor, persistent_workers),
+    )
+
+    samples = 0
+    peak_rss = _tree_rss(process)
+    start = time.perf_counter()
+    try:
+        for _ in range(epochs):
+            for images, _ in loader:
+                samples += len(images)
+                peak_rss = max(peak_rss, _tree_rss(process))
+    finally:
+        elapsed = time.perf_counter() - start
+        del loader
+        torch.set_num_threads(default_threads)
+
+    return {
+        "N_WORKERS": num_workers,
+        "BATCH_SIZE": batch_size,
+        "PREFETCH_FACTOR": prefetch_factor,
+        "PERSISTENT_WORKERS": persistent_workers,
+        "TORCH_THREADS": torch_threads,
+        "samples_per_sec": samples / max(elapsed, 1e-9),
+        "peak_rss_mb": peak_rss / 2**20,
+    }
+
+
+def sweep(
+    dataset: Dataset_fetcher,
+    workers: List[int],
+    batch_sizes: List[int],
+    prefetch_factors: List[int],
+    persistent: List[bool],
+    threads: List[int],
+    epochs: int = 2,
+) -> List[Dict]:
+    """Benchmarks every combination, worker-only options are skipped without workers"""
+
+    results = []
+    for (
+        num_workers,
+        batch_size,
+        prefetch_factor,
+        persistent_workers,
+        torch_threads,
+    ) in itertools.product(workers, batch_sizes, prefetch_factors, persistent, threads):
+        if num_workers == 0 and (prefetch_factor != prefetch_factors[0] or persistent_workers):
+            continue
+        result = benchmark(
+            dataset,
+            num_workers,
+            batch_size,
+            prefetch_factor,
+            persistent_workers,
+            torch_threads,
+            epochs,
+        )
+        print(
+            f"workers={num_workers:<3} batch={batch_size:<4} prefetch={prefetch_factor:<2}"
+            f" persistent={persistent_workers!s:<5} threads={torch_threads:<3}"
+            f" {result['samples_per_sec']:8.1f} samples/sec {result['peak_rss_mb']:8.0f} MB"
+        )
+        results.append(result)
+    return results
+
+
+def best_result(results: List[Dict], max_rss_mb: Optional[float] = None) -> Dict:
+    """Returns the fastest setting that stays within the memory budget"""
+
+    within = [r for r in results if max_rss_mb is None or r["peak_rss_mb"] <= max_rss_mb]
+    if not within:
+        raise ValueError(f"No setting stays below {max_rss_mb} MB")
+    return max(within, key=lambda r: r["samples_per_sec"])
+
+
+def write_machine_config(result: Dict, config_dir: str = "config") -> str:
+    """Writes the settings of a benchmark result as the override for this machine"""
+
+    path = machine_config_path(config_dir)
+    with open(path, "w") as f:
+        f.write(
+            f"# written by src/models/loader_tuning.py on {time.strftime('%Y-%m-%d %H:%M')}:"
+            f" {result['samples_per_sec']:.1f} samples/sec, {result['peak_rss_mb']:.0f} MB\n"
+            f"# measured with BATCH_SIZE {result['BATCH_SIZE']}, which is not applied:"
+            " set it in config.yaml to use it\n"
+        )
+        f.write(OmegaConf.to_yaml(OmegaConf.create({key: result[key] for key in TUNED_KEYS})))
+    return path
+
+
+def _int_list(text: str) -> List[int]:
+    return [int(value) for value in text.split(",")]
+
+
+def main() -> None:
+    """Sweeps the DataLoader settings on the training split and stores the best ones"""
+
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Benchmark and tune the DataLoader settings")
+    parser.add_argument("--workers", type=_int_list, default=sorted({0, 1, 2, 4, cpus}))
+    parser.add_argument("--batch-sizes", type=_int_list, default=[16, 32, 64])
+    parser.add_argument("--prefetch-factors", type=_int_list, default=[2, 4])
+    parser.add_argument("--threads", type=_int_list, default=sorted({1, cpus}))
+    parser.add_argument("--samples", type=int, default=512, help="samples per epoch to time")
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--max-rss-mb", type=float, default=None, help="memory budget")
+    parser.add_argument("--dry-run", action="store_true", help="do not write the override")
+    args = parser.parse_args()
+
+    BASE_DIR = os.getcwd()
+    config = OmegaConf.load(BASE_DIR + "/config/config.yaml")
+    augmentation = {"transform": None, "batch_transform": batch_aug}
+    dataset = Dataset_fetcher(
+        BASE_DIR + config.TRAIN_PATHS.images,
+        BASE_DIR + config.TRAIN_PATHS.labels,
+        resolution=config.RESOLUTION,
+        mmap=config.MMAP,
+        **(augmentation if config.BATCH_AUGMENTATION else {}),
+    )
+    if args.samples < len(dataset):
+        dataset = Subset(dataset, range(args.samples))
+        dataset.collate_fn = dataset.dataset.collate_fn
+
+    results = sweep(
+        dataset,
+        args.workers,
+        args.batch_sizes,
+        args.prefetch_factors,
+        [False, True],
+        args.threads,
+        args.epochs,
+    )
+    best = best_result(results, args.max_rss_mb)
+    print(f"[INFO] Best: {json.dumps(best)}")
+    print(f"[INFO] Suggested BATCH_SIZE: {best['BATCH_SIZE']} (not applied automatically)")
+    if not args.dry_run:
+        print(f"[INFO] Suggested settings written to {write_machine_config(best)}")
+
+
+if __name__ == "__main__":
+
+    main()
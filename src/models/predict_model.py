@@ -22,8 +22,11 @@ import torch
 import wandb
 from cloud_functions import loadCheckpointFromGCP
 from dataset_fetcher import Dataset_fetcher
+from export_model import load_scripted
+from inference_backend import OnnxBackend, TorchBackend
 from matplotlib import pyplot as plt
 from omegaconf import OmegaConf
+from prefetcher import BatchPrefetcher
 from torch import nn
 from tqdm import tqdm
 
@@ -35,16 +38,16 @@ def get_model_from_checkpoint(
 ) -> nn.Module:
     """Returns a loaded model from checkpoint"""
 
-    from model_architecture import XrayClassifier
+    from model_architecture import model_from_checkpoint
 
-    model = XrayClassifier()
     if cloudModel:
         print("[INFO] Load model from cloud...")
         checkpoint = loadCheckpointFromGCP(config)
     else:
         print("[INFO] Load model from disk...")
         checkpoint = torch.load(config.BEST_MODEL_PATH)
-    model.load_state_dict(checkpoint["model_state_dict"])
+    # rebuilt from the architecture spec stored in the checkpoint
+    model = model_from_checkpoint(checkpoint)
     return model
 
 
@@ -101,26 +104,43 @@ def inference(model: nn.Module = None, load_model: bool = False) -> None:
         "labels": BASE_DIR + config.VALID_PATHS.labels,
     }
 
+    if config.INFERENCE_BACKEND == "onnx":
+        # ONNX export of export_model.py on onnxruntime
+        backend = OnnxBackend(config.ONNX_MODEL_PATH)
+    elif config.SCRIPTED_MODEL_PATH:
+        # frozen TorchScript artifact written by export_model.py, no model code needed
+        backend = TorchBackend(*load_scripted(config.SCRIPTED_MODEL_PATH))
+    else:
+        if load_model:
+            # Loading saved model
+            model = get_model_from_checkpoint(config)
+        backend = TorchBackend(model)
+    input_size = backend.metadata["input_size"]
+
     log.info("[INFO] Load dataset from disk...")
-    validation_set = Dataset_fetcher(VALID_PATHS["images"], VALID_PATHS["labels"])
+    validation_set = Dataset_fetcher(
+        VALID_PATHS["images"],
+        VALID_PATHS["labels"],
+        resolution=input_size,
+        mmap=config.MMAP,
+    )
 
     log.info("[INFO] Prepare dataloader...")
     validationloader = torch.utils.data.DataLoader(
-        validation_set, shuffle=False, num_workers=N_WORKERS, batch_size=BATCH_SIZE
+        validation_set,
+        shuffle=False,
+        num_workers=N_WORKERS,
+        batch_size=BATCH_SIZE,
+        collate_fn=validation_set.collate_fn,
     )
 
     classes = ("covid", "normal", "pneumonia")
 
-    if load_model:
-        # Loading saved model
-        model = get_model_from_checkpoint(config)
-
-    wandb.watch(model, log_freq=100)
+    if isinstance(backend, TorchBackend) and not isinstance(backend.model, torch.jit.ScriptModule):
+        wandb.watch(backend.model, log_freq=100)
 
     # Disable gradient tracking
     with torch.no_grad():
-        model.eval()
-
         correct = 0
         total = 0
 
@@ -130,13 +150,15 @@ def inference(model: nn.Module = None, load_model: bool = False) -> None:
         correct_pred = {classname: 0 for classname in classes}
         total_pred = {classname: 0 for classname in classes}
 
-        with tqdm(validationloader) as progress_bar:
+        with tqdm(
+            BatchPrefetcher(validationloader, config.PREFETCH_BATCHES, config.PIN_MEMORY)
+        ) as progress_bar:
             for i, (images, labels) in enumerate(progress_bar, 1):
 
                 progress_bar.set_description("[INFO] Running inference...")
 
                 # Generate prediction
-                output = model(images)
+                output = torch.from_numpy(backend(images.numpy()))
                 print(images.shape)
                 # Predicted class value
                 _, predicted = torch.max(output.data, 1)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module contains the background batch prefetcher
+######################################################################
+
+import queue
+import threading
+import time
+from typing import Dict, Iterable, Iterator, Sequence
+
+import torch
+
+
+class BatchPrefetcher(object):
+    """Pulls batches from a DataLoader in a background thread, up to `depth` batches ahead
+
+    This only overlaps loading with the consumer: the batches are the DataLoader's own
+    tensors, nothing is copied or reused. With pin_memory set and CUDA available the
+    background thread also moves them to page-locked memory, which takes one copy per
+    batch but keeps it off the training loop.
+
+    wait_time is the time the consumer spent waiting for data, load_time the time the
+    background thread spent waiting for the DataLoader. A high wait_time compared to the
+    time per step means training is input bound.
+    """
+
+    def __init__(self, loader: Iterable, depth: int = 2, pin_memory: bool = False) -> None:
+        self.loader = loader
+        self.depth = max(1, depth)
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        """Sets the counters back to zero, e.g. at the start of an epoch"""
+
+        self.batches = 0
+        self.wait_time = 0.0
+        self.load_time = 0.0
+
+    def stats(self) -> Dict[str, float]:
+        """Returns the counters"""
+
+        return {
+            "batches": self.batches,
+            "wait_time": self.wait_time,
+            "load_time": self.load_time,
+            "wait_per_batch": self.wait_time / max(1, self.batches),
+        }
+
+    def __len__(self) -> int:
+        return len(self.loader)
+
+    def _pin(self, batch: Sequence) -> Sequence:
+        if not self.pin_memory:
+            return batch
+        return [
+            element.pin_memory() if isinstance(element, torch.Tensor) else element
+            for element in batch
+        ]
+
+    def _produce(self, ready: queue.Queue, stop: threading.Event) -> None:
+        def put(item) -> bool:
+            # blocks while depth batches are ahead of the consumer, unless it stopped
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            iterator = iter(self.loader)
+            while True:
+                start = time.perf_counter()
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    break
+                self.load_time += time.perf_counter() - start
+                if not put((True, self._pin(batch))):
+                    return
+        except Exception as error:
+            put((False, error))
+            return
+        put((False, None))
+
+    def __iter__(self) -> Iterator:
+        ready: queue.Queue = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(ready, stop), daemon=True)
+        thread.start()
+
+        try:
+            while True:
+                start = time.perf_counter()
+                ok, batch = ready.get()
+                self.wait_time += time.perf_counter() - start
+                if not ok:
+                    if batch is not None:
+                        raise batch
+                    return
+                self.batches += 1
+                yield tuple(batch)
+        finally:
+            # unblocks the producer if the consumer stops early
+            stop.set()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module prunes conv filters and reports the accuracy/cost trade-off
+######################################################################
+
+import argparse
+import json
+import os
+import time
+from typing import Dict, Iterable, List
+
+import matplotlib.pyplot as plt
+import torch
+from convert_head import evaluate
+from dataset_fetcher import Dataset_fetcher
+from model_architecture import XrayClassifier, model_from_checkpoint, output_size
+from omegaconf import OmegaConf
+from torch import nn, optim
+from torch.utils.data import DataLoader
+
+CRITERIA = ["bn", "l1"]
+
+
+def filter_scores(model: XrayClassifier, block: int, criterion: str = "bn") -> torch.Tensor:
+    """Returns the importance of every filter of a conv block
+
+    "bn" uses |gamma| of the block's batch norm, which scales the filter's output
+    directly; blocks without batch norm fall back to "l1", the L1 norm of the filter.
+    """
+
+    if criterion not in CRITERIA:
+        raise ValueError(f"Unknown criterion {criterion}, expected one of {CRITERIA}")
+    if criterion == "bn" and model.spec["batch_norm"][block - 1]:
+        return getattr(model, f"bn{block}").weight.detach().abs()
+    return getattr(model, f"conv{block}").weight.detach().abs().sum(dim=(1, 2, 3))
+
+
+def prune_model(model: XrayClassifier, ratio: float, criterion: str = "bn") -> XrayClassifier:
+    """Returns a smaller copy without the lowest ranked `ratio` of filters of every block
+
+    The kept filters are copied into a model built from the pruned spec, together with
+    the matching input channels of the next conv, the batch norm entries and the fc
+    weights of the kept channels. At least one filter per block is kept.
+    """
+
+    keep = []
+    for block, width in enumerate(model.spec["widths"], 1):
+        count = max(1, int(round(width * (1 - ratio))))
+        scores = filter_scores(model, block, criterion)
+        keep.append(torch.sort(torch.topk(scores, count).indices).values)
+
+    pruned = XrayClassifier(spec=dict(model.spec, widths=[len(k) for k in keep]))
+    source = model.state_dict()
+    state = {}
+    previous = torch.arange(model.spec["in_channels"])
+    for block, kept in enumerate(keep, 1):
+        state[f"conv{block}.weight"] = source[f"conv{block}.weight"][kept][:, previous]
+        state[f"conv{block}.bias"] = source[f"conv{block}.bias"][kept]
+        for name in ["weight", "bias", "running_mean", "running_var"]:
+            state[f"bn{block}.{name}"] = source[f"bn{block}.{name}"][kept]
+        state[f"bn{block}.num_batches_tracked"] = source[f"bn{block}.num_batches_tracked"]
+        previous = kept
+
+    weight = source["fc.weight"]
+    channels = model.spec["widths"][-1]
+    if model.head == "flatten":
+        # fc sees channel-major flattened maps: drop whole channel slices
+        weight = weight.view(len(weight), channels, -1)[:, previous].reshape(len(weight), -1)
+    elif model.head == "avgmax":
+        weight = weight[:, torch.cat([previous, previous + channels])]
+    else:
+        weight = weight[:, previous]
+    state["fc.weight"] = weight
+    state["fc.bias"] = source["fc.bias"]
+    pruned.load_state_dict(state)
+    return pruned.train(model.training)
+
+
+def count_flops(spec: Dict) -> int:
+    """Multiply-accumulates of one forward pass at spec["input_size"]"""
+
+    size = spec["input_size"]
+    padding = spec["kernel_size"] // 2
+    in_channels = spec["in_channels"]
+    flops = 0
+    for width, stride, pool in zip(spec["widths"], spec["strides"], spec["pools"]):
+        size = (size + 2 * padding - spec["kernel_size"]) // stride + 1
+        flops += size * size * width * in_channels * spec["kernel_size"] ** 2
+        if pool:
+            size //= 2
+        in_channels = width
+    if spec["head"] == "flatten":
+        features = in_channels * output_size(spec) ** 2
+    else:
+        features = 2 * in_channels if spec["head"] == "avgmax" else in_channels
+    return flops + features * spec["num_classes"]
+
+
+def fine_tune(
+    model: XrayClassifier, loader: Iterable, epochs: int = 1, learning_rate: float = 1e-4
+) -> None:
+    """Trains the whole pruned model for a few epochs to recover accuracy"""
+
+    criterion = nn.CrossEntropyLoss()
+    optimizer = optim.Adam(model.parameters(), lr=learning_rate)
+    model.train()
+    for _ in range(epochs):
+        for images, labels in loader:
+            optimizer.zero_grad(set_to_none=True)
+            loss = criterion(model(images), labels)
+            loss.backward()
+            optimizer.step()
+    model.eval()
+
+
+def plot_curve(results: List[Dict], path: str) -> None:
+    """Plots accuracy against FLOPs and latency for the pruning ratios"""
+
+    fig, axes = plt.subplots(1, 2, figsize=(10, 4))
+    for ax, key, label in [
+        (axes[0], "mflops", "MFLOPs per image"),
+        (axes[1], "latency_ms", "ms per image"),
+    ]:
+        ax.plot([r[key] for r in results], [r["accuracy"] for r in results], marker="o")
+        for result in results:
+            ax.annotate(f"{result['ratio']:.0%}", (result[key], result["accuracy"]))
+        ax.set_xlabel(label)
+        ax.set_ylabel("validation accuracy %")
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+
+
+def main() -> None:
+    """Prunes the best checkpoint at several ratios and reports the trade-off curve"""
+
+    BASE_DIR = os.getcwd()
+    config = OmegaConf.load(BASE_DIR + "/config/config.yaml")
+
+    parser = argparse.ArgumentParser(description="Structured filter pruning")
+    parser.add_argument("--checkpoint", type=str, default=config.BEST_MODEL_PATH)
+    parser.add_argument("--ratios", type=float, nargs="*", default=[0.0, 0.25, 0.5, 0.75])
+    parser.add_argument("--criterion", type=str, default="bn", choices=CRITERIA)
+    parser.add_argument("--epochs", type=int, default=0, help="fine-tuning epochs per ratio")
+    parser.add_argument("--learning-rate", type=float, default=1e-4)
+    parser.add_argument("--report-dir", type=str, default="reports/figures")
+    args = parser.parse_args()
+
+    model = model_from_checkpoint(torch.load(args.checkpoint, map_location="cpu")).eval()
+
+    def loader(paths, shuffle):
+        dataset = Dataset_fetcher(
+            BASE_DIR + paths.images,
+            BASE_DIR + paths.labels,
+            transform=None,
+            resolution=model.input_size,
+            mmap=config.MMAP,
+        )
+        return DataLoader(
+            dataset,
+            shuffle=shuffle,
+            num_workers=config.N_WORKERS,
+            batch_size=config.BATCH_SIZE,
+            collate_fn=dataset.collate_fn,
+        )
+
+    validation = loader(config.VALID_PATHS, False)
+    training = loader(config.TRAIN_PATHS, True) if args.epochs else None
+
+    results = []
+    stem = os.path.splitext(args.checkpoint)[0]
+    print(f"{'ratio':>6} {'widths':>18} {'MFLOPs':>10} {'accuracy %':>12} {'ms/image':>10}")
+    for ratio in args.ratios:
+        pruned = prune_model(model, ratio, args.criterion)
+        if args.epochs:
+            fine_tune(pruned, training, args.epochs, args.learning_rate)
+        result = dict(
+            ratio=ratio,
+            widths=pruned.spec["widths"],
+            mflops=count_flops(pruned.spec) / 1e6,
+            **evaluate(pruned, validation),
+        )
+        results.append(result)
+        print(
+            f"{ratio:>6.2f} {str(result['widths']):>18} {result['mflops']:>10.1f}"
+            f" {result['accuracy']:>12.2f} {result['latency_ms']:>10.2f}"
+        )
+        torch.save(
+            {"architecture": pruned.spec, "model_state_dict": pruned.state_dict()},
+            f"{stem}_pruned_{int(round(100 * ratio))}.pth",
+        )
+
+    os.makedirs(args.report_dir, exist_ok=True)
+    name = time.strftime("pruning_%Y%m%dT%H%M%S")
+    with open(os.path.join(args.report_dir, name + ".json"), "w") as f:
+        json.dump(
+            {"checkpoint": args.checkpoint, "criterion": args.criterion, "results": results},
+            f,
+            indent=2,
+        )
+    plot_curve(results, os.path.join(args.report_dir, name + ".png"))
+    print(f"[INFO] Pruning report written to {os.path.join(args.report_dir, name)}.json/.png")
+
+
+if __name__ == "__main__":
+
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module quantizes trained models to int8 for CPU serving
+######################################################################
+
+import argparse
+import itertools
+import json
+import os
+from typing import Iterable
+
+import torch
+from convert_head import evaluate
+from dataset_fetcher import Dataset_fetcher
+from model_architecture import (
+    QuantizedXrayClassifier,
+    XrayClassifier,
+    convert_quantization,
+    model_from_checkpoint,
+    prepare_quantization,
+    quantization_backend,
+)
+from omegaconf import OmegaConf
+from torch.utils.data import DataLoader
+
+
+def quantize(
+    model: XrayClassifier,
+    calibration: Iterable,
+    batches: int = 16,
+    backend: str = None,
+) -> QuantizedXrayClassifier:
+    """Returns the int8 model: static convs calibrated on `batches` batches, dynamic fc"""
+
+    prepared = prepare_quantization(model.eval(), backend or quantization_backend())
+    with torch.no_grad():
+        for images, _ in itertools.islice(calibration, batches):
+            prepared(images)
+    return convert_quantization(prepared)
+
+
+def main() -> None:
+    """Quantizes the best checkpoint and compares it with fp32 on the test split"""
+
+    BASE_DIR = os.getcwd()
+    config = OmegaConf.load(BASE_DIR + "/config/config.yaml")
+
+    parser = argparse.ArgumentParser(description="Post-training int8 quantization")
+    parser.add_argument("--checkpoint", type=str, default=config.BEST_MODEL_PATH)
+    parser.add_argument("--calibration-batches", type=int, default=16)
+    parser.add_argument("--backend", type=str, default=None, choices=["fbgemm", "qnnpack"])
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    checkpoint = torch.load(args.checkpoint, map_location="cpu")
+    if "quantization" in checkpoint:
+        parser.error(f"{args.checkpoint} is already quantized")
+    model = model_from_checkpoint(checkpoint).eval()
+
+    def loader(paths):
+        dataset = Dataset_fetcher(
+            BASE_DIR + paths.images,
+            BASE_DIR + paths.labels,
+            transform=None,
+            resolution=model.input_size,
+            mmap=config.MMAP,
+        )
+        return DataLoader(
+            dataset,
+            shuffle=False,
+            num_workers=config.N_WORKERS,
+            batch_size=config.BATCH_SIZE,
+            collate_fn=dataset.collate_fn,
+        )
+
+    # calibrated on validation images and evaluated on the test split, evaluating on the
+    # calibration images would make the int8 accuracy look better than it is
+    backend = args.backend or quantization_backend()
+    print(f"[INFO] Calibrating on {args.calibration_batches} validation batches ({backend})...")
+    quantized = quantize(model, loader(config.VALID_PATHS), args.calibration_batches, backend)
+
+    print("[INFO] Evaluating fp32 and int8 on the test split...")
+    test = loader(config.TEST_PATHS)
+    report = {
+        "checkpoint": args.checkpoint,
+        "backend": backend,
+        "calibration_split": "valid",
+        "calibration_batches": args.calibration_batches,
+        "evaluation_split": "test",
+        "fp32": evaluate(model, test),
+        "int8": evaluate(quantized, test),
+    }
+    print(f"{'model':>10} {'accuracy %':>12} {'ms/image':>10} {'MB':>8}")
+    for name in ["fp32", "int8"]:
+        result = report[name]
+        print(
+            f"{name:>10} {result['accuracy']:>12.2f} {result['latency_ms']:>10.2f}"
+            f" {result['size_mb']:>8.2f}"
+        )
+
+    output = args.output or os.path.splitext(args.checkpoint)[0] + "_int8.pth"
+    torch.save(
+        {
+            "epoch": checkpoint.get("epoch"),
+            "architecture": model.spec,
+            "quantization": {"backend": backend, "convs": "static", "fc": "dynamic"},
+            "model_state_dict": quantized.state_dict(),
+        },
+        output,
+    )
+    with open(os.path.splitext(output)[0] + "_report.json", "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"[INFO] Quantized model saved to {output}")
+
+
+if __name__ == "__main__":
+
+    main()
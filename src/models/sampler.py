@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module contains the class-balanced sampling working on labels only
+######################################################################
+
+from typing import Iterator, Optional, Sequence
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+SAMPLING_MODES = ["balanced", "weighted"]
+
+
+def class_shares(
+    num_classes: int, mode: str = "balanced", class_weights: Optional[Sequence[float]] = None
+) -> np.ndarray:
+    """Returns the fraction of an epoch that is drawn from every class
+
+    "balanced" draws every class equally often, "weighted" in proportion to class_weights.
+    """
+
+    if mode == "balanced":
+        weights = np.ones(num_classes)
+    elif mode == "weighted":
+        if class_weights is None or len(class_weights) != num_classes:
+            raise ValueError(f"weighted sampling needs {num_classes} class weights")
+        weights = np.asarray(class_weights, dtype=np.float64)
+    else:
+        raise ValueError(f"Unknown sampling mode {mode}, expected one of {SAMPLING_MODES}")
+    if (weights < 0).any() or weights.sum() <= 0:
+        raise ValueError("class weights must be non-negative and not all zero")
+    return weights / weights.sum()
+
+
+def repeat_factors(
+    labels: torch.Tensor, mode: str = "balanced", class_weights: Optional[Sequence[float]] = None
+) -> np.ndarray:
+    """Returns how often every class has to be seen per epoch to reach its share
+
+    The factors keep the expected epoch length at len(labels): above 1 a class is
+    oversampled, below 1 it is subsampled.
+    """
+
+    labels = np.asarray(labels)
+    counts = np.bincount(labels)
+    shares = class_shares(len(counts), mode, class_weights)
+    # classes without samples cannot be drawn
+    return np.divide(shares * len(labels), counts, out=np.zeros(len(counts)), where=counts > 0)
+
+
+class ClassBalancedSampler(Sampler):
+    """Draws class-balanced or class-weighted epochs from the labels alone
+
+    The indices are grouped into per-class buckets once, with a single stable sort.
+    Every epoch first draws the class of each of the num_samples positions, then walks
+    through a fresh permutation of each class bucket. So a class is only repeated
+    once all of its samples were drawn, and subsampled classes get different samples
+    every epoch. No image is read: unlike MAX_PER_CLASS in data.yaml, nothing is
+    discarded at preprocessing time.
+
+    The epoch only depends on seed and epoch. Under torch.distributed, every rank draws
+    the same epoch and keeps every world_size-th index, as DistributedSampler does.
+    Call set_epoch before every epoch.
+    """
+
+    def __init__(
+        self,
+        labels: torch.Tensor,
+        mode: str = "balanced",
+        class_weights: Optional[Sequence[float]] = None,
+        num_samples: Optional[int] = None,
+        seed: int = 0,
+        rank: Optional[int] = None,
+        world_size: Optional[int] = None,
+    ) -> None:
+        labels = np.asarray(labels).astype(np.int64)
+        self.labels = labels
+        self.class_counts = np.bincount(labels)
+        self.offsets = np.concatenate([[0], np.cumsum(self.class_counts)[:-1]])
+        self.shares = class_shares(len(self.class_counts), mode, class_weights)
+        if (self.shares[self.class_counts == 0] > 0).any():
+            raise ValueError("a class without samples has a non-zero share")
+
+        if rank is None or world_size is None:
+            distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+            rank = torch.distributed.get_rank() if distributed else 0
+            world_size = torch.distributed.get_world_size() if distributed else 1
+        self.rank = rank
+        self.world_size = world_size
+        # every rank gets the same number of samples
+        num_samples = len(labels) if num_samples is None else num_samples
+        self.num_samples = -(-num_samples // world_size)
+        self.total_size = self.num_samples * world_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        """Selects the draw of an epoch"""
+
+        self.epoch = epoch
+
+    def epoch_indices(self) -> np.ndarray:
+        """Returns the indices of the current epoch over all ranks"""
+
+        rng = np.random.default_rng([self.seed, self.epoch])
+        # class buckets in a fresh random order: sorted by label, ties by a random key
+        buckets = np.lexsort((rng.random(len(self.labels)), self.labels))
+        classes = rng.choice(len(self.shares), size=self.total_size, p=self.shares)
+
+        # n-th draw of a class takes the n-th entry of its bucket, wrapping around
+        order = np.argsort(classes, kind="stable")
+        starts = np.searchsorted(classes[order], np.arange(len(self.shares)))
+        draw = np.empty(self.total_size, dtype=np.int64)
+        draw[order] = np.arange(self.total_size) - starts[classes[order]]
+        return buckets[self.offsets[classes] + draw % np.maximum(self.class_counts[classes], 1)]
+
+    def __iter__(self) -> Iterator[int]:
+        indices = self.epoch_indices()[self.rank :: self.world_size]
+        return iter(indices.tolist())
+
+    def __len__(self) -> int:
+        return self.num_samples
@@ -20,9 +20,13 @@ import numpy as np
 import torch
 import torchvision
 from cloud_functions import uploadModelwithTimestamp
-from dataset_fetcher import Dataset_fetcher
-from model_architecture import XrayClassifier
+from dataset_fetcher import Dataset_fetcher, Dataset_streamer, batch_aug
+from distillation import WithTeacherLogits, distillation_loss, teacher_logits
+from loader_tuning import load_machine_config, loader_kwargs
+from model_architecture import XrayClassifier, architecture_spec
 from omegaconf import OmegaConf
+from prefetcher import BatchPrefetcher
+from sampler import ClassBalancedSampler
 from torch import nn, optim
 
 import matplotlib.pyplot as plt
@@ -40,6 +44,9 @@ def train() -> None:
 
     # Load config file
     config = OmegaConf.load(BASE_DIR + "/config/config.yaml")
+    config = load_machine_config(config, BASE_DIR + "/config")
+    if config.TORCH_THREADS:
+        torch.set_num_threads(config.TORCH_THREADS)
 
     # Initialize logging with wandb and track conf settings
     WANDB_API = os.getenv("WANDB_API")
@@ -77,19 +84,105 @@ def train() -> None:
         ]
     )
 
-    training_set = Dataset_fetcher(TRAIN_PATHS["images"], TRAIN_PATHS["labels"])
-    testing_set = Dataset_fetcher(TEST_PATHS["images"], TEST_PATHS["labels"])
+    # balancing by repetition in the streamer or by a sampler over the labels
+    sampling = None if config.SAMPLER == "shuffle" else config.SAMPLER
+    class_weights = list(config.CLASS_WEIGHTS) or None
+
+    # either the per-sample data_aug of Dataset_fetcher or batch_aug on the collated batch
+    augmentation = {}
+    if config.BATCH_AUGMENTATION:
+        augmentation = {"transform": None, "batch_transform": batch_aug}
+
+    if config.DATASET_MODE == "stream":
+        # sequential block reads with a bounded shuffle buffer for data larger than memory
+        training_set = Dataset_streamer(
+            TRAIN_PATHS["images"],
+            TRAIN_PATHS["labels"],
+            resolution=config.RESOLUTION,
+            shuffle_buffer=config.SHUFFLE_BUFFER,
+            block_size=config.STREAM_BLOCK_SIZE,
+            seed=1,
+            sampling=sampling,
+            class_weights=class_weights,
+            **augmentation,
+        )
+    elif config.AUGMENTED_CACHE:
+        # variants written ahead of time by augment_cache.py, no augmentation while training
+        training_set = Dataset_fetcher(
+            TRAIN_PATHS["images"],
+            TRAIN_PATHS["labels"],
+            transform=None,
+            resolution=config.RESOLUTION,
+            augmented_dir=BASE_DIR + config.AUGMENTED_CACHE,
+            seed=1,
+        )
+    else:
+        training_set = Dataset_fetcher(
+            TRAIN_PATHS["images"],
+            TRAIN_PATHS["labels"],
+            resolution=config.RESOLUTION,
+            mmap=config.MMAP,
+            **augmentation,
+        )
+    testing_set = Dataset_fetcher(
+        TEST_PATHS["images"],
+        TEST_PATHS["labels"],
+        resolution=config.RESOLUTION,
+        mmap=config.MMAP,
+        **augmentation,
+    )
+
+    if config.TEACHER_CHECKPOINT:
+        if isinstance(training_set, Dataset_streamer):
+            raise ValueError("distillation needs the sample indices, use DATASET_MODE map")
+        # computed once and cached, the teacher never runs in the training loop
+        training_set = WithTeacherLogits(
+            training_set,
+            teacher_logits(
+                BASE_DIR + "/" + config.TEACHER_CHECKPOINT,
+                TRAIN_PATHS["images"],
+                TRAIN_PATHS["labels"],
+                BASE_DIR + "/" + config.TEACHER_LOGITS_DIR,
+                num_workers=N_WORKERS,
+            ),
+        )
+
+    sampler = None
+    if sampling is not None and not isinstance(training_set, Dataset_streamer):
+        sampler = ClassBalancedSampler(training_set.labels, sampling, class_weights, seed=1)
 
     print("[INFO] Prepare dataloaders...")
     trainloader = torch.utils.data.DataLoader(
-        training_set, shuffle=True, num_workers=N_WORKERS, batch_size=BATCH_SIZE
+        training_set,
+        # the streamer shuffles by itself, DataLoader does not allow it for iterable datasets
+        shuffle=sampler is None and not isinstance(training_set, Dataset_streamer),
+        sampler=sampler,
+        batch_size=BATCH_SIZE,
+        collate_fn=training_set.collate_fn,
+        **loader_kwargs(N_WORKERS, config.PREFETCH_FACTOR, config.PERSISTENT_WORKERS),
     )
     testloader = torch.utils.data.DataLoader(
-        testing_set, shuffle=False, num_workers=N_WORKERS, batch_size=BATCH_SIZE
+        testing_set,
+        shuffle=False,
+        batch_size=BATCH_SIZE,
+        collate_fn=testing_set.collate_fn,
+        **loader_kwargs(N_WORKERS, config.PREFETCH_FACTOR, config.PERSISTENT_WORKERS),
     )
 
+    # loads batches in the background and measures the time spent waiting for data
+    train_batches = BatchPrefetcher(trainloader, config.PREFETCH_BATCHES, config.PIN_MEMORY)
+    test_batches = BatchPrefetcher(testloader, config.PREFETCH_BATCHES, config.PIN_MEMORY)
+
     print("[INFO] Building network...")
-    model = XrayClassifier(num_classes=3, dropout_probability=DROPOUT_PROBABILITY)
+    spec = architecture_spec(
+        config.ARCHITECTURE,
+        num_classes=3,
+        dropout=DROPOUT_PROBABILITY,
+        input_size=config.RESOLUTION,
+        head=config.HEAD,
+        **OmegaConf.to_container(config.ARCHITECTURE_OVERRIDES),
+    )
+    model = XrayClassifier(spec=spec)
     wandb.watch(model, log_freq=100)
 
     criterion = nn.CrossEntropyLoss()
@@ -100,15 +193,29 @@ def train() -> None:
     for epoch in range(EPOCHS):
         # Training Loop Start
         model.train()
+        training_set.set_epoch(epoch)
+        if sampler is not None:
+            sampler.set_epoch(epoch)
+        train_batches.reset_stats()
+        epoch_start = time.time()
 
         losses = []
         correct = 0
         total = 0
 
-        for images, labels in trainloader:
+        for images, labels, *teacher in train_batches:
             optimizer.zero_grad(set_to_none=True)
             output = model(images)
-            loss = criterion(output, labels)
+            if teacher:
+                loss = distillation_loss(
+                    output,
+                    teacher[0],
+                    labels,
+                    config.DISTILL_TEMPERATURE,
+                    config.DISTILL_ALPHA,
+                )
+            else:
+                loss = criterion(output, labels)
 
             loss.backward()
             optimizer.step()
@@ -122,13 +229,18 @@ def train() -> None:
         train_loss = sum(losses) / max(1, len(losses))
         train_acc = 100 * correct // total
 
+        epoch_time = time.time() - epoch_start
+        data_wait = train_batches.wait_time / max(epoch_time, 1e-9)
+
         # Log train loss and acc
         wandb.log({"train_loss": train_loss})
         wandb.log({"train_acc": train_acc})
+        wandb.log({"data_wait": data_wait})
 
         print(
             f"Epoch {epoch+1}/{EPOCHS} \n \tTraining:  "
             f" Loss={train_loss:.2f}\t Accuracy={train_acc}%\t"
+            f" Waiting for data={100 * data_wait:.0f}%"
         )
         # Training Loop End
 
@@ -140,7 +252,7 @@ def train() -> None:
             correct = 0
             total = 0
 
-            for images, labels in testloader:
+            for images, labels in test_batches:
 
                 output = model(images)
                 loss = criterion(output, labels)
@@ -171,6 +283,7 @@ def train() -> None:
             torch.save(
                 {
                     "epoch": epoch + 1,
+                    "architecture": model.spec,
                     "model_state_dict": model.state_dict(),
                     "optimizer_state_dict": optimizer.state_dict(),
                 },
@@ -183,6 +296,7 @@ def train() -> None:
             torch.save(
                 {
                     "epoch": epoch + 1,
+                    "architecture": model.spec,
                     "model_state_dict": model.state_dict(),
                     "optimizer_state_dict": optimizer.state_dict(),
                 },
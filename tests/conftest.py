@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module contains the fixtures shared by the tests
+######################################################################
+
+from typing import Callable, Optional, Tuple
+
+import pytest
+import torch
+
+
+@pytest.fixture
+def write_split(tmp_path) -> Callable[..., Tuple[str, str]]:
+    """Returns a function writing a .pt split into tmp_path and returning its paths
+
+    By default the split holds n random 1 x size x size images with labels arange(n) % 3.
+    """
+
+    def write(
+        n: int = 10,
+        size: int = 32,
+        images: Optional[torch.Tensor] = None,
+        labels: Optional[torch.Tensor] = None,
+    ) -> Tuple[str, str]:
+        images = torch.rand(n, 1, size, size) if images is None else images
+        labels = torch.arange(len(images)) % 3 if labels is None else labels
+        torch.save(images, tmp_path / "train_images.pt")
+        torch.save(labels, tmp_path / "train_labels.pt")
+        return str(tmp_path / "train_images.pt"), str(tmp_path / "train_labels.pt")
+
+    return write
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module is used to test the pre-augmented epoch cache
+######################################################################
+
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from src.data.shards import ShardedArray
+from src.models import dataset_fetcher
+from src.models.augment_cache import build_augmented_cache
+from src.models.dataset_fetcher import Dataset_fetcher
+
+
+def test_cache_is_reproducible_across_workers(tmp_path, write_split):
+    paths = write_split(n=12)
+    for workers in [1, 2]:
+        build_augmented_cache(
+            *paths, str(tmp_path / f"cache{workers}"), variants=2, workers=workers, chunk_size=5
+        )
+    for variant in ["variant_000", "variant_001"]:
+        serial = ShardedArray(str(tmp_path / "cache1" / variant))
+        parallel = ShardedArray(str(tmp_path / "cache2" / variant))
+        assert np.array_equal(serial[:], parallel[:])
+    first = ShardedArray(str(tmp_path / "cache1" / "variant_000"))
+    second = ShardedArray(str(tmp_path / "cache1" / "variant_001"))
+    assert not np.array_equal(first[:], second[:])
+
+
+def test_fetcher_samples_one_variant_per_epoch(tmp_path, write_split):
+    paths = write_split(n=12)
+    build_augmented_cache(*paths, str(tmp_path / "cache"), variants=4, chunk_size=5)
+    dataset = Dataset_fetcher(*paths, transform=None, augmented_dir=str(tmp_path / "cache"))
+    variants = [ShardedArray(str(tmp_path / "cache" / f"variant_{v:03d}")) for v in range(4)]
+
+    epochs = []
+    for epoch in range(2):
+        dataset.set_epoch(epoch)
+        images = dataset.collate_fn([dataset[idx] for idx in range(len(dataset))])[0]
+        for idx, variant in enumerate(dataset.variant_of):
+            assert torch.equal(
+                images[idx], variants[variant].decode(torch.from_numpy(variants[variant][idx]))
+            )
+        epochs.append(dataset.variant_of.copy())
+    assert not np.array_equal(epochs[0], epochs[1])
+    assert torch.equal(dataset.labels, torch.arange(12) % 3)
+
+
+def test_fetcher_rejects_a_stale_cache(tmp_path, write_split):
+    paths = write_split(n=12)
+    build_augmented_cache(*paths, str(tmp_path / "cache"), variants=1)
+    with pytest.raises(ValueError, match="px"):
+        Dataset_fetcher(
+            *paths, transform=None, resolution=256, augmented_dir=str(tmp_path / "cache")
+        )
+
+    torch.save(torch.rand(12, 1, 32, 32), paths[0])
+    with pytest.raises(ValueError, match="rebuild"):
+        Dataset_fetcher(*paths, transform=None, augmented_dir=str(tmp_path / "cache"))
+
+
+def test_building_leaves_the_global_rng_alone(tmp_path, write_split):
+    paths = write_split(n=12)
+    torch.manual_seed(123)
+    expected = torch.rand(3)
+    torch.manual_seed(123)
+    build_augmented_cache(*paths, str(tmp_path / "cache"), variants=2)
+    assert torch.equal(torch.rand(3), expected)
+
+
+def test_unchanged_source_is_not_hashed_again(tmp_path, write_split, monkeypatch):
+    paths = write_split(n=12)
+    build_augmented_cache(*paths, str(tmp_path / "cache"), variants=1)
+
+    def no_hashing(path):
+        raise AssertionError("the source was hashed again")
+
+    monkeypatch.setattr(dataset_fetcher, "file_digest", no_hashing)
+    Dataset_fetcher(*paths, transform=None, augmented_dir=str(tmp_path / "cache"))
+
+
+def test_persistent_workers_follow_set_epoch(tmp_path, write_split):
+    paths = write_split(n=12)
+    build_augmented_cache(*paths, str(tmp_path / "cache"), variants=4, chunk_size=5)
+    dataset = Dataset_fetcher(*paths, transform=None, augmented_dir=str(tmp_path / "cache"))
+    loader = DataLoader(
+        dataset, batch_size=4, num_workers=2, persistent_workers=True, collate_fn=dataset.collate_fn
+    )
+    variants = [ShardedArray(str(tmp_path / "cache" / f"variant_{v:03d}")) for v in range(4)]
+    for epoch in range(3):
+        dataset.set_epoch(epoch)
+        images = torch.cat([batch for batch, _ in loader])
+        for idx, variant in enumerate(dataset.variant_of):
+            expected = variants[variant].decode(torch.from_numpy(variants[variant][idx]))
+            assert torch.equal(images[idx], expected)
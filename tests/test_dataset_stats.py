@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module is used to test the dataset statistics
+######################################################################
+
+import json
+
+import numpy as np
+import pytest
+import torch
+
+from src.data.shards import convert_split
+from src.models.dataset_stats import RunningStats, dataset_stats, stats_path
+
+
+def test_merged_stats_equal_single_pass():
+    values = torch.rand(1000, dtype=torch.float64)
+    stats = RunningStats(bins=10)
+    for part in values.split(137):
+        partial = RunningStats(bins=10)
+        partial.update(part)
+        stats.merge(partial)
+    assert stats.count == 1000
+    assert stats.mean == pytest.approx(float(values.mean()))
+    assert stats.std == pytest.approx(float(values.std(unbiased=False)))
+    assert stats.histogram.tolist() == np.histogram(values.numpy(), 10, (0, 1))[0].tolist()
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_dataset_stats_are_exact_and_cached(write_split, num_workers):
+    images = torch.rand(10, 1, 16, 16) ** 2
+    images_path, labels_path = write_split(images=images)
+    stats = dataset_stats(images_path, labels_path, num_workers=num_workers)
+    assert stats.mean == pytest.approx(float(images.double().mean()))
+    assert stats.std == pytest.approx(float(images.double().std(unbiased=False)))
+
+    # a valid cache entry is returned as is
+    with open(stats_path(images_path)) as f:
+        cached = json.load(f)
+    cached["stats"]["mean"] = -1.0
+    with open(stats_path(images_path), "w") as f:
+        json.dump(cached, f)
+    assert dataset_stats(images_path, labels_path).mean == -1.0
+
+    # changing the data invalidates it
+    torch.save(images * 0.5, images_path)
+    assert dataset_stats(images_path, labels_path).mean == pytest.approx(
+        float(images.double().mean() * 0.5)
+    )
+
+
+def test_sharded_dataset_stats(tmp_path, write_split):
+    images = torch.rand(10, 1, 16, 16) ** 2
+    images_path, labels_path = write_split(images=images)
+    convert_split(images_path, labels_path, str(tmp_path / "train"))
+    stats = dataset_stats(str(tmp_path / "train"))
+    quantized = torch.round(images.double() * 255) / 255
+    assert stats.mean == pytest.approx(float(quantized.mean()))
+    assert dataset_stats(str(tmp_path / "train")).count == stats.count
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module is used to test the streaming dataset
+######################################################################
+
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from src.data.shards import convert_split
+from src.models.dataset_fetcher import Dataset_streamer
+
+
+@pytest.fixture(params=["npy", "shards"])
+def split(tmp_path, request):
+    """writes 50 images whose first pixel holds their index"""
+    images = torch.zeros(50, 1, 8, 8)
+    images[:, 0, 0, 0] = torch.arange(50) / 255
+    torch.save(images, tmp_path / "train_images.pt")
+    torch.save(torch.arange(50) % 3, tmp_path / "train_labels.pt")
+    if request.param == "shards":
+        convert_split(
+            str(tmp_path / "train_images.pt"),
+            str(tmp_path / "train_labels.pt"),
+            str(tmp_path / "train"),
+            shard_size=8,
+        )
+        return str(tmp_path / "train"), None
+    return str(tmp_path / "train_images.pt"), str(tmp_path / "train_labels.pt")
+
+
+def _indices(dataset, num_workers=0):
+    loader = DataLoader(
+        dataset, batch_size=4, num_workers=num_workers, collate_fn=dataset.collate_fn
+    )
+    return [int(round(float(x) * 255)) for images, _ in loader for x in images[:, 0, 0, 0]]
+
+
+def test_every_sample_once_per_epoch(split):
+    dataset = Dataset_streamer(*split, transform=None, shuffle_buffer=16, block_size=8)
+    indices = _indices(dataset, num_workers=2)
+    assert sorted(indices) == list(range(50))
+    assert indices != list(range(50))
+    assert len(dataset) == 50
+
+
+def test_order_depends_on_seed_and_epoch_only(split):
+    first = Dataset_streamer(*split, transform=None, block_size=8, seed=3)
+    second = Dataset_streamer(*split, transform=None, block_size=8, seed=3)
+    assert _indices(first) == _indices(second)
+    second.set_epoch(1)
+    assert _indices(first) != _indices(second)
+
+
+def test_ranks_cover_every_sample(split):
+    seen = []
+    for rank in range(3):
+        dataset = Dataset_streamer(*split, transform=None, block_size=8, rank=rank, world_size=3)
+        indices = _indices(dataset)
+        assert len(indices) == len(dataset)
+        seen += indices
+    # 50 samples over 3 ranks: one sample is repeated to give every rank 17
+    assert sorted(set(seen)) == list(range(50))
+    assert len(seen) == 51
+
+
+@pytest.mark.parametrize("world_size", [2, 3, 4, 7])
+def test_ranks_get_the_same_number_of_samples(split, world_size):
+    lengths, counts = set(), set()
+    for epoch in range(2):
+        for rank in range(world_size):
+            dataset = Dataset_streamer(
+                *split, transform=None, block_size=8, rank=rank, world_size=world_size
+            )
+            dataset.set_epoch(epoch)
+            lengths.add(len(dataset))
+            counts.add(len(_indices(dataset, num_workers=2)))
+    assert lengths == counts == {-(-50 // world_size)}
+
+
+def test_persistent_workers_follow_set_epoch(split):
+    dataset = Dataset_streamer(*split, transform=None, shuffle_buffer=16, block_size=8)
+    loader = DataLoader(
+        dataset,
+        batch_size=4,
+        num_workers=2,
+        persistent_workers=True,
+        collate_fn=dataset.collate_fn,
+    )
+    epochs = []
+    for epoch in range(2):
+        dataset.set_epoch(epoch)
+        epochs.append(
+            [int(round(float(x) * 255)) for images, _ in loader for x in images[:, 0, 0, 0]]
+        )
+        expected = Dataset_streamer(*split, transform=None, shuffle_buffer=16, block_size=8)
+        expected.set_epoch(epoch)
+        assert epochs[-1] == _indices(expected, num_workers=2)
+    assert epochs[0] != epochs[1]
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module is used to test the knowledge distillation
+######################################################################
+
+import os
+
+import torch
+import torch.nn.functional as F
+
+from src.models.dataset_fetcher import Dataset_fetcher
+from src.models.distillation import WithTeacherLogits, distillation_loss, teacher_logits
+from src.models.model_architecture import XrayClassifier, architecture_spec
+
+
+def _write_teacher(tmp_path, seed):
+    torch.manual_seed(seed)
+    teacher = XrayClassifier(spec=architecture_spec(head="avg"))
+    path = str(tmp_path / "teacher.pth")
+    torch.save({"architecture": teacher.spec, "model_state_dict": teacher.state_dict()}, path)
+    return teacher.eval(), path
+
+
+def test_loss_without_teacher_weight_is_cross_entropy():
+    student, teacher = torch.randn(4, 3), torch.randn(4, 3)
+    labels = torch.tensor([0, 1, 2, 1])
+    loss = distillation_loss(student, teacher, labels, alpha=0.0)
+    assert torch.allclose(loss, F.cross_entropy(student, labels))
+    # a student that matches the teacher has no soft loss
+    assert torch.allclose(
+        distillation_loss(teacher, teacher, labels, alpha=1.0), torch.tensor(0.0), atol=1e-6
+    )
+
+
+def test_teacher_logits_are_cached_per_teacher(tmp_path, write_split):
+    paths = write_split()
+    teacher, checkpoint = _write_teacher(tmp_path, seed=0)
+    cache_dir = str(tmp_path / "logits")
+
+    logits = teacher_logits(checkpoint, *paths, cache_dir, batch_size=4)
+    with torch.no_grad():
+        expected = teacher(torch.load(paths[0]))
+    assert torch.allclose(logits, expected, atol=1e-5)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # a second call reads the cache instead of running the teacher
+    cache_file = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+    cached = torch.load(cache_file)
+    cached["logits"] = torch.zeros_like(logits)
+    torch.save(cached, cache_file)
+    assert torch.equal(teacher_logits(checkpoint, *paths, cache_dir), torch.zeros_like(logits))
+
+    # a different teacher gets its own entry
+    _write_teacher(tmp_path, seed=1)
+    assert not torch.equal(teacher_logits(checkpoint, *paths, cache_dir), logits)
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_wrapper_adds_the_logits_of_each_sample(tmp_path, write_split):
+    paths = write_split()
+    dataset = Dataset_fetcher(*paths, transform=None)
+    logits = torch.arange(30, dtype=torch.float32).view(10, 3)
+    wrapped = WithTeacherLogits(dataset, logits)
+    assert len(wrapped) == 10 and torch.equal(wrapped.labels, dataset.labels)
+
+    images, labels, batch_logits = wrapped.collate_fn([wrapped[i] for i in [3, 7]])
+    assert images.shape == (2, 1, 32, 32)
+    assert torch.equal(labels, dataset.labels[[3, 7]])
+    assert torch.equal(batch_logits, logits[[3, 7]])
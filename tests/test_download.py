@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module is used to test the dataset downloader
+######################################################################
+
+import hashlib
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src.data.download import _part_path, _plan_ranges, download_file
+
+PAYLOAD = os.urandom(100_000)
+SHA256 = hashlib.sha256(PAYLOAD).hexdigest()
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    """Serves PAYLOAD, honouring single byte ranges unless the server disables them"""
+
+    def log_message(self, *args):
+        pass
+
+    def _headers(self, status, length, content_range=None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if content_range:
+            self.send_header("Content-Range", content_range)
+        self.end_headers()
+
+    def do_HEAD(self):
+        self._headers(200, len(PAYLOAD))
+
+    def do_GET(self):
+        match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if match and self.server.ranges:
+            start, end = int(match.group(1)), int(match.group(2))
+            body = PAYLOAD[start : end + 1]
+            self._headers(206, len(body), f"bytes {start}-{end}/{len(PAYLOAD)}")
+        else:
+            body = PAYLOAD
+            self._headers(200, len(body))
+        self.server.served += len(body)
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _RangeHandler)
+    httpd.ranges = True
+    httpd.served = 0
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}/data.zip"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _download(server, dest, **kwargs):
+    kwargs.setdefault("sha256", SHA256)
+    download_file(server.url, str(dest), connections=4, min_range_size=1, **kwargs)
+
+
+def test_parallel_download_is_verified(server, tmp_path):
+    dest = tmp_path / "data.zip"
+    _download(server, dest)
+    assert dest.read_bytes() == PAYLOAD
+    assert os.listdir(tmp_path) == ["data.zip"]
+
+
+def test_download_resumes_from_partial_ranges(server, tmp_path):
+    dest = tmp_path / "data.zip"
+    start, end = _plan_ranges(len(PAYLOAD), 4, 1)[1]
+    with open(_part_path(str(dest), start, end), "wb") as f:
+        f.write(PAYLOAD[start : start + 1000])
+
+    _download(server, dest)
+    assert dest.read_bytes() == PAYLOAD
+    assert server.served == len(PAYLOAD) - 1000
+
+
+def test_download_without_range_support(server, tmp_path):
+    server.ranges = False
+    dest = tmp_path / "data.zip"
+    _download(server, dest)
+    assert dest.read_bytes() == PAYLOAD
+
+
+def test_checksum_mismatch_raises(server, tmp_path):
+    dest = tmp_path / "data.zip"
+    with pytest.raises(ValueError):
+        _download(server, dest, sha256="0" * 64)
+    assert os.listdir(tmp_path) == []
+
+
+def test_corrupt_existing_file_is_replaced(server, tmp_path):
+    dest = tmp_path / "data.zip"
+    dest.write_bytes(PAYLOAD[:500])
+    _download(server, dest)
+    assert dest.read_bytes() == PAYLOAD
+
+    served = server.served
+    _download(server, dest)
+    assert server.served == served
+
+
+def test_truncated_file_is_replaced_without_checksum(server, tmp_path):
+    dest = tmp_path / "data.zip"
+    dest.write_bytes(PAYLOAD[:500])
+    _download(server, dest, sha256=None)
+    assert dest.read_bytes() == PAYLOAD
+
+    served = server.served
+    _download(server, dest, sha256=None)
+    assert server.served == served
+
+
+def test_oversized_part_is_fetched_again(server, tmp_path):
+    dest = tmp_path / "data.zip"
+    start, end = _plan_ranges(len(PAYLOAD), 4, 1)[0]
+    with open(_part_path(str(dest), start, end), "wb") as f:
+        f.write(os.urandom(end - start + 10))
+    _download(server, dest, sha256=None)
+    assert dest.read_bytes() == PAYLOAD
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module is used to test the DataLoader tuning
+######################################################################
+
+import pytest
+from omegaconf import OmegaConf
+
+from src.models.dataset_fetcher import Dataset_fetcher
+from src.models.loader_tuning import (
+    best_result,
+    load_machine_config,
+    loader_kwargs,
+    machine_config_path,
+    sweep,
+    write_machine_config,
+)
+
+
+def test_worker_options_only_with_workers():
+    assert loader_kwargs(0, 4, True) == {"num_workers": 0}
+    assert loader_kwargs(2, 4, True) == {
+        "num_workers": 2,
+        "prefetch_factor": 4,
+        "persistent_workers": True,
+    }
+
+
+def test_sweep_writes_the_best_setting_as_override(tmp_path, write_split):
+    dataset = Dataset_fetcher(*write_split(n=16, size=16), transform=None)
+    results = sweep(dataset, [0, 1], [4, 8], [2], [False, True], [1], epochs=1)
+    # persistent workers are only tried with workers
+    assert len(results) == 6
+    assert all(r["samples_per_sec"] > 0 and r["peak_rss_mb"] > 0 for r in results)
+
+    best = best_result(results)
+    assert best["samples_per_sec"] == max(r["samples_per_sec"] for r in results)
+    with pytest.raises(ValueError):
+        best_result(results, max_rss_mb=0)
+
+    config = OmegaConf.create({"N_WORKERS": 2, "BATCH_SIZE": 32, "EPOCHS": 100})
+    assert load_machine_config(config, str(tmp_path)) is config
+    path = write_machine_config(best, str(tmp_path))
+    assert path == machine_config_path(str(tmp_path))
+    merged = load_machine_config(config, str(tmp_path))
+    assert merged.N_WORKERS == best["N_WORKERS"]
+    assert merged.EPOCHS == 100
+
+    # the batch size is an optimization setting: suggested, never applied
+    with open(path, "a") as f:
+        f.write("BATCH_SIZE: 4\n")
+    assert load_machine_config(config, str(tmp_path)).BATCH_SIZE == 32
@@ -14,12 +14,262 @@
 
 # WORK IN PROGRESS
 
+import glob
+import io
+import multiprocessing.pool
+import os
+import shutil
+
+import numpy as np
 import PIL
+import torch
 from PIL import Image
 
-from src.data.make_dataset import kornia_preprocess
+from src.data import make_dataset
+from src.data.cache import content_digest
+from src.data.make_dataset import kornia_preprocess, list_images, preprocess
+from src.data.pyramid import downsample, resolution_path
+from src.data.shards import ShardedArray
 
 
 def test_kornia_preprocess_type():
     image = Image.new("RGB", (512, 512))
     assert type(kornia_preprocess(image) is PIL.Image.Image)
+
+
+def _make_fake_dataset(root, per_class=2):
+    """writes a few random grayscale and RGB images per class folder"""
+    rng = np.random.default_rng(0)
+    for class_name in ["covid", "normal", "pneumonia"]:
+        os.makedirs(os.path.join(root, class_name))
+        for i in range(per_class):
+            arr = rng.integers(0, 256, (96 + 8 * i, 80), dtype=np.uint8)
+            if i % 2:
+                arr = np.stack([arr] * 3, -1)
+            Image.fromarray(arr).save(os.path.join(root, class_name, f"img{i}.png"))
+
+
+def test_parallel_preprocess_matches_serial(tmp_path):
+    raw = str(tmp_path / "raw")
+    _make_fake_dataset(raw)
+    preprocess(
+        raw,
+        cache_dir=None,
+        plotsample=False,
+        output_filepath=str(tmp_path / "serial") + "/",
+        workers=1,
+    )
+    preprocess(
+        raw,
+        cache_dir=None,
+        plotsample=False,
+        output_filepath=str(tmp_path / "parallel") + "/",
+        workers=2,
+    )
+    for split in ["train", "test", "valid"]:
+        serial = torch.load(tmp_path / "serial" / f"{split}_images.pt")
+        parallel = torch.load(tmp_path / "parallel" / f"{split}_images.pt")
+        assert torch.equal(serial, parallel)
+
+
+def test_pool_keeps_a_bounded_number_of_chunks_in_flight():
+    submitted = []
+
+    def tasks():
+        for task in range(20):
+            submitted.append(task)
+            yield task
+
+    with multiprocessing.pool.ThreadPool(2) as pool:
+        results = []
+        for result in make_dataset._ordered_imap(pool, abs, tasks(), window=4):
+            results.append(result)
+            assert len(submitted) - len(results) <= 4
+    assert results == list(range(20))
+
+
+def test_serial_preprocess_leaves_the_global_rng_alone(tmp_path):
+    raw = str(tmp_path / "raw")
+    _make_fake_dataset(raw)
+    torch.manual_seed(123)
+    expected = torch.rand(3)
+    torch.manual_seed(123)
+    preprocess(raw, cache_dir=None, plotsample=False, output_filepath=str(tmp_path / "out") + "/")
+    assert torch.equal(torch.rand(3), expected)
+
+
+def test_streaming_preprocess_matches_in_memory(tmp_path):
+    raw = str(tmp_path / "raw")
+    _make_fake_dataset(raw)
+    preprocess(
+        raw, cache_dir=None, plotsample=False, output_filepath=str(tmp_path / "memory") + "/"
+    )
+    preprocess(
+        raw,
+        cache_dir=None,
+        plotsample=False,
+        output_filepath=str(tmp_path / "stream") + "/",
+        stream=True,
+    )
+    for split in ["train", "test", "valid"]:
+        in_memory = torch.load(tmp_path / "memory" / f"{split}_images.pt")
+        streamed = torch.from_numpy(np.load(tmp_path / "stream" / f"{split}_images.npy"))
+        assert torch.equal(in_memory, streamed)
+        assert torch.equal(
+            torch.load(tmp_path / "memory" / f"{split}_labels.pt"),
+            torch.load(tmp_path / "stream" / f"{split}_labels.pt"),
+        )
+
+
+def test_sharded_preprocess_matches_in_memory(tmp_path):
+    raw = str(tmp_path / "raw")
+    _make_fake_dataset(raw)
+    preprocess(
+        raw, cache_dir=None, plotsample=False, output_filepath=str(tmp_path / "memory") + "/"
+    )
+    preprocess(
+        raw,
+        plotsample=False,
+        output_filepath=str(tmp_path / "shards") + "/",
+        output_format="shards",
+    )
+    for split in ["train", "test", "valid"]:
+        in_memory = torch.load(tmp_path / "memory" / f"{split}_images.pt")
+        shards = ShardedArray(str(tmp_path / "shards" / split))
+        assert torch.allclose(in_memory, shards.decode(torch.from_numpy(shards[:])), atol=2e-3)
+        assert torch.equal(
+            torch.load(tmp_path / "memory" / f"{split}_labels.pt"), torch.from_numpy(shards.labels)
+        )
+
+
+def test_cache_only_processes_new_images(tmp_path):
+    raw = str(tmp_path / "raw")
+    cache_dir = str(tmp_path / "cache")
+    _make_fake_dataset(raw)
+    preprocess(
+        raw, plotsample=False, output_filepath=str(tmp_path / "first") + "/", cache_dir=cache_dir
+    )
+    entries = glob.glob(os.path.join(cache_dir, "*", "*", "*.npy"))
+    assert len(entries) == 6
+
+    # poison one entry: if the rerun reads from cache the poisoned image shows up in the output
+    np.save(entries[0], np.zeros((1, 512, 512), dtype=np.float32))
+    Image.fromarray(np.full((64, 64), 7, dtype=np.uint8)).save(
+        os.path.join(raw, "covid", "new.png")
+    )
+    preprocess(
+        raw, plotsample=False, output_filepath=str(tmp_path / "second") + "/", cache_dir=cache_dir
+    )
+
+    assert len(glob.glob(os.path.join(cache_dir, "*", "*", "*.npy"))) == 7
+    images = torch.cat(
+        [
+            torch.load(tmp_path / "second" / f"{split}_images.pt")
+            for split in ["train", "test", "valid"]
+        ]
+    )
+    assert (images.flatten(1).abs().sum(1) == 0).sum() == 1
+
+
+def test_zip_source_matches_extracted_folder(tmp_path):
+    raw = str(tmp_path / "raw")
+    _make_fake_dataset(os.path.join(raw, "Dataset"))
+    archive = shutil.make_archive(str(tmp_path / "raw"), "zip", raw)
+
+    assert len(list_images(archive)[0]) == 6
+    assert list_images(archive)[1] == list_images(os.path.join(raw, "Dataset"))[1]
+    preprocess(
+        os.path.join(raw, "Dataset"),
+        cache_dir=None,
+        plotsample=False,
+        output_filepath=str(tmp_path / "folder") + "/",
+    )
+    preprocess(
+        archive,
+        cache_dir=None,
+        plotsample=False,
+        output_filepath=str(tmp_path / "zip") + "/",
+        workers=2,
+    )
+    for split in ["train", "test", "valid"]:
+        assert torch.equal(
+            torch.load(tmp_path / "folder" / f"{split}_images.pt"),
+            torch.load(tmp_path / "zip" / f"{split}_images.pt"),
+        )
+
+
+def _legacy_transform(data, digest):
+    """the PIL based per-image chain the tensor pipeline replaced"""
+    torch.manual_seed(make_dataset.config.SEED + int(digest[:12], 16))
+    image = make_dataset.rgb_to_gray(kornia_preprocess(io.BytesIO(data)))
+    image = make_dataset.data_aug(make_dataset.K.color.grayscale_to_rgb(image))
+    image = make_dataset.transforms.ToPILImage()(image.squeeze_())
+    return make_dataset.rgb_to_gray(image).numpy()
+
+
+def test_batched_transform_matches_pil_pipeline():
+    rng = np.random.default_rng(1)
+    datas = []
+    for mode, shape in [("L", (96, 80)), ("RGB", (96, 80, 3)), ("RGBA", (64, 72, 4))]:
+        for _ in range(2):
+            buffer = io.BytesIO()
+            arr = rng.integers(0, 256, shape, dtype=np.uint8)
+            Image.fromarray(arr, mode).save(buffer, format="PNG")
+            datas.append(buffer.getvalue())
+    digests = [content_digest(data) for data in datas]
+
+    batched = make_dataset._transform_batch(datas, digests)
+    for data, digest, image in zip(datas, digests, batched):
+        assert np.array_equal(image, _legacy_transform(data, digest))
+
+
+def _png(arr, mode=None):
+    buffer = io.BytesIO()
+    Image.fromarray(arr, mode).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_check_size_and_gray_drops_constant_channels():
+    rgb = torch.rand(3, 32, 32)
+    alpha = torch.ones(1, 32, 32)
+    rgba = torch.cat([rgb, alpha])
+    assert torch.equal(make_dataset.gray_check(rgba), make_dataset.gray_check(rgb))
+    # a blank multi-plane image falls back to its first channel instead of failing
+    assert make_dataset.gray_check(torch.zeros(4, 8, 8)).shape == (1, 8, 8)
+
+
+def test_16bit_images_use_full_range():
+    rng = np.random.default_rng(2)
+    arr8 = rng.integers(0, 256, (96, 80), dtype=np.uint8)
+    arr16 = arr8.astype(np.uint16) * 257
+    datas = [_png(arr8), _png(arr16)]
+    counts = {}
+    image8, image16 = make_dataset._transform_batch(datas, ["0" * 64] * 2, counts)
+    assert np.allclose(image8, image16, atol=1 / 255)
+    assert counts == {"gray": 2, "16bit": 1}
+
+
+def test_pyramid_outputs_match_downsampled_base(tmp_path):
+    raw = str(tmp_path / "raw")
+    _make_fake_dataset(raw)
+    out = str(tmp_path / "out") + "/"
+    preprocess(raw, cache_dir=None, plotsample=False, output_filepath=out, resolutions=[256, 128])
+    preprocess(
+        raw,
+        cache_dir=None,
+        plotsample=False,
+        output_filepath=str(tmp_path / "shards") + "/",
+        output_format="shards",
+        resolutions=[128],
+    )
+    for split in ["train", "test", "valid"]:
+        base = torch.load(out + f"{split}_images.pt")
+        for size in [256, 128]:
+            images = torch.load(resolution_path(out + f"{split}_images.pt", size))
+            assert images.shape[-2:] == (size, size)
+            assert torch.allclose(images, downsample(base, size))
+        shards = ShardedArray(resolution_path(str(tmp_path / "shards" / split), 128))
+        assert shards.shape == (1, 128, 128)
+        assert np.allclose(
+            shards.decode(torch.from_numpy(shards[:])), downsample(base, 128), atol=2e-3
+        )
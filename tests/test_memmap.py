@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module is used to test the memory-mapped dataset_fetcher
+######################################################################
+
+import pickle
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from src.models.dataset_fetcher import Dataset_fetcher
+
+
+def test_mmap_items_match_in_memory(write_split):
+    paths = write_split(n=12, size=16)
+    in_memory = Dataset_fetcher(*paths, transform=None)
+    mapped = Dataset_fetcher(*paths, transform=None, mmap=True)
+    assert len(mapped) == len(in_memory) == 12
+    for idx in range(12):
+        image, label = mapped[idx]
+        assert torch.equal(image, in_memory[idx][0]) and label == in_memory[idx][1]
+
+
+def test_pickling_drops_the_mapping(write_split):
+    dataset = Dataset_fetcher(*write_split(n=12, size=16), transform=None, mmap=True)
+    dataset[0]
+    assert isinstance(dataset._images, np.memmap)
+    restored = pickle.loads(pickle.dumps(dataset))
+    assert restored._images is None
+    assert len(restored) == 12
+    assert torch.equal(restored[5][0], dataset[5][0])
+
+
+def test_mmap_reads_correctly_in_workers(write_split):
+    paths = write_split(n=12, size=16)
+    expected = torch.load(paths[0])
+    dataset = Dataset_fetcher(*paths, transform=None, mmap=True)
+    # touch the mapping in the parent so the workers have to reopen it
+    dataset[0]
+    loader = DataLoader(
+        dataset, batch_size=4, num_workers=2, collate_fn=dataset.collate_fn, shuffle=False
+    )
+    images, labels = zip(*loader)
+    assert torch.equal(torch.cat(images), expected)
+    assert torch.equal(torch.cat(labels), torch.load(paths[1]))
@@ -12,6 +12,11 @@
 # Module: This module is responsible for testing the model architecture
 ######################################################################
 
+import filecmp
+
+import pytest
+import torch
+
 from src.models import model_architecture
 
 
@@ -20,6 +25,135 @@ def test_model_arch():
     assert model_architecture.XrayClassifier()
 
 
+def test_model_input_size():
+    """tests that a lower resolution model accepts matching images"""
+    model = model_architecture.XrayClassifier(input_size=128)
+    assert model(torch.rand(2, 1, 128, 128)).shape == (2, 3)
+
+
+def test_pooled_heads_accept_any_size():
+    """tests that the pooled heads are small and independent of the resolution"""
+    for head, in_features in [("avg", 48), ("max", 48), ("avgmax", 96)]:
+        model = model_architecture.XrayClassifier(input_size=64, head=head).eval()
+        assert model.fc.in_features == in_features
+        for size in [32, 64]:
+            assert model(torch.rand(2, 1, size, size)).shape == (2, 3)
+
+
+def test_convert_head_keeps_uniform_logits():
+    """tests that the converted avg head matches the flatten head on uniform activations"""
+    from src.models.convert_head import pooled_from_flatten
+
+    model = model_architecture.XrayClassifier(input_size=16).eval()
+    pooled = pooled_from_flatten(model, "avg").eval()
+    assert torch.equal(pooled.conv4.weight, model.conv4.weight)
+    features = torch.rand(2, 48, 1, 1).expand(2, 48, 8, 8)
+    expected = model.fc(features.reshape(2, -1))
+    assert torch.allclose(pooled.fc(pooled.avg_pool(features).view(2, 48)), expected, atol=1e-5)
+
+
+def test_original_network_is_unchanged():
+    """tests that the default spec computes the original forward pass"""
+    model = model_architecture.XrayClassifier(input_size=16).eval()
+    assert sorted(model.state_dict()) == sorted(
+        [f"{layer}{i}.{p}" for i in range(1, 5) for layer in ["conv"] for p in ["weight", "bias"]]
+        + [
+            f"bn{i}.{p}"
+            for i in range(1, 5)
+            for p in ["weight", "bias", "running_mean", "running_var", "num_batches_tracked"]
+        ]
+        + ["fc.weight", "fc.bias"]
+    )
+    x = torch.rand(2, 1, 16, 16)
+    y = model.pool(model.relu1(model.bn1(model.conv1(x))))
+    y = model.relu2(model.conv2(y))
+    y = model.relu3(model.bn3(model.conv3(y)))
+    y = model.relu4(model.bn4(model.conv4(y)))
+    assert torch.allclose(model(x), model.fc(y.reshape(2, -1)))
+
+
+def test_checkpoint_rebuilds_the_architecture():
+    """tests that checkpoints carry their spec and older ones still load"""
+    spec = model_architecture.architecture_spec("xray_fast", input_size=64, widths=[4, 8, 8, 16])
+    model = model_architecture.XrayClassifier(spec=spec).eval()
+    x = torch.rand(2, 1, 64, 64)
+    checkpoint = {"architecture": model.spec, "model_state_dict": model.state_dict()}
+    assert torch.equal(model_architecture.model_from_checkpoint(checkpoint).eval()(x), model(x))
+    assert model.fc.in_features == 16 * model_architecture.output_size(spec) ** 2
+
+    legacy = model_architecture.XrayClassifier(input_size=32)
+    checkpoint = {"input_size": 32, "model_state_dict": legacy.state_dict()}
+    assert model_architecture.model_from_checkpoint(checkpoint).spec == legacy.spec
+
+
+def test_deployment_copy_is_identical():
+    """tests that the deployment keeps the same architecture and backend modules"""
+    for module in ["model_architecture.py", "inference_backend.py"]:
+        assert filecmp.cmp(f"src/models/{module}", f"src/deployment/{module}", shallow=False)
+
+
+def test_scripted_export_matches_the_eager_model():
+    """tests that the fused TorchScript artifact gives the eager outputs and its metadata"""
+    import io
+
+    from src.models.export_model import export_model, load_scripted
+
+    model = model_architecture.XrayClassifier(input_size=32).eval()
+    with torch.no_grad():
+        model.bn1.running_mean.uniform_()
+        model.bn4.running_var.uniform_(0.5, 2)
+    artifact = io.BytesIO()
+    export_model(model, artifact)
+    artifact.seek(0)
+    scripted, metadata = load_scripted(artifact)
+    assert metadata["input_size"] == 32 and metadata["architecture"] == model.spec
+    x = torch.rand(3, 1, 32, 32)
+    with torch.no_grad():
+        assert torch.allclose(scripted(x), model(x), atol=1e-4)
+
+
+def test_quantized_checkpoint_loads(tmp_path):
+    """tests that int8 checkpoints are rebuilt by model_from_checkpoint"""
+    from src.models.quantize_model import quantize
+
+    model = model_architecture.XrayClassifier(input_size=32).eval()
+    calibration = [(torch.rand(4, 1, 32, 32), None) for _ in range(3)]
+    quantized = quantize(model, calibration, batches=2)
+    x = torch.rand(2, 1, 32, 32)
+    with torch.no_grad():
+        assert torch.allclose(quantized(x), model(x), atol=0.05)
+    torch.save(
+        {
+            "architecture": model.spec,
+            "quantization": {"backend": model_architecture.quantization_backend()},
+            "model_state_dict": quantized.state_dict(),
+        },
+        tmp_path / "int8.pth",
+    )
+    checkpoint = torch.load(tmp_path / "int8.pth")
+    loaded = model_architecture.model_from_checkpoint(checkpoint)
+    with torch.no_grad():
+        assert torch.equal(loaded(x), quantized(x))
+
+
+def test_onnx_export_matches_torch_for_any_batch_size(tmp_path):
+    """tests the ONNX export against the eager model on onnxruntime"""
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    from src.models.export_model import compare_backends, export_onnx
+    from src.models.inference_backend import OnnxBackend, TorchBackend
+
+    model = model_architecture.XrayClassifier(input_size=32).eval()
+    export_onnx(model, str(tmp_path / "model.onnx"))
+    backend = OnnxBackend(str(tmp_path / "model.onnx"))
+    assert backend.metadata["architecture"] == model.spec
+    loader = [(torch.rand(n, 1, 32, 32), torch.arange(n) % 3) for n in [1, 5]]
+    report = compare_backends(model, {"torch": TorchBackend(model), "onnx": backend}, loader)
+    assert report["torch"]["max_abs_diff"] == 0
+    assert report["onnx"]["max_abs_diff"] < 1e-4
+    assert report["onnx"]["accuracy"] == report["torch"]["accuracy"]
+
+
 # TODO: Needs to be implemented by passing a test image
 def test_forward_pass():
     """tests the forward pass"""
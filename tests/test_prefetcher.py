@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module is used to test the background batch prefetcher
+######################################################################
+
+import pytest
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from src.models.prefetcher import BatchPrefetcher
+
+
+def _loader(n=10, batch_size=4):
+    dataset = TensorDataset(torch.rand(n, 1, 8, 8), torch.arange(n))
+    return DataLoader(dataset, batch_size=batch_size)
+
+
+def test_yields_the_loader_batches():
+    loader = _loader()
+    prefetcher = BatchPrefetcher(loader, depth=1)
+    batches = list(prefetcher)
+    for (images, labels), (expected_images, expected_labels) in zip(batches, loader):
+        assert torch.equal(images, expected_images)
+        assert torch.equal(labels, expected_labels)
+    assert len(batches) == len(loader) == 3
+    assert prefetcher.stats()["batches"] == 3
+
+
+def test_errors_are_raised_in_the_consumer():
+    def broken():
+        yield torch.zeros(2), torch.zeros(2)
+        raise RuntimeError("broken loader")
+
+    with pytest.raises(RuntimeError, match="broken loader"):
+        for _ in BatchPrefetcher(broken()):
+            pass
+
+
+def test_stopping_early_does_not_block():
+    prefetcher = BatchPrefetcher(_loader(n=100, batch_size=1), depth=2)
+    for _ in range(2):
+        for step, _ in enumerate(prefetcher):
+            if step == 3:
+                break
+    assert prefetcher.batches == 8
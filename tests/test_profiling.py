@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module is used to test the data pipeline instrumentation
+######################################################################
+
+import json
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from src.data.make_dataset import preprocess
+from src.data.profiling import Profiler
+from tests.test_make_dataset import _make_fake_dataset
+
+
+def test_nested_stages_keep_inner_peak():
+    profiler = Profiler(trace_memory=True)
+    try:
+        with profiler.stage("outer", 10):
+            with profiler.stage("inner") as stage:
+                block = bytearray(4 * 2**20)
+                stage["bytes"] = len(block)
+                del block
+    finally:
+        tracemalloc.stop()
+    assert profiler.stages["inner"]["bytes"] == 4 * 2**20
+    assert profiler.stages["outer"]["bytes"] == 10
+    assert profiler.stages["outer"]["peak_traced"] >= profiler.stages["inner"]["peak_traced"]
+    assert profiler.stages["inner"]["peak_traced"] >= 4 * 2**20
+
+
+def test_worker_stages_are_merged_into_report(tmp_path):
+    raw = str(tmp_path / "raw")
+    _make_fake_dataset(raw)
+    profiler = Profiler()
+    preprocess(
+        raw,
+        cache_dir=None,
+        plotsample=False,
+        output_filepath=str(tmp_path / "out") + "/",
+        workers=2,
+        profiler=profiler,
+    )
+    with open(profiler.write_report(str(tmp_path / "reports"))) as f:
+        report = json.load(f)
+    for name in ["list", "read", "decode", "resize", "augment", "split", "save"]:
+        assert report["stages"][name]["calls"] > 0
+    assert report["stages"]["decode"]["bytes"] > 0
+    assert len(report["peak_rss_per_process"]) >= 2
+
+
+def test_light_stage_does_not_inherit_an_earlier_rss_peak():
+    profiler = Profiler()
+    if profiler.rss_scope != "stage":
+        pytest.skip("the RSS high-water mark cannot be reset here")
+    with profiler.stage("heavy"):
+        block = np.ones(32 * 2**20)
+        del block
+    with profiler.stage("light"):
+        pass
+    heavy = profiler.stages["heavy"]["peak_rss"]
+    assert profiler.stages["light"]["peak_rss"] < heavy - 128 * 2**20
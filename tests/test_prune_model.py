@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module is used to test the structured filter pruning
+######################################################################
+
+import pytest
+import torch
+
+from src.models.model_architecture import XrayClassifier, model_from_checkpoint
+from src.models.prune_model import count_flops, prune_model
+
+
+@pytest.mark.parametrize("head", ["flatten", "avg", "avgmax"])
+def test_pruning_zero_filters_keeps_the_outputs(head):
+    model = XrayClassifier(input_size=16, head=head).eval()
+    pruned = prune_model(model, 0.0)
+    x = torch.rand(2, 1, 16, 16)
+    with torch.no_grad():
+        assert torch.allclose(pruned(x), model(x), atol=1e-6)
+
+
+@pytest.mark.parametrize("head", ["flatten", "avgmax"])
+def test_removed_filters_are_the_unimportant_ones(head):
+    model = XrayClassifier(input_size=16, head=head).eval()
+    with torch.no_grad():
+        # silence half of the filters of every block: pruning them changes nothing
+        for block in range(1, 5):
+            conv = getattr(model, f"conv{block}")
+            conv.weight[conv.out_channels // 2 :] = 0
+            conv.bias[conv.out_channels // 2 :] = -1
+            getattr(model, f"bn{block}").weight[conv.out_channels // 2 :] = 0
+    pruned = prune_model(model, 0.5, "l1")
+    assert pruned.spec["widths"] == [6, 10, 16, 24]
+    x = torch.rand(2, 1, 16, 16)
+    with torch.no_grad():
+        assert torch.allclose(pruned(x), model(x), atol=1e-5)
+    assert count_flops(pruned.spec) < count_flops(model.spec) / 3
+
+    checkpoint = {"architecture": pruned.spec, "model_state_dict": pruned.state_dict()}
+    with torch.no_grad():
+        assert torch.equal(model_from_checkpoint(checkpoint).eval()(x), pruned(x))
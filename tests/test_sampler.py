@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module is used to test the class-balanced sampling
+######################################################################
+
+import numpy as np
+import pytest
+import torch
+
+from src.models.dataset_fetcher import Dataset_streamer
+from src.models.sampler import ClassBalancedSampler, repeat_factors
+
+LABELS = torch.tensor([0] * 60 + [1] * 30 + [2] * 10)
+
+
+def test_balanced_epochs_draw_classes_equally_without_early_repeats():
+    sampler = ClassBalancedSampler(LABELS, num_samples=300, seed=3)
+    indices = np.array(list(sampler))
+    counts = np.bincount(LABELS.numpy()[indices], minlength=3)
+    assert len(indices) == len(sampler) == 300
+    assert np.all(np.abs(counts - 100) < 30)
+    # a class is only repeated once all of its samples were drawn
+    for c in range(3):
+        drawn = indices[LABELS.numpy()[indices] == c]
+        size = int((LABELS == c).sum())
+        assert len(np.unique(drawn)) == min(len(drawn), size)
+
+    assert list(sampler) == indices.tolist()
+    sampler.set_epoch(1)
+    assert list(sampler) != indices.tolist()
+
+
+def test_weighted_sampling_follows_the_weights():
+    sampler = ClassBalancedSampler(LABELS, "weighted", [1, 0, 1], num_samples=1000)
+    classes = LABELS.numpy()[list(sampler)]
+    assert not (classes == 1).any()
+    assert abs((classes == 0).mean() - 0.5) < 0.1
+    with pytest.raises(ValueError):
+        ClassBalancedSampler(LABELS, "weighted", [1, 1])
+
+
+def test_ranks_split_one_epoch():
+    ranks = [ClassBalancedSampler(LABELS, rank=r, world_size=3, seed=5) for r in range(3)]
+    assert all(len(sampler) == 34 for sampler in ranks)
+    combined = sorted(sum((list(sampler) for sampler in ranks), []))
+    assert combined == sorted(ranks[0].epoch_indices().tolist())
+
+
+def test_streamer_repeats_samples_to_balance_classes(write_split):
+    streamer = Dataset_streamer(
+        *write_split(n=len(LABELS), size=4, labels=LABELS),
+        transform=None,
+        shuffle_buffer=16,
+        block_size=25,
+        sampling="balanced",
+    )
+    assert np.allclose(repeat_factors(LABELS) * np.bincount(LABELS.numpy()), 100 / 3)
+    labels = torch.stack([label for _, label in streamer]).numpy()
+    assert len(streamer) == 100
+    assert abs(len(labels) - 100) < 20
+    assert np.all(np.abs(np.bincount(labels, minlength=3) - 100 / 3) < 15)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+######################################################################
+# Authors:      <s202540> Rian Leevinson
+#                     <s202385> David Parham
+#                     <s193647> Stefan Nahstoll
+#                     <s210246> Abhista Partal Balasubramaniam
+#
+# Course:        Machine Learning Operations
+# Semester:    Spring 2022
+# Institution:  Technical University of Denmark (DTU)
+#
+# Module: This module is used to test the sharded dataset format
+######################################################################
+
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+from src.data.shards import ShardedArray, ShardWriter, is_sharded
+
+
+def _write(directory, images, dtype="uint8", shard_size=3):
+    writer = ShardWriter(
+        str(directory), list(range(len(images))), images.shape[1:], dtype, shard_size
+    )
+    for position in range(len(images)):
+        writer[position] = images[position]
+    writer.flush()
+    return ShardedArray(str(directory))
+
+
+def test_uint8_round_trip(tmp_path):
+    images = torch.randint(0, 256, (7, 1, 8, 8)).float() / 255
+    shards = _write(tmp_path, images)
+    assert is_sharded(str(tmp_path))
+    assert len(shards) == 7
+    assert shards[0].dtype == np.uint8
+    decoded = shards.decode(torch.from_numpy(shards[:]))
+    assert torch.equal(decoded, images)
+    assert shards.labels.tolist() == list(range(7))
+
+
+def test_slicing_across_shards(tmp_path):
+    images = torch.rand(8, 1, 4, 4)
+    shards = _write(tmp_path, images, dtype="float16")
+    expected = images.half().numpy()
+    np.testing.assert_array_equal(shards[2:7], expected[2:7])
+    np.testing.assert_array_equal(shards[::3], expected[::3])
+    np.testing.assert_array_equal(shards[[6, 0, 4]], expected[[6, 0, 4]])
+    np.testing.assert_array_equal(shards[-1], expected[-1])
+    with pytest.raises(IndexError):
+        shards[8]
+
+
+def test_pickled_view_reopens_shards(tmp_path):
+    images = torch.rand(4, 1, 4, 4)
+    shards = _write(tmp_path, images)
+    shards[0]
+    clone = pickle.loads(pickle.dumps(shards))
+    np.testing.assert_array_equal(clone[3], shards[3])